@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+'''
+Compare download throughputs of binaries: a new connection per binary read
+in 1 KiB chunks versus the download engine (pooled session, large buffers
+filled with readinto). A local HTTP server stands in for CouchDB.
+
+Usage: python benchmarks/download_benchmark.py [large file size in MB]
+'''
+import os
+import sys
+import time
+import tempfile
+import requests
+import threading
+import BaseHTTPServer
+import SocketServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from cozyfuse.downloads import DownloadEngine
+
+SMALL_SIZE = 16 * 1024
+SMALL_COUNT = 500
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Serve an attachment of the size given in the path, with keep-alive.
+    '''
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        size = int(self.path.strip('/'))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        block = self.server.block
+        while size > 0:
+            self.wfile.write(block[:min(size, len(block))])
+            size -= len(block)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def legacy_fetch(url, fd):
+    '''
+    Download the way it was done before the engine.
+    '''
+    req = requests.get(url, stream=True)
+    for chunk in req.iter_content(1024):
+        fd.write(chunk)
+        fd.flush()
+
+
+def run(fetch, url, count, filename):
+    '''
+    Return the time needed to download given URL *count* times.
+    '''
+    start = time.time()
+    for i in range(count):
+        with open(filename, 'wb') as fd:
+            fetch(url, fd)
+    return time.time() - start
+
+
+def main():
+    large_size = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    large_size *= 1024 * 1024
+
+    server = Server(('127.0.0.1', 0), Handler)
+    server.block = os.urandom(1024 * 1024)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base_url = 'http://127.0.0.1:%d' % server.server_address[1]
+
+    (fd, filename) = tempfile.mkstemp()
+    os.close(fd)
+    engine = DownloadEngine()
+    try:
+        for (name, size, count) in [('small', SMALL_SIZE, SMALL_COUNT),
+                                    ('large', large_size, 1)]:
+            url = '%s/%d' % (base_url, size)
+            for (method, fetch) in [('requests 1 KiB', legacy_fetch),
+                                    ('engine', engine.fetch)]:
+                duration = run(fetch, url, count, filename)
+                print '%-6s %8d KiB x %-4d %-15s %8.1f MB/s' % (
+                    name, size / 1024, count, method,
+                    size * count / duration / 1024 / 1024)
+    finally:
+        os.remove(filename)
+        engine.session.close()
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
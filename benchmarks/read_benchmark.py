@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+'''
+Compare the read path of cached binaries: seek/read on the cached file
+versus slicing a memory mapping of it.
+
+Usage: python benchmarks/read_benchmark.py [file size in MB]
+'''
+import os
+import sys
+import time
+import random
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from cozyfuse.filehandle import FileHandle
+
+READ_SIZES = [4 * 1024, 128 * 1024]
+READS = 20000
+
+
+class LocalBinaryCache:
+    '''
+    Binary cache serving a single local file.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def is_cached(self, path):
+        return True
+
+    def get(self, path):
+        return open(self.filename, 'rb')
+
+
+def run(binary_cache, use_mmap, offsets, size):
+    '''
+    Return the time needed to read *size* bytes at each offset.
+    '''
+    fh = FileHandle('/bench', binary_cache, use_mmap)
+    start = time.time()
+    for offset in offsets:
+        fh.read(size, offset)
+    duration = time.time() - start
+    fh.release()
+    return duration
+
+
+def main():
+    file_size = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    file_size *= 1024 * 1024
+
+    (fd, filename) = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as binary:
+        for i in range(file_size / (1024 * 1024)):
+            binary.write(os.urandom(1024 * 1024))
+    binary_cache = LocalBinaryCache(filename)
+
+    try:
+        for size in READ_SIZES:
+            sequential = range(0, file_size, size)[:READS]
+            randoms = [random.randrange(0, file_size - size)
+                       for i in range(READS)]
+
+            for (name, offsets) in [('sequential', sequential),
+                                    ('random', randoms)]:
+                for use_mmap in [False, True]:
+                    duration = run(binary_cache, use_mmap, offsets, size)
+                    print '%-10s %4d KiB %-9s %8.0f reads/s %8.1f MB/s' % (
+                        name,
+                        size / 1024,
+                        'mmap' if use_mmap else 'seek/read',
+                        len(offsets) / duration,
+                        len(offsets) * size / duration / 1024 / 1024)
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -149,6 +149,18 @@ def main(argv=sys.argv):
     )
     parser_display_conf.set_defaults(func=actions.display_config)
 
+    # "stats" action
+    parser_stats = subparsers.add_parser(
+        'stats',
+        help='Display operation latencies and cache hits of a mounted device.'
+    )
+    parser_stats.set_defaults(func=actions.display_stats)
+
+    parser_stats.add_argument(
+        'device',
+        help='Name of the mounted device'
+    ).completer = DeviceCompleter
+
     # "remove_config" action
     parser_rmconf = subparsers.add_parser(
         'remove_config',
@@ -2,7 +2,6 @@ import os
 import sys
 import errno
 import getpass
-import requests
 import json
 import binarycache
 
@@ -11,8 +10,7 @@ import replication
 import local_config
 import remote
 import dbutils
-
-from couchdb import Server
+import metrics
 
 
 def query_yes_no(question, default='yes'):
@@ -112,16 +110,17 @@ def kill_running_replications():
     Useful when a replication is in Zombie mode.
     '''
 
-    server = Server('http://localhost:5984/')
+    client = dbutils.get_client()
 
-    for task in server.tasks():
+    for task in client.server.tasks():
         data = {
             "replication_id": task["replication_id"],
             "cancel": True
         }
         headers = {'content-type': 'application/json'}
-        response = requests.post('http://localhost:5984/_replicate',
-                                 json.dumps(data), headers=headers)
+        response = client.request('POST',
+                                  'http://localhost:5984/_replicate',
+                                  data=json.dumps(data), headers=headers)
         if response.status_code == 200:
             print 'Replication %s stopped.' % data['replication_id']
         else:
@@ -266,13 +265,17 @@ def cache_file(device, path, add=True):
     print "Start %s caching." % abs_path
     if abs_path[:device_mount_path_len] == device_mount_path:
         binary_cache = binarycache.BinaryCache(
-            device, device_config_path, device_url, device_mount_path)
+            device, device_config_path, device_url, device_mount_path,
+            dedup=local_config.get_option(device, 'cache_dedup', False))
         if add:
             binary_cache.add(path)
+            binary_cache.pin(path)
             print "File %s successfully cached." % abs_path
         else:
+            binary_cache.unpin(path)
             binary_cache.remove(path)
             print "File %s successfully uncached." % abs_path
+        binary_cache.flush()
 
     else:
         print "Wrong path, that doesn't match any file in your device folder"
@@ -317,7 +320,8 @@ def cache_folder(device, path, add=True):
 
         # Cache object
         binary_cache = binarycache.BinaryCache(
-            device, device_config_path, device_url, device_mount_path)
+            device, device_config_path, device_url, device_mount_path,
+            dedup=local_config.get_option(device, 'cache_dedup', False))
 
         # Walk through given folder and run cache operation on each file found.
         for (dirpath, dirnames, filenames) in os.walk(abs_path):
@@ -328,10 +332,13 @@ def cache_folder(device, path, add=True):
 
                 if add:
                     binary_cache.add(file_path)
+                    binary_cache.pin(file_path)
                     print "File %s successfully cached." % file_path
                 else:
+                    binary_cache.unpin(file_path)
                     binary_cache.remove(file_path)
                     print "File %s successfully uncached." % file_path
+        binary_cache.flush()
     else:
         print 'This is not a folder synchronized with your Cozy'
 
@@ -343,6 +350,21 @@ def uncache_folder(device, path):
     cache_folder(device, path, False)
 
 
+def display_stats(device):
+    '''
+    Display metrics of the file system mounted for given device.
+    '''
+    filename = os.path.join(local_config.CONFIG_FOLDER, device, 'metrics.json')
+    try:
+        snapshot = metrics.read(filename)
+    except IOError:
+        print 'No metrics found, is %s mounted?' % device
+        sys.exit(1)
+
+    for line in metrics.format_metrics(snapshot):
+        print line
+
+
 def display_config():
     '''
     Display config file in a human readable way.
@@ -1,10 +1,157 @@
 import os
+import copy
+import fcntl
+import base64
 import shutil
-import requests
-import exceptions
+import logging
+import tempfile
+import threading
 
 import dbutils
 import cache
+import locks
+import eviction
+import blockcache
+import fileindex
+import storage
+import downloads
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+# Time (s) to wait for the local CouchDB to answer a range request.
+RANGE_TIMEOUT = 30
+
+
+class Download(threading.Thread):
+    '''
+    Background download of a binary. Data are written to a partial file with
+    a unique name, renamed to the cache file name once complete, so the cache
+    file is never seen truncated. Readers can wait for a given amount of bytes
+    to be written.
+
+    The download holds a lock file next to the cache file, so a process
+    downloading the same binary (the mount and the command line) waits for
+    it and uses its result rather than downloading it again.
+    '''
+
+    def __init__(self, url, filename, on_finished=None, engine=None):
+        '''
+        Create the partial file, so it can be opened as soon as the download
+        is started. Data are fetched by given download engine.
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.url = url
+        self.filename = filename
+        if engine is None:
+            engine = downloads.DownloadEngine()
+        self.engine = engine
+        self.lock_filename = get_lock_filename(filename)
+        self.on_finished = on_finished
+
+        self.written = 0
+        self.done = False
+        self.error = None
+        self._condition = threading.Condition()
+        (fd, self.part_filename) = tempfile.mkstemp(
+            dir=os.path.dirname(filename),
+            prefix=os.path.basename(filename) + '.', suffix='.part')
+        self._part_file = os.fdopen(fd, 'wb')
+
+    def run(self):
+        '''
+        Write binary to the partial file then rename it. Nothing is
+        downloaded if another process cached the binary in the meantime.
+        '''
+        try:
+            with open(self.lock_filename, 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                if os.path.exists(self.filename):
+                    logger.info('[Cache] %s downloaded by another process'
+                                % self.filename)
+                    self._part_file.close()
+                    os.remove(self.part_filename)
+                else:
+                    self._download()
+                    os.rename(self.part_filename, self.filename)
+
+        except Exception as e:
+            self.error = e
+            self._part_file.close()
+            if os.path.exists(self.part_filename):
+                os.remove(self.part_filename)
+
+        with self._condition:
+            self.done = True
+            self._condition.notify_all()
+
+        if self.on_finished is not None:
+            self.on_finished(self)
+
+    def _download(self):
+        '''
+        Write binary to the partial file.
+        '''
+        with self._part_file as fd:
+            self.engine.fetch(self.url, fd, self._on_data)
+
+    def _on_data(self, size):
+        '''
+        Tell readers that *size* more bytes are written. The engine flushes
+        them first: readers use their own file object.
+        '''
+        with self._condition:
+            self.written += size
+            self._condition.notify_all()
+
+    def open(self):
+        '''
+        Return a file object to read the binary while it's downloaded. Once
+        the download is done, the cache file must be opened again: it may
+        have been written by another process.
+        '''
+        try:
+            return open(self.part_filename, 'rb')
+        except IOError:
+            # Download is already finished.
+            self.wait()
+            return open(self.filename, 'rb')
+
+    def wait_for(self, end):
+        '''
+        Wait until the first *end* bytes are written or the download is
+        finished. Raise download error if it failed.
+        '''
+        with self._condition:
+            while not self.done and self.written < end:
+                self._condition.wait()
+        if self.error is not None:
+            raise self.error
+
+    def wait(self):
+        '''
+        Wait until the download is finished. Raise download error if it
+        failed.
+        '''
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+def get_lock_filename(filename):
+    '''
+    Return name of the lock file held while given cache file is downloaded.
+    '''
+    return filename + '.lock'
+
+
+def get_block_key(binary_id, index):
+    '''
+    Return key of given block of a binary in the cache accounting.
+    '''
+    return '%s/%d' % (binary_id, index)
 
 
 class BinaryCache:
@@ -13,21 +160,72 @@ class BinaryCache:
     '''
 
     def __init__(self,
-                 name, device_config_path, remote_url, device_mount_path):
+                 name, device_config_path, remote_url, device_mount_path,
+                 path_index=None,
+                 metadata_validity_period=cache.VALIDITY_PERIOD,
+                 max_size=None, max_files=None, dedup=False,
+                 block_size=None, engine=None):
         '''
-        Register information required to handle caching.
+        Register information required to handle caching. When a loaded path
+        index is given, file documents are read from it. Otherwise they are
+        read from the file index of the device folder, and from views when
+        they are not indexed yet.
+        When *max_size* (bytes) or *max_files* is given, least recently used
+        binaries are evicted to stay within this quota.
+
+        With *dedup*, cached binaries are also stored as blobs named after
+        their attachment digest. Binaries with the same content are hard
+        links to the same blob and are downloaded once.
+
+        With *block_size*, files opened through the mount are cached block by
+        block (see get_blocks), so only the parts read use disk space.
+
+        Binaries are fetched by given download engine, whose session also
+        serves range requests.
         '''
         self.name = name
         self.device_config_path = device_config_path
         self.remote_url = remote_url
         self.device_mount_path = device_mount_path
+        self.path_index = path_index
 
         self.cache_path = os.path.join(device_config_path, 'cache')
+        self.blobs_path = os.path.join(self.cache_path, 'blobs')
+        self.dedup = dedup
         self.db = dbutils.get_db(self.name)
-        self.metadata_cache = cache.Cache()
+        self.storage = storage.StorageQueue(self.db, self.name)
+        if engine is None:
+            engine = downloads.DownloadEngine()
+        self.engine = engine
+        self.metadata_cache = cache.Cache(metadata_validity_period)
+        self.metadata_generation = 0
+        self.locks = locks.KeyLocks()
+        self.downloads = {}
+        self._downloads_lock = threading.Lock()
+        # Binaries for which the database doesn't serve ranges.
+        self.unranged_binaries = set()
+        self.hits = 0
+        self.misses = 0
+        self.range_requests = 0
+        self.evictions = 0
+        self.accounting = eviction.CacheAccounting(max_size, max_files)
+        self.pins = eviction.Pins(os.path.join(device_config_path, 'pinned'))
+        self._eviction_lock = threading.Lock()
+        self._blobs_lock = threading.Lock()
+        self.dedup_hits = 0
+        self.block_size = block_size
+        self.block_files = {}
 
         if not os.path.isdir(self.cache_path):
             os.makedirs(self.cache_path)
+        else:
+            self._remove_partial_files()
+        self.file_index = fileindex.FileIndex(
+            os.path.join(device_config_path, 'files.sqlite'))
+        if dedup and not os.path.isdir(self.blobs_path):
+            os.mkdir(self.blobs_path)
+        if max_size is not None or max_files is not None:
+            self._load_accounting()
 
     def get_file_metadata(self, path):
         '''
@@ -36,22 +234,66 @@ class BinaryCache:
         '''
         res = self.metadata_cache.get(path)
         if res is None:
-            file_doc = dbutils.get_file(self.db, path)
+            generation = self.metadata_generation
+            if self.path_index is not None and self.path_index.loaded:
+                # Copy it, the document is updated when marked as stored.
+                file_doc = copy.deepcopy(self.path_index.get(path))
+            else:
+                file_doc = self.file_index.get(path)
+                if file_doc is None:
+                    file_doc = dbutils.get_file(self.db, path)
+                    if file_doc is not None:
+                        self.file_index.update(file_doc)
             binary_id = file_doc["binary"]["file"]["id"]
             cache_file_folder = os.path.join(self.cache_path, binary_id)
             cache_file_name = os.path.join(cache_file_folder, 'file')
 
             res = (file_doc, binary_id, cache_file_name)
-            self.metadata_cache.add(path, res)
+            if generation == self.metadata_generation:
+                self.metadata_cache.add(path, res)
         return res
 
+    def on_change(self, line):
+        '''
+        Apply a line of the changes feed to the file index.
+        '''
+        self.file_index.on_change(line)
+
+    def evict_metadata(self, path):
+        '''
+        Remove cached metadata of given path. Metadata read before the
+        eviction are not cached.
+        '''
+        self.metadata_generation += 1
+        self.metadata_cache.remove(path)
+
     def is_cached(self, path):
         '''
         Return True is the file is already present in the cache folder.
+        Downloads are renamed to the cache file once complete, so an
+        existing cache file is complete. One with another size than the file
+        document is a previous content or a truncated file written by an
+        older version: it is removed to be downloaded again.
         '''
         (file_doc, binary_id, filename) = self.get_file_metadata(path)
 
-        return os.path.exists(filename)
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            size = None
+        if size is not None and size != file_doc.get('size', size):
+            logger.warn('[Cache] %s has %d bytes instead of %d, removed'
+                        % (binary_id, size, file_doc['size']))
+            with self.locks.lock(binary_id):
+                self._remove_binary(binary_id, True)
+            size = None
+
+        if size is not None:
+            self.hits += 1
+            return True
+        else:
+            self.misses += 1
+            return False
 
     def get(self, path):
         '''
@@ -59,34 +301,496 @@ class BinaryCache:
         '''
         (file_doc, binary_id, filename) = self.get_file_metadata(path)
 
-        return open(filename, 'rb')
+        cached_file = open(filename, 'rb')
+        self.accounting.touch(binary_id)
+        self.file_index.touch(binary_id)
+        return cached_file
 
     def add(self, path):
         '''
         Download binary from local CouchDB and save it in the cache folder.
         File is marked as stored in the file metadata.
         '''
+        download = self.start_download(path)
+        if download is not None:
+            download.wait()
+
+    def start_download(self, path):
+        '''
+        Start downloading binary of given file in background, or return the
+        download already running for it. Return None if the file is already
+        cached. File is marked as stored once downloaded.
+        '''
         (file_doc, binary_id, filename) = self.get_file_metadata(path)
         cache_file_folder = os.path.join(self.cache_path, binary_id)
 
-        # Create cache folder for given binary
-        if not os.path.isdir(cache_file_folder):
-            os.mkdir(cache_file_folder)
+        digest = None
+        if self.dedup and not os.path.exists(filename):
+            digest = self.get_digest(binary_id)
+            if digest is not None and \
+                    self._link_blob(digest, binary_id, file_doc):
+                return None
 
-        # Download file.
+        with self._downloads_lock:
+            download = self.downloads.get(binary_id)
+            if download is None and not os.path.exists(filename):
+
+                # Create cache folder for given binary
+                if not os.path.isdir(cache_file_folder):
+                    os.mkdir(cache_file_folder)
+
+                url = '%s/%s/%s' % (self.remote_url, binary_id, 'file')
+                download = Download(
+                    url, filename,
+                    lambda download: self._on_downloaded(
+                        download, binary_id, file_doc, digest),
+                    self.engine)
+                self.downloads[binary_id] = download
+                download.start()
+        return download
+
+    def get_blocks(self, path):
+        '''
+        Return block file caching file located at given path block by block.
+        Return None if the file is cached or must be downloaded entirely:
+        block mode is off, the file size is unknown, the database doesn't
+        serve ranges of it or its download is already running.
+        '''
+        if self.block_size is None:
+            return None
+        (file_doc, binary_id, filename) = self.get_file_metadata(path)
+        size = file_doc.get('size')
+        if size is None or binary_id in self.unranged_binaries \
+                or os.path.exists(filename):
+            return None
+
+        with self._downloads_lock:
+            if binary_id in self.downloads:
+                return None
+            block_file = self.block_files.get(binary_id)
+            if block_file is None or block_file.size != size:
+                cache_file_folder = os.path.join(self.cache_path, binary_id)
+                if not os.path.isdir(cache_file_folder):
+                    os.mkdir(cache_file_folder)
+                block_file = blockcache.BlockFile(
+                    cache_file_folder, size,
+                    lambda offset, length: self._read_binary_range(
+                        binary_id, offset, length),
+                    self.block_size)
+                self.block_files[binary_id] = block_file
+        return block_file
+
+    def read_blocks(self, path, block_file, size, offset):
+        '''
+        Read *size* bytes at *offset* of the block file of file located at
+        given path. Fetched blocks are counted in the cache quota. Once all
+        blocks are there, the block file becomes the cached binary. Return
+        None if blocks can't be fetched with range requests.
+        '''
+        binary_id = os.path.basename(block_file.folder)
+        (buf, added) = block_file.read(size, offset)
+        for (index, block_size) in added:
+            self.accounting.add(get_block_key(binary_id, index),
+                                block_size, None)
+        if size > 0 and offset < block_file.size:
+            last = min(offset + size, block_file.size) - 1
+            for index in range(offset // block_file.block_size,
+                               last // block_file.block_size + 1):
+                self.accounting.touch(get_block_key(binary_id, index))
+
+        if buf is not None and len(added) > 0 and block_file.is_complete():
+            self._promote_blocks(path, binary_id, block_file)
+        self._evict()
+        return buf
+
+    def read_range(self, path, offset, size):
+        '''
+        Read part of a binary straight from the local CouchDB. Return None if
+        the database can't serve this range (compressed attachment).
+        '''
+        (file_doc, binary_id, filename) = self.get_file_metadata(path)
+        return self._read_binary_range(binary_id, offset, size)
+
+    def _read_binary_range(self, binary_id, offset, size):
+        '''
+        Read part of given binary, see read_range.
+        '''
+        if binary_id in self.unranged_binaries:
+            return None
+
+        self.range_requests += 1
         url = '%s/%s/%s' % (self.remote_url, binary_id, 'file')
-        req = requests.get(url, stream=True)
-        if req.status_code != 200:
-            raise exceptions.IOError(
-                "File not stored in the local CouchDB database %s" % url)
-        else:
-            with open(filename, 'wb') as fd:
-                for chunk in req.iter_content(1024):
-                    fd.write(chunk)
+        headers = {'Range': 'bytes=%d-%d' % (offset, offset + size - 1)}
+        # Streamed, so a complete attachment sent instead of the range is
+        # not read.
+        req = self.engine.session.get(url, headers=headers, stream=True,
+                                      timeout=RANGE_TIMEOUT)
+        try:
+            if req.status_code == 206:
+                return req.content
+            elif req.status_code == 416:
+                return ''
+            else:
+                if req.status_code == 200:
+                    self.unranged_binaries.add(binary_id)
+                return None
+        finally:
+            req.close()
+
+    def pin(self, path):
+        '''
+        Prevent binary of file located at given path from being evicted.
+        '''
+        (file_doc, binary_id, filename) = self.get_file_metadata(path)
+        self.pins.add(binary_id)
 
-            # Update metadata.
-            file_doc['size'] = os.path.getsize(filename)
+    def unpin(self, path):
+        '''
+        Let binary of file located at given path be evicted again.
+        '''
+        (file_doc, binary_id, filename) = self.get_file_metadata(path)
+        self.pins.remove(binary_id)
+
+    def get_cached_binaries(self):
+        '''
+        Return IDs of binaries entirely cached.
+        '''
+        return [binary_id for binary_id in os.listdir(self.cache_path)
+                if binary_id != 'blobs' and os.path.exists(
+                    os.path.join(self.cache_path, binary_id, 'file'))]
+
+    def repair(self, binary_id, stat=None):
+        '''
+        Remove corrupt cached binary, and its blob which has the same
+        content, then download it again. When *stat* is given, nothing is
+        done if the cached file changed since it was checked. Return the
+        download, None if the binary isn't downloaded again.
+        '''
+        cache_file_folder = os.path.join(self.cache_path, binary_id)
+        filename = os.path.join(cache_file_folder, 'file')
+        doc_filename = os.path.join(cache_file_folder, 'doc')
+        digest_filename = os.path.join(cache_file_folder, 'digest')
+        file_id = None
+        with self.locks.lock(binary_id):
+            try:
+                current = os.stat(filename)
+            except OSError:
+                return None
+            if stat is not None and \
+                    (current.st_ino, current.st_size, current.st_mtime) != \
+                    (stat.st_ino, stat.st_size, stat.st_mtime):
+                return None
+            if os.path.exists(doc_filename):
+                with open(doc_filename) as fd:
+                    file_id = fd.read().strip()
+            if os.path.exists(digest_filename):
+                with open(digest_filename) as fd:
+                    blob_filename = self._get_blob_filename(fd.read().strip())
+                with self._blobs_lock:
+                    try:
+                        os.remove(blob_filename)
+                    except OSError:
+                        pass
+            self._remove_binary(binary_id, True)
+        if file_id is not None:
+            self.storage.mark(file_id, False)
+
+        path = self.file_index.get_path(binary_id)
+        if path is None:
+            return None
+        self.evict_metadata(path)
+        return self.start_download(path)
+
+    def stats(self):
+        '''
+        Return cache hits and misses of binaries, downloads running, range
+        requests sent, and size, number and evictions of cached binaries.
+        '''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'downloads': len(self.downloads),
+            'range_requests': self.range_requests,
+            'size': self.accounting.size,
+            'files': len(self.accounting),
+            'evictions': self.evictions,
+            'dedup_hits': self.dedup_hits,
+        }
+
+    def _remove_partial_files(self):
+        '''
+        Remove partial files left by downloads interrupted by a crash.
+        Binaries being downloaded by another process are skipped: their lock
+        file is held.
+        '''
+        for binary_id in os.listdir(self.cache_path):
+            cache_file_folder = os.path.join(self.cache_path, binary_id)
+            if binary_id == 'blobs' or not os.path.isdir(cache_file_folder):
+                continue
+            part_filenames = [filename
+                              for filename in os.listdir(cache_file_folder)
+                              if filename.endswith('.part')]
+            if len(part_filenames) == 0:
+                continue
+
+            lock_filename = get_lock_filename(
+                os.path.join(cache_file_folder, 'file'))
+            with open(lock_filename, 'w') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    continue
+                for filename in part_filenames:
+                    logger.warn('[Cache] Removing stale file %s/%s'
+                                % (binary_id, filename))
+                    os.remove(os.path.join(cache_file_folder, filename))
+
+    def _load_accounting(self):
+        '''
+        Count binaries and blocks already in the cache, ordered by their last
+        access. It's done once, the accounting is then kept up to date in
+        memory.
+        '''
+        entries = []
+        for binary_id in os.listdir(self.cache_path):
+            if binary_id == 'blobs':
+                continue
+            cache_file_folder = os.path.join(self.cache_path, binary_id)
+            try:
+                stat = os.stat(os.path.join(cache_file_folder, 'file'))
+            except OSError:
+                entries.extend(self._get_block_entries(binary_id))
+                continue
+            file_id = None
+            doc_filename = os.path.join(cache_file_folder, 'doc')
+            if os.path.exists(doc_filename):
+                with open(doc_filename) as fd:
+                    file_id = fd.read().strip()
+            last_access = max(stat.st_atime, stat.st_mtime)
+            entries.append((last_access, binary_id, stat.st_size, file_id))
+
+        for (last_access, binary_id, size, file_id) in sorted(entries):
+            self.accounting.add(binary_id, size, file_id)
+        logger.info('[Cache] %d binaries cached, %d bytes'
+                    % (len(self.accounting), self.accounting.size))
+
+    def _get_block_entries(self, binary_id):
+        '''
+        Return accounting entries of blocks of given binary cached in block
+        mode.
+        '''
+        cache_file_folder = os.path.join(self.cache_path, binary_id)
+        bitmap = blockcache.read_bitmap(cache_file_folder)
+        if self.block_size is None or bitmap is None:
+            return []
+        last_access = os.path.getmtime(
+            os.path.join(cache_file_folder, 'bitmap'))
+        return [(last_access, get_block_key(binary_id, index),
+                 self.block_size, None)
+                for index in blockcache.get_blocks(bitmap)]
+
+    def _promote_blocks(self, path, binary_id, block_file):
+        '''
+        Make the complete block file of given binary its cached binary.
+        '''
+        try:
+            with self.locks.lock(binary_id):
+                (file_doc, binary_id, filename) = \
+                    self.get_file_metadata(path)
+                block_file.promote(filename)
+                with self._downloads_lock:
+                    self.block_files.pop(binary_id, None)
+                for index in range(block_file.count):
+                    self.accounting.remove(get_block_key(binary_id, index))
+                self.mark_file_as_stored(file_doc)
+                self._account(binary_id, file_doc['_id'])
+        except Exception:
+            logger.exception('[Cache] Cannot store blocks of %s' % binary_id)
+
+    def _account(self, binary_id, file_id):
+        '''
+        Count binary just added to the cache. The ID of its file document is
+        kept next to it, to update the document when the binary is evicted
+        after a restart. Binary lock must be held.
+        '''
+        cache_file_folder = os.path.join(self.cache_path, binary_id)
+        with open(os.path.join(cache_file_folder, 'doc'), 'w') as fd:
+            fd.write(file_id)
+        size = os.path.getsize(os.path.join(cache_file_folder, 'file'))
+        self.accounting.add(binary_id, size, file_id)
+        self.file_index.set_cached(binary_id, True)
+
+    def _evict(self):
+        '''
+        Remove least recently used binaries until the cache is within its
+        quota. Their files are marked as not stored on this device.
+        '''
+        with self._eviction_lock:
+            for (binary_id, file_id) in \
+                    self.accounting.get_victims(self.pins.get()):
+                if '/' in binary_id:
+                    self._evict_block(binary_id)
+                    self.evictions += 1
+                    continue
+                with self.locks.lock(binary_id):
+                    self._remove_binary(binary_id, True)
+                self.evictions += 1
+                logger.info('[Cache] %s evicted' % binary_id)
+                if file_id is not None:
+                    self.storage.mark(file_id, False)
+
+    def get_digest(self, binary_id):
+        '''
+        Return digest of the attachment of given binary, None if it can't be
+        read. It's read from the file index when it's known.
+        '''
+        state = self.file_index.get_state(binary_id)
+        if state is not None and state['digest'] is not None:
+            return state['digest']
+        try:
+            binary = self.db[binary_id]
+            digest = binary['_attachments']['file']['digest']
+            self.file_index.set_digest(binary_id, digest)
+            return digest
+        except Exception:
+            logger.exception('[Cache] Cannot read digest of %s' % binary_id)
+            return None
+
+    def _get_blob_filename(self, digest):
+        '''
+        Return path of the blob of given digest. Digests are base64 encoded,
+        they are hex encoded to get a valid file name.
+        '''
+        (algorithm, value) = digest.split('-', 1)
+        return os.path.join(self.blobs_path, '%s-%s' % (
+            algorithm, base64.b64decode(value).encode('hex')))
+
+    def _link_blob(self, digest, binary_id, file_doc):
+        '''
+        Cache given binary as a link to the blob of given digest, if it is
+        stored. Return True if the binary is cached this way.
+        '''
+        blob_filename = self._get_blob_filename(digest)
+        cache_file_folder = os.path.join(self.cache_path, binary_id)
+        with self.locks.lock(binary_id):
+            with self._blobs_lock:
+                if not os.path.exists(blob_filename):
+                    return False
+                if not os.path.isdir(cache_file_folder):
+                    os.mkdir(cache_file_folder)
+                try:
+                    os.link(blob_filename,
+                            os.path.join(cache_file_folder, 'file'))
+                except OSError:
+                    logger.exception('[Cache] Cannot link blob %s' % digest)
+                    return False
+            self._store_digest(binary_id, digest)
+            file_doc['size'] = os.path.getsize(blob_filename)
             self.mark_file_as_stored(file_doc)
+            self._account(binary_id, file_doc['_id'])
+        self.dedup_hits += 1
+        logger.info('[Cache] %s linked to blob %s' % (binary_id, digest))
+        self._evict()
+        return True
+
+    def _add_blob(self, digest, binary_id):
+        '''
+        Store cached binary as the blob of given digest, unless this blob
+        already exists. Binary lock must be held.
+        '''
+        blob_filename = self._get_blob_filename(digest)
+        filename = os.path.join(self.cache_path, binary_id, 'file')
+        with self._blobs_lock:
+            try:
+                if not os.path.exists(blob_filename):
+                    os.link(filename, blob_filename)
+            except OSError:
+                logger.exception('[Cache] Cannot add blob %s' % digest)
+                return
+        self._store_digest(binary_id, digest)
+
+    def _store_digest(self, binary_id, digest):
+        '''
+        Keep digest next to the cached binary, to find its blob when the
+        binary is removed.
+        '''
+        digest_filename = os.path.join(self.cache_path, binary_id, 'digest')
+        with open(digest_filename, 'w') as fd:
+            fd.write(digest)
+
+    def _evict_block(self, key):
+        '''
+        Remove block of given accounting key from the cache.
+        '''
+        (binary_id, index) = key.split('/')
+        index = int(index)
+        cache_file_folder = os.path.join(self.cache_path, binary_id)
+        with self.locks.lock(binary_id):
+            self.accounting.remove(key)
+            block_file = self.block_files.get(binary_id)
+            if block_file is not None:
+                block_file.evict_block(index)
+            else:
+                bitmap = blockcache.read_bitmap(cache_file_folder)
+                if bitmap is None:
+                    return
+                blockcache.set_block(bitmap, index, False)
+                blockcache.write_bitmap(cache_file_folder, bitmap)
+                blockcache.evict_block(cache_file_folder, index,
+                                       self.block_size)
+
+    def _remove_binary(self, binary_id, ignore_errors=False):
+        '''
+        Remove cached binary, and its blob once no other binary links to it.
+        Binary lock must be held.
+        '''
+        cache_file_folder = os.path.join(self.cache_path, binary_id)
+        digest_filename = os.path.join(cache_file_folder, 'digest')
+        blob_filename = None
+        if os.path.exists(digest_filename):
+            with open(digest_filename) as fd:
+                blob_filename = self._get_blob_filename(fd.read().strip())
+        bitmap = blockcache.read_bitmap(cache_file_folder)
+        if bitmap is not None:
+            for index in blockcache.get_blocks(bitmap):
+                self.accounting.remove(get_block_key(binary_id, index))
+        with self._downloads_lock:
+            self.block_files.pop(binary_id, None)
+
+        shutil.rmtree(cache_file_folder, ignore_errors)
+        self.accounting.remove(binary_id)
+        self.file_index.set_cached(binary_id, False)
+
+        if blob_filename is not None:
+            with self._blobs_lock:
+                try:
+                    if os.stat(blob_filename).st_nlink == 1:
+                        os.remove(blob_filename)
+                except OSError:
+                    pass
+
+    def _on_downloaded(self, download, binary_id, file_doc, digest=None):
+        '''
+        Update metadata once a download is finished. The binary is stored as
+        a blob too when its digest is given.
+        '''
+        try:
+            if download.error is None:
+                with self.locks.lock(binary_id):
+                    file_doc['size'] = os.path.getsize(download.filename)
+                    self.mark_file_as_stored(file_doc)
+                    self._account(binary_id, file_doc['_id'])
+                    if digest is not None:
+                        self._add_blob(digest, binary_id)
+                self._evict()
+            else:
+                logger.error('[Cache] Download of %s failed: %s'
+                             % (binary_id, download.error))
+        except Exception:
+            logger.exception('[Cache] Cannot mark %s as stored' % binary_id)
+        finally:
+            with self._downloads_lock:
+                self.downloads.pop(binary_id, None)
 
     def remove(self, path):
         '''
@@ -94,30 +798,61 @@ class BinaryCache:
         '''
         (file_doc, binary_id, filename) = self.get_file_metadata(path)
 
-        cache_file_folder = os.path.join(self.cache_path, binary_id)
-        shutil.rmtree(cache_file_folder)
+        with self.locks.lock(binary_id):
+            self._remove_binary(binary_id)
         self.mark_file_as_not_stored(file_doc)
 
+    def store(self, path, filename):
+        '''
+        Move given local file to the cache as the binary of file located at
+        given path. File document is expected to be marked as stored.
+        '''
+        (file_doc, binary_id, cache_filename) = self.get_file_metadata(path)
+        cache_file_folder = os.path.join(self.cache_path, binary_id)
+        with self.locks.lock(binary_id):
+            if not os.path.isdir(cache_file_folder):
+                os.mkdir(cache_file_folder)
+            os.rename(filename, cache_filename)
+            self._account(binary_id, file_doc['_id'])
+        self._evict()
+
+    def discard(self, path):
+        '''
+        Remove cached binary of file located at given path without updating
+        the file document, which is being changed or deleted.
+        '''
+        (file_doc, binary_id, filename) = self.get_file_metadata(path)
+        with self.locks.lock(binary_id):
+            self._remove_binary(binary_id, True)
+
     def mark_file_as_stored(self, file_doc):
         '''
         Mark file as stored in the database. It's done by adding the device
-        name to the storage list field.
+        name to the storage list field. The document is saved with the next
+        flush of the storage queue, with its size.
         '''
         if file_doc.get('storage', None) is None:
             file_doc['storage'] = [self.name]
         elif not (self.name in file_doc['storage']):
             file_doc['storage'].append(self.name)
 
-        self.db.save(file_doc)
+        self.storage.mark(file_doc['_id'], True, file_doc.get('size'))
 
     def mark_file_as_not_stored(self, file_doc):
         '''
         Remove the device name from the storage list linked to the given
-        file_doc.
+        file_doc. The document is saved with the next flush of the storage
+        queue.
         '''
         if file_doc.get('storage', None) is None:
             return
         elif self.name in file_doc['storage']:
             file_doc['storage'].remove(self.name)
 
-        self.db.save(file_doc)
+        self.storage.mark(file_doc['_id'], False)
+
+    def flush(self):
+        '''
+        Save storage marks waiting in the queue.
+        '''
+        self.storage.flush()
@@ -0,0 +1,209 @@
+import os
+import ctypes
+import ctypes.util
+import logging
+import threading
+
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+# Size (bytes) of the blocks fetched and evicted in block mode.
+BLOCK_SIZE = 1024 * 1024
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _fallocate = _libc.fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                           ctypes.c_longlong, ctypes.c_longlong]
+except (OSError, AttributeError):
+    # Not Linux: evicted blocks keep their disk space until the whole file
+    # is removed.
+    _fallocate = None
+
+
+class BlockFile:
+    '''
+    Binary cached block by block. Blocks are written at their offset in a
+    sparse file, so only fetched blocks use disk space, and a bitmap of
+    present blocks is stored next to it. Reads fetch missing blocks with
+    range requests.
+    '''
+
+    def __init__(self, folder, size, fetch, block_size=BLOCK_SIZE):
+        '''
+        Open block file of a binary of given size stored in *folder*.
+        *fetch(offset, size)* returns data of the binary, or None if ranges
+        can't be read. When the sparse file doesn't match the size, blocks
+        are from a previous content and are dropped.
+        '''
+        self.folder = folder
+        self.size = size
+        self.fetch = fetch
+        self.block_size = block_size
+        self.count = (size + block_size - 1) // block_size
+        self.filename = os.path.join(folder, 'blocks')
+        self._lock = threading.RLock()
+
+        self.bitmap = read_bitmap(folder)
+        if self.bitmap is None or len(self.bitmap) != (self.count + 7) // 8 \
+                or not os.path.exists(self.filename) \
+                or os.path.getsize(self.filename) != size:
+            self.bitmap = bytearray((self.count + 7) // 8)
+            with open(self.filename, 'wb') as fd:
+                fd.truncate(size)
+            self._save_bitmap()
+
+    def is_complete(self):
+        '''
+        Return True if all blocks are present.
+        '''
+        with self._lock:
+            return all(has_block(self.bitmap, index)
+                       for index in range(self.count))
+
+    def read(self, size, offset):
+        '''
+        Return *size* bytes starting at *offset*, fetching missing blocks.
+        Return None if they can't be fetched with range requests. The list
+        of fetched blocks, as (index, size), is given as second value.
+        '''
+        with self._lock:
+            if offset >= self.size:
+                return ('', [])
+            end = min(offset + size, self.size)
+            added = []
+            for (first, last) in self._missing_runs(
+                    offset // self.block_size, (end - 1) // self.block_size):
+                start = first * self.block_size
+                stop = min((last + 1) * self.block_size, self.size)
+                data = self.fetch(start, stop - start)
+                if data is None or len(data) != stop - start:
+                    return (None, added)
+                with open(self.filename, 'r+b') as fd:
+                    fd.seek(start)
+                    fd.write(data)
+                for index in range(first, last + 1):
+                    set_block(self.bitmap, index, True)
+                    added.append((index, self.get_block_size(index)))
+            if len(added) > 0:
+                self._save_bitmap()
+
+            with open(self.filename, 'rb') as fd:
+                fd.seek(offset)
+                return (fd.read(end - offset), added)
+
+    def get_block_size(self, index):
+        '''
+        Return size of block of given index, the last one can be shorter.
+        '''
+        return min(self.block_size, self.size - index * self.block_size)
+
+    def evict_block(self, index):
+        '''
+        Mark block as missing and free its disk space.
+        '''
+        with self._lock:
+            set_block(self.bitmap, index, False)
+            self._save_bitmap()
+            evict_block(self.folder, index, self.block_size)
+
+    def promote(self, filename):
+        '''
+        Move the complete sparse file to *filename*, the bitmap is not needed
+        any more. Following reads are served by the new file.
+        '''
+        with self._lock:
+            os.rename(self.filename, filename)
+            os.remove(os.path.join(self.folder, 'bitmap'))
+            self.filename = filename
+
+    def _missing_runs(self, first, last):
+        '''
+        Return (first, last) indexes of runs of consecutive missing blocks
+        between given blocks, so each run is fetched with one request.
+        '''
+        runs = []
+        for index in range(first, last + 1):
+            if has_block(self.bitmap, index):
+                continue
+            if len(runs) > 0 and runs[-1][1] == index - 1:
+                runs[-1] = (runs[-1][0], index)
+            else:
+                runs.append((index, index))
+        return runs
+
+    def _save_bitmap(self):
+        '''
+        Write the bitmap to a temporary file then rename it, so a crash never
+        leaves a partial bitmap.
+        '''
+        write_bitmap(self.folder, self.bitmap)
+
+
+def read_bitmap(folder):
+    '''
+    Return bitmap of present blocks stored in given folder, None if there is
+    none.
+    '''
+    filename = os.path.join(folder, 'bitmap')
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'rb') as fd:
+        return bytearray(fd.read())
+
+
+def write_bitmap(folder, bitmap):
+    '''
+    Store bitmap of present blocks in given folder.
+    '''
+    filename = os.path.join(folder, 'bitmap')
+    with open(filename + '.tmp', 'wb') as fd:
+        fd.write(bitmap)
+    os.rename(filename + '.tmp', filename)
+
+
+def has_block(bitmap, index):
+    '''
+    Return True if block of given index is present in given bitmap.
+    '''
+    return bool(bitmap[index // 8] & (1 << (index % 8)))
+
+
+def set_block(bitmap, index, present):
+    '''
+    Set presence of block of given index in given bitmap.
+    '''
+    if present:
+        bitmap[index // 8] |= 1 << (index % 8)
+    else:
+        bitmap[index // 8] &= ~(1 << (index % 8)) & 0xff
+
+
+def get_blocks(bitmap):
+    '''
+    Return indexes of blocks present in given bitmap.
+    '''
+    return [index for index in range(len(bitmap) * 8)
+            if has_block(bitmap, index)]
+
+
+def evict_block(folder, index, block_size=BLOCK_SIZE):
+    '''
+    Free disk space of block of given index in the sparse file of given
+    folder. The bitmap is expected to be updated by the caller.
+    '''
+    filename = os.path.join(folder, 'blocks')
+    if _fallocate is None or not os.path.exists(filename):
+        return
+    with open(filename, 'r+b') as fd:
+        result = _fallocate(fd.fileno(),
+                            FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                            index * block_size, block_size)
+    if result != 0:
+        logger.warn('[Cache] Cannot free block %d of %s: errno %d'
+                    % (index, folder, ctypes.get_errno()))
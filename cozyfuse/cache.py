@@ -1,4 +1,5 @@
 import datetime
+import threading
 
 VALIDITY_PERIOD = datetime.timedelta(seconds=30)
 
@@ -6,6 +7,8 @@ VALIDITY_PERIOD = datetime.timedelta(seconds=30)
 class Cache:
     '''
     Utility to store data in memory for a short time and retrieve them quickly.
+    It can be used from several threads. When validity period is None, data
+    are kept until they are removed. Hits, misses and evictions are counted.
     '''
 
     def __init__(self, validity_period=VALIDITY_PERIOD):
@@ -15,7 +18,11 @@ class Cache:
         '''
         self._cache = {}
         self._timestamps = {}
+        self._lock = threading.Lock()
         self.validity_period = validity_period
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
     def get(self, key):
         '''
@@ -23,26 +30,56 @@ class Cache:
         and the validity period is not expired.
         '''
         now = datetime.datetime.now()
-        if self._timestamps.get(key, now) > now:
-            return self._cache[key]
-        else:
-            self.remove(key)
-            return None
+        with self._lock:
+            if key not in self._cache:
+                self.misses += 1
+                return None
+            elif self._timestamps[key] is None or self._timestamps[key] > now:
+                self.hits += 1
+                return self._cache[key]
+            else:
+                self._remove(key)
+                self.misses += 1
+                return None
 
     def add(self, key, value):
         '''
         Add a key/value couple to the cache that will be valing for defined
         validity period.
         '''
-        now = datetime.datetime.now()
-        self._cache[key] = value
-        self._timestamps[key] = now + self.validity_period
+        if self.validity_period is None:
+            timestamp = None
+        else:
+            timestamp = datetime.datetime.now() + self.validity_period
+        with self._lock:
+            self._cache[key] = value
+            self._timestamps[key] = timestamp
 
     def remove(self, key):
         '''
         Remove couple key/value from cache.
         '''
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        '''
+        Remove couple key/value from cache, lock must be held.
+        '''
         if key in self._cache:
             del self._cache[key]
+            self.evictions += 1
         if key in self._timestamps:
             del self._timestamps[key]
+
+    def stats(self):
+        '''
+        Return number of entries, hits, misses and evictions.
+        '''
+        with self._lock:
+            return {
+                'size': len(self._cache),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,74 @@
+import logging
+import threading
+
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+# Time (ms) CouchDB keeps a longpoll request open when nothing changes.
+LONGPOLL_TIMEOUT = 60000
+# Time (s) to wait before retrying when the changes feed is unreachable.
+RETRY_DELAY = 5
+
+
+class ChangesListener(threading.Thread):
+    '''
+    Background thread that follows the changes feed of the local database
+    and gives each change to the registered callbacks.
+    '''
+
+    def __init__(self, db, since=0):
+        '''
+        Register database to listen to and the sequence number from where
+        changes should be read.
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.db = db
+        self.since = since
+        self.callbacks = []
+        self._stopped = threading.Event()
+
+    def register(self, callback):
+        '''
+        Add a function to call for each change. It receives the change line
+        (with the related document).
+        '''
+        self.callbacks.append(callback)
+
+    def stop(self):
+        '''
+        Ask the thread to stop after the current request.
+        '''
+        self._stopped.set()
+
+    def run(self):
+        '''
+        Long poll the changes feed until the listener is stopped.
+        '''
+        while not self._stopped.is_set():
+            try:
+                changes = self.db.changes(feed='longpoll',
+                                          since=self.since,
+                                          include_docs=True,
+                                          timeout=LONGPOLL_TIMEOUT)
+                for line in changes['results']:
+                    self._dispatch(line)
+                self.since = changes['last_seq']
+
+            except Exception:
+                logger.exception('[Changes] Cannot read changes feed')
+                self._stopped.wait(RETRY_DELAY)
+
+    def _dispatch(self, line):
+        '''
+        Give change line to every callback. A failing callback doesn't
+        prevent others from being called.
+        '''
+        for callback in self.callbacks:
+            try:
+                callback(line)
+            except Exception:
+                logger.exception(
+                    '[Changes] Cannot handle change for %s' % line['id'])
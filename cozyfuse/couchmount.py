@@ -9,6 +9,8 @@
 # you should have received as part of this distribution.
 
 import os
+import copy
+import bisect
 import platform
 import errno
 import fuse
@@ -21,29 +23,42 @@ import cache
 
 import dbutils
 import binarycache
+import blockcache
+import logs
 import local_config
-
-ATTR_VALIDITY_PERIOD = datetime.timedelta(seconds=10)
+import pathindex
+import changes
+import filehandle
+import diskspace
+import downloads
+import integrity
+import metadata
+import metrics
+import storage
+import tree
+import writeback
 
 DEVNULL = open(os.devnull, 'wb')
 
 fuse.fuse_python_api = (0, 2)
 
 CONFIG_FOLDER = os.path.join(os.path.expanduser('~'), '.cozyfuse')
-HDLR = logging.FileHandler(os.path.join(CONFIG_FOLDER, 'cozyfuse.log'))
-HDLR.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
 
-logger = logging.getLogger(__name__)
-logger.addHandler(HDLR)
-logger.setLevel(logging.INFO)
+# Hot operations: only one call out of this number is logged by default.
+LOG_SAMPLING = {
+    'getattr': 100,
+    'read': 100,
+}
 
+# File system operations whose calls are measured.
+INSTRUMENTED_OPERATIONS = [
+    'getattr', 'readdir', 'open', 'read', 'write', 'release', 'mknod',
+    'unlink', 'truncate', 'ftruncate', 'mkdir', 'rmdir', 'rename', 'fsync',
+    'statfs',
+]
 
-def get_current_date():
-    """
-    Get current date : Return current date with format 'Y-m-d T H:M:S'
-        Exemple : 2014-05-07T09:17:48
-    """
-    return datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
 
 
 def get_date(ctime):
@@ -85,6 +100,26 @@ class CouchStat(fuse.Stat):
         self.st_blocks = 0
 
 
+def get_stat(doc):
+    '''
+    Build file descriptor from a folder or file document.
+    '''
+    st = CouchStat()
+    if pathindex.is_folder(doc):
+        st.st_mode = stat.S_IFDIR | 0o775
+        st.st_nlink = 2
+    else:
+        st.st_mode = stat.S_IFREG | 0o664
+        st.st_nlink = 1
+        st.st_size = doc.get('size', 4096)
+
+    if 'lastModification' in doc:
+        st.st_atime = get_date(doc['lastModification'])
+        st.st_ctime = st.st_atime
+        st.st_mtime = st.st_atime
+    return st
+
+
 class CouchFSDocument(fuse.Fuse):
 
     '''
@@ -107,6 +142,10 @@ class CouchFSDocument(fuse.Fuse):
 
         # Configure device
         self.device = device_name
+        self.op_logger = logs.OperationLogger(
+            logger,
+            local_config.get_option(device_name, 'log_levels', {}),
+            local_config.get_option(device_name, 'log_sampling', LOG_SAMPLING))
         (self.db, self.server) = dbutils.get_db_and_server(device_name)
         logger.info('- Database configured')
 
@@ -133,90 +172,153 @@ class CouchFSDocument(fuse.Fuse):
         logger.info(self.rep_target)
         logger.info('- Replication configured')
 
+        # Configure path index
+        self.path_index = pathindex.PathIndex()
+        self.changes_listener = None
+        self._load_path_index()
+
+        # Without the path index, deleted documents can't be matched to their
+        # paths, so cached file metadata expire.
+        if self.path_index.loaded:
+            metadata_validity_period = None
+        else:
+            metadata_validity_period = cache.VALIDITY_PERIOD
+
         # Configure cache and create required folders
-        self.writeBuffers = {}
         device_path = os.path.join(CONFIG_FOLDER, device_name)
+        cache_max_size = local_config.get_option(
+            device_name, 'cache_max_size')
+        if cache_max_size is not None:
+            cache_max_size = int(cache_max_size * 1024 * 1024)
+        block_size = None
+        if local_config.get_option(device_name, 'cache_blocks', False):
+            block_size = blockcache.BLOCK_SIZE
+        engine = downloads.DownloadEngine(fsync=local_config.get_option(
+            device_name, 'download_fsync', downloads.FSYNC_NEVER))
         self.binary_cache =  binarycache.BinaryCache(
-            device_name, device_path, self.rep_source, mountpoint)
-
-        self.file_size_cache = cache.Cache()
-        self.attr_cache = cache.Cache(ATTR_VALIDITY_PERIOD)
-        self.readdir_file_cache = cache.Cache(ATTR_VALIDITY_PERIOD)
-        self.readdir_folder_cache = cache.Cache(ATTR_VALIDITY_PERIOD)
+            device_name, device_path, self.rep_source, mountpoint,
+            self.path_index, metadata_validity_period,
+            cache_max_size,
+            local_config.get_option(device_name, 'cache_max_files'),
+            local_config.get_option(device_name, 'cache_dedup', False),
+            block_size, engine)
+        self.metadata = metadata.Metadata(
+            self.db, self.path_index, get_stat,
+            self.binary_cache.evict_metadata)
+        self.tree = tree.Tree(self.db, self.metadata, self.binary_cache)
+        self.staging = writeback.Staging(
+            self.db, self.binary_cache, os.path.join(device_path, 'staging'),
+            self.tree.apply)
+        self.storage_flusher = storage.StorageFlusher(
+            self.binary_cache.storage)
+        verify_rate = local_config.get_option(
+            device_name, 'cache_verify_rate', 2)
+        self.integrity_verifier = None
+        if verify_rate > 0:
+            self.integrity_verifier = integrity.IntegrityVerifier(
+                self.binary_cache, os.path.join(device_path, 'integrity.json'),
+                int(verify_rate * 1024 * 1024),
+                local_config.get_option(device_name, 'cache_verify_workers',
+                                        integrity.WORKERS))
+        self.use_mmap = local_config.get_option(device_name, 'mmap', False)
         logger.info('- Cache configured')
 
+        # Configure metrics
+        self.metrics = metrics.Metrics()
+        for operation in INSTRUMENTED_OPERATIONS:
+            setattr(self, operation, self.metrics.instrument(
+                operation, getattr(self, operation)))
+        self.metrics.register_cache('binary', self.binary_cache)
+        self.metrics.register_cache('downloads', engine)
+        if self.integrity_verifier is not None:
+            self.metrics.register_cache('integrity', self.integrity_verifier)
+        self.metrics.register_cache('metadata',
+                                    self.binary_cache.metadata_cache)
+        self.metrics.register_cache('attr', self.metadata.attr_cache)
+        self.metrics.register_cache('missing', self.metadata.missing_cache)
+        self.metrics.register_cache('readdir_file',
+                                    self.metadata.readdir_file_cache)
+        self.metrics.register_cache('readdir_folder',
+                                    self.metadata.readdir_folder_cache)
+        self.metrics_writer = metrics.MetricsWriter(
+            self.metrics, os.path.join(device_path, 'metrics.json'))
+        logger.info('- Metrics configured')
+
+        # Configure disk space
+        self.disk_space_monitor = diskspace.DiskSpaceMonitor(
+            self.db, self.urlCozy, self.loginCozy, self.passwordCozy,
+            local_config.get_option(device_name, 'disk_space_interval',
+                                    diskspace.REFRESH_INTERVAL))
+        logger.info('- Disk space configured')
+
+    def fsinit(self):
+        '''
+        Start background workers. It's done here rather than in the
+        constructor because FUSE forks the process when it daemonizes, and
+        threads don't survive a fork.
+        '''
+        self.changes_listener = changes.ChangesListener(
+            self.db, self.changes_seq)
+        self.changes_listener.register(self.metadata.on_change)
+        self.changes_listener.register(self.binary_cache.on_change)
+        self.changes_listener.start()
+        logger.info('- Changes listener started')
+        self.disk_space_monitor.start()
+        logger.info('- Disk space monitor started')
+        self.metrics_writer.start()
+        logger.info('- Metrics writer started')
+        self.storage_flusher.start()
+        logger.info('- Storage flusher started')
+        if self.integrity_verifier is not None:
+            self.integrity_verifier.start()
+            logger.info('- Integrity verifier started')
+
+    def fsdestroy(self):
+        '''
+        Stop background workers.
+        '''
+        if self.changes_listener is not None:
+            self.changes_listener.stop()
+        self.disk_space_monitor.stop()
+        self.metrics_writer.stop()
+        self.storage_flusher.stop()
+        if self.integrity_verifier is not None:
+            self.integrity_verifier.stop()
+
     def readdir(self, path, offset):
         """
         Generator: list files for given path and yield each file result when
         it arrives.
         """
         path = _normalize_path(path)
-        logger.info('readdir %s' % path)
+        self.op_logger.log('readdir', path)
 
         # this two folders are conventional in Unix system.
         for directory in '.', '..':
             yield fuse.Direntry(directory)
 
-        res = self.readdir_file_cache.get(path)
-        if res is None:
-            res = self.db.view('file/byFolder', key=path)
-            self.readdir_file_cache.add(path, res)
-        for doc in res:
-            yield fuse.Direntry(doc.value['name'].encode('utf-8'))
-
-        res = self.readdir_folder_cache.get(path)
-        if res is None:
-            res = self.db.view('folder/byFolder', key=path)
-            self.readdir_folder_cache.add(path, res)
-        for doc in res:
-            yield fuse.Direntry(doc.value['name'].encode('utf-8'))
+        for doc in self.metadata.list(path):
+            yield fuse.Direntry(doc['name'].encode('utf-8'))
 
     def getattr(self, path):
         """
         Return file descriptor for given_path. Useful for 'ls -la' command
         like.
         """
-        logger.info('getattr %s' % path)
+        path = _normalize_path(path)
+        self.op_logger.log('getattr', path)
 
         try:
-            st = self.attr_cache.get(path)
+            st = self.metadata.get_attr(path)
             if st is None:
-                st = CouchStat()
-
-                # Path is root
-                if path is "/":
-                    st.st_mode = stat.S_IFDIR | 0o775
-                    st.st_nlink = 2
-
-                else:
-                    # Or path is a folder
-                    folder = dbutils.get_folder(self.db, path)
-
-                    if folder is not None:
-                        st.st_mode = stat.S_IFDIR | 0o775
-                        st.st_nlink = 2
-                        if 'lastModification' in folder:
-                            st.st_atime = get_date(folder['lastModification'])
-                            st.st_ctime = st.st_atime
-                            st.st_mtime = st.st_atime
-
-                    else:
-                        # Or path is a file
-                        file_doc = dbutils.get_file(self.db, path)
-
-                        if file_doc is not None:
-                            st.st_mode = stat.S_IFREG | 0o664
-                            st.st_nlink = 1
-                            st.st_size = file_doc.get('size', 4096)
-                            if 'lastModification' in file_doc:
-                                st.st_atime = \
-                                    get_date(file_doc['lastModification'])
-                                st.st_ctime = st.st_atime
-                                st.st_mtime = st.st_atime
-
-                        else:
-                            logger.info('File does not exist: %s' % path)
-                self.attr_cache.add(path, st)
+                return -errno.ENOENT
+
+            # Size of a file being written is the size of its staging file.
+            handle = self.staging.handles.get(path)
+            size = handle.get_size() if handle is not None else None
+            if size is not None:
+                st = copy.copy(st)
+                st.st_size = size
             return st
 
         except Exception as e:
@@ -225,206 +327,138 @@ class CouchFSDocument(fuse.Fuse):
 
     def open(self, path, flags):
         """
-        Open file
+        Open file. Returned handle is given back by FUSE to read, write and
+        release. Files opened for writing are served by a staging file.
             path {string}: file path
             flags {string}: opening mode
         """
-        logger.info('open %s' % path)
+        self.op_logger.log('open', path)
         path = _normalize_path(path)
         try:
-            res = self.db.view('file/byFullPath', key=path)
-            if len(res) > 0:
-                #logger.info('%s found' % path)
-                return 0
-            else:
+            if self.metadata.get_file(path) is None:
                 logger.error('File not found %s' % path)
                 return -errno.ENOENT
+            elif flags & (os.O_WRONLY | os.O_RDWR):
+                return self.staging.open(path, bool(flags & os.O_TRUNC))
+            else:
+                return filehandle.FileHandle(
+                    path, self.binary_cache, self.use_mmap,
+                    self._prefetch_next_file)
 
         except Exception as e:
             logger.exception(e)
             return -errno.ENOENT
 
-    def read(self, path, size, offset):
+    def read(self, path, size, offset, fh=None):
         """
         Return content of file located at given path.
         Extract it from remote Cozy and save it in a cache folder.
             path {string}: file path
             size {integer}: size of file part to read
             offset {integer}=: beginning of file part to read
+            fh {FileHandle}: handle returned by open
         """
         try:
-            logger.info('read %s' % path)
+            self.op_logger.log('read', path)
             path = _normalize_path(path)
 
-            if not self.binary_cache.is_cached(path):
-                self.binary_cache.add(path)
-
-            with self.binary_cache.get(path) as binary_attachment:
+            if fh is not None:
+                return fh.read(size, offset)
 
-                content_length = self.file_size_cache.get(path)
-                if content_length is None:
-                    fileno = binary_attachment.fileno()
-                    content_length = os.fstat(fileno).st_size
-                    self.file_size_cache.add(path, content_length)
-
-                if offset < content_length:
-                    if offset + size > content_length:
-                        size = content_length - offset
-                    binary_attachment.seek(offset)
-                    buf = binary_attachment.read(size)
-                else:
-                    buf = ''
-
-            return buf
+            # No handle given, the file is opened for this read only.
+            fh = filehandle.FileHandle(path, self.binary_cache, self.use_mmap)
+            try:
+                return fh.read(size, offset)
+            finally:
+                fh.release()
 
         except Exception as e:
             logger.exception(e)
             return -errno.ENOENT
 
-    def write(self, path, buf, offset):
+    def write(self, path, buf, offset, fh=None):
         """
-        Write data in file located at given path.
+        Write data in the staging file of the file located at given path.
             path {string}: file path
             buf {buffer}: data to write
+            fh {WriteHandle}: handle returned by open
         """
-        logger.info('write %s' % path)
-        return errno.EACCES
-        #path = _normalize_path(path)
-        #logger.info('write %s' % path)
-        #if path not in self.writeBuffers:
-            #self.writeBuffers[path] = ''
-        #self.writeBuffers[path] = self.writeBuffers[path] + buf
-        #return len(buf)
+        self.op_logger.log('write', path)
+        if not isinstance(fh, writeback.WriteHandle):
+            return -errno.EBADF
+        try:
+            return fh.write(buf, offset)
+        except Exception as e:
+            logger.exception(e)
+            return -errno.EIO
 
-    def release(self, path, fuse_file_info):
+    def release(self, path, flags, fh=None):
         """
-        Save file to device and launch replication to remote Cozy.
+        Close handle. Content written through it is uploaded to the file
+        binary.
             path {string}: file path
-            fuse_file_info {struct}: information about open file
+            flags {integer}: opening mode
+            fh {FileHandle}: handle returned by open
 
             Release is called when there are no more references
             to an open file: all file descriptors are closed and
             all memory mappings are unmapped.
         """
-        logger.info('release %s' % path)
-
-        return 0
+        self.op_logger.log('release', path)
         try:
-            path = _normalize_path(path)
-            file_doc = dbutils.get_file(self.db, path)
-            binary_id = file_doc["binary"]["file"]["id"]
-
-            if path in self.writeBuffers:
-                data = self.writeBuffers[path]
-                self.db.put_attachment(self.db[binary_id],
-                                       data,
-                                       filename="file")
-                file_doc['size'] = len(data)
-                file_doc['lastModification'] = get_current_date()
-                self.writeBuffers.pop(path, None)
-
-                binary = self.db[binary_id]
-                file_doc['binary']['file']['rev'] = binary['_rev']
-                self.db.save(file_doc)
-
-            logger.info("release is done")
+            if fh is not None:
+                fh.release()
             return 0
-
         except Exception as e:
             logger.exception(e)
-            return -errno.ENOENT
+            return -errno.EIO
 
     def mknod(self, path, mode, dev):
         """
-        Create special/ordinary file. Since it's a new file, the file and
-        and the binary metadata are created in the device. Then file is saved
-        as an attachment to the device.
+        Create an empty file: its binary and file documents are created in
+        the device.
             path {string}: file path
             mode {string}: file permissions
             dev: if the file type is S_IFCHR or S_IFBLK, dev specifies the
                  major and minor numbers of the newly created device special
                  file
         """
-        logger.info('mknod %s' % path)
-        return errno.EACCES
-        #try:
-            #path = _normalize_path(path)
-            #logger.info('mknod %s' % path)
-            #(file_path, name) = _path_split(path)
-
-            #file_path = _normalize_path(file_path)
-            #new_binary = {"docType": "Binary"}
-            #binary_id = self.db.create(new_binary)
-            #self.db.put_attachment(self.db[binary_id], '', filename="file")
-            #(mime_type, encoding) = mimetypes.guess_type(path)
-
-            #rev = self.db[binary_id]["_rev"]
-            #now = get_current_date()
-            #newFile = {
-                #"name": name,
-                #"path": _normalize_path(file_path),
-                #"binary": {
-                    #"file": {
-                        #"id": binary_id,
-                        #"rev": rev
-                    #}
-                #},
-                #"docType": "File",
-                #"mime": mime_type,
-                #'creationDate': now,
-                #'lastModification': now,
-            #}
-            #self.db.create(newFile)
-            #logger.info("file created")
-            #self._update_parent_folder(newFile['path'])
-            #logger.info('mknod is done for %s' % path)
-            #return 0
-        #except Exception as e:
-            #logger.exception(e)
-            #return -errno.ENOENT
+        self.op_logger.log('mknod', path)
+        if not stat.S_ISREG(mode):
+            return -errno.EPERM
+        return self._change_tree(self.tree.create_file, path)
 
     def unlink(self, path):
         """
         Remove file from device.
         """
-
-        logger.info('unlink %s' % path)
-        return errno.EACCES
-        #try:
-            #path = _normalize_path(path)
-            #logger.info('unlink %s' % path)
-            #parts = path.rsplit(u'/', 1)
-            #if len(parts) == 1:
-                #dirname, filename = u'', parts[0]
-            #else:
-                #dirname, filename = parts
-
-            #file_doc = dbutils.get_file(self.db, path)
-            #if file_doc is not None:
-                #binary_id = file_doc["binary"]["file"]["id"]
-                #logger.info(self.db[file_doc["_id"]])
-
-                #try:
-                    #self.db.delete(self.db[binary_id])
-                #except ResourceNotFound:
-                    #pass
-                #self.db.delete(self.db[file_doc["_id"]])
-                #logger.info('file %s removed' % path)
-                #self._update_parent_folder(file_doc['path'])
-                #return 0
-            #else:
-                #logger.warn('Cannot delete file, no entry found')
-                #return -errno.ENOENT
-
-        #except Exception as e:
-            #logger.exception(e)
-            #return -errno.ENOENT
+        self.op_logger.log('unlink', path)
+        return self._change_tree(self.tree.remove_file, path)
 
     def truncate(self, path, size):
-        """ TODO: look if something should be done there.
+        """
         Change size of a file.
         """
-        return 0
+        self.op_logger.log('truncate', path)
+        try:
+            self.staging.truncate(_normalize_path(path), size)
+            return 0
+        except Exception as e:
+            logger.exception(e)
+            return -errno.EIO
+
+    def ftruncate(self, path, size, fh=None):
+        """
+        Change size of an opened file.
+        """
+        if not isinstance(fh, writeback.WriteHandle):
+            return self.truncate(path, size)
+        try:
+            fh.truncate(size)
+            return 0
+        except Exception as e:
+            logger.exception(e)
+            return -errno.EIO
 
     def utime(self, path, times):
         """ TODO: look if something should be done there.
@@ -438,116 +472,38 @@ class CouchFSDocument(fuse.Fuse):
             path {string}: diretory path
             mode {string}: directory permissions
         """
-        logger.info('mkdir %s' % path)
-        return errno.EACCES
-        #try:
-            #(folder_path, name) = _path_split(path)
-            #folder_path = _normalize_path(folder_path)
-            #path = _normalize_path(path)
-            #now = get_current_date()
-
-            #logger.info('create new dir %s' % path)
-            #folder = dbutils.get_folder(self.db, path)
-            #if folder is not None:
-                #logger.info('folder already exists %s' % path)
-                #return -errno.EEXIST
-            #else:
-                #self.db.create({
-                    #"name": name,
-                    #"path": folder_path,
-                    #"docType": "Folder",
-                    #'creationDate': now,
-                    #'lastModification': now,
-                #})
-
-                #self._update_parent_folder(folder_path)
-                #return 0
-
-        #except Exception as e:
-            #logger.exception(e)
-            #return -errno.EEXIST
+        self.op_logger.log('mkdir', path)
+        return self._change_tree(self.tree.create_folder, path)
 
     def rmdir(self, path):
         """
         Delete folder from device.
             path {string}: diretory path
         """
-        logger.info('rmdir %s' % path)
-        return errno.EACCES
-        #try:
-            #path = _normalize_path(path)
-            #folder = dbutils.get_folder(self.db, path)
-            #self.db.delete(self.db[folder['_id']])
-            #return 0
-
-        #except Exception as e:
-            #logger.exception(e)
-            #return -errno.ENOENT
-
-    def rename(self, pathfrom, pathto, root=True):
-        """
-        Rename file and subfiles (if it's a folder) in device.
-        """
-        logger.info('rename %s' % pathfrom)
-        return errno.EACCES
-        #logger.info("path rename %s -> %s: " % (pathfrom, pathto))
-        #pathfrom = _normalize_path(pathfrom)
-        #pathto = _normalize_path(pathto)
-
-        #for doc in self.db.view("file/byFullPath", key=pathfrom):
-            #doc = doc.value
-            #(file_path, name) = _path_split(pathto)
-            #doc.update({
-                #"name": name,
-                #"path": file_path,
-                #"lastModification": get_current_date(
-                #)})
-            #self.db.save(doc)
-            #if root:
-                #self._update_parent_folder(file_path)
-                ## Change lastModification for file_path_from in case of file
-                ## was moved
-                #(file_path_from, name) = _path_split(pathfrom)
-                #self._update_parent_folder(file_path_from)
-            #return 0
-
-        #for doc in self.db.view("folder/byFullPath", key=pathfrom):
-            #doc = doc.value
-            #(file_path, name) = _path_split(pathto)
-            #doc.update({
-                #"name": name,
-                #"path": file_path,
-                #"lastModification": get_current_date()
-            #})
-
-            ## Rename all subfiles
-            #for res in self.db.view("file/byFolder", key=pathfrom):
-                #child_pathfrom = os.path.join(
-                    #res.value['path'],
-                    #res.value['name'])
-                #child_pathto = os.path.join(file_path, name, res.value['name'])
-                #self.rename(child_pathfrom, child_pathto, False)
-
-            #for res in self.db.view("folder/byFolder", key=pathfrom):
-                #child_pathfrom = os.path.join(
-                    #res.value['path'],
-                    #res.value['name'])
-                #child_pathto = os.path.join(file_path, name, res.value['name'])
-                #self.rename(child_pathfrom, child_pathto, False)
-
-            #if root:
-                #self._update_parent_folder(file_path)
-                ## Change lastModification for file_path_from in case of file
-                ## was moved
-                #(file_path_from, name) = _path_split(pathfrom)
-                #self._update_parent_folder(file_path_from)
-
-            #self.db.save(doc)
-            #return 0
-
-    def fsync(self, path, isfsyncfile):
-        """ TODO: look if something should be done there. """
-        return 0
+        self.op_logger.log('rmdir', path)
+        return self._change_tree(self.tree.remove_folder, path)
+
+    def rename(self, pathfrom, pathto):
+        """
+        Move file or folder, with its subfolders and files, in device.
+        """
+        self.op_logger.log('rename', pathfrom)
+        if _normalize_path(pathfrom) in self.staging.handles:
+            return -errno.EBUSY
+        return self._change_tree(self.tree.rename, pathfrom, pathto)
+
+    def fsync(self, path, isfsyncfile, fh=None):
+        """
+        Upload content written through given handle.
+        """
+        if not isinstance(fh, writeback.WriteHandle):
+            return 0
+        try:
+            fh.flush()
+            return 0
+        except Exception as e:
+            logger.exception(e)
+            return -errno.EIO
 
     def chmod(self, path, mode):
         """ TODO: look if something should be done there. """
@@ -570,11 +526,7 @@ class CouchFSDocument(fuse.Fuse):
         Feel free to set any of the above values to 0, which tells
         the kernel that the info is not available.
         """
-        disk_space = dbutils.get_disk_space(
-            self.device,
-            self.urlCozy,
-            self.loginCozy,
-            self.passwordCozy)
+        disk_space = self.disk_space_monitor.disk_space
         st = fuse.StatVfs()
 
         blocks = float(disk_space['totalDiskSpace']) * 1000 * 1000
@@ -595,6 +547,58 @@ class CouchFSDocument(fuse.Fuse):
 
         return st
 
+    def _load_path_index(self):
+        '''
+        Load path index from folder and file views. The sequence number is
+        read first so changes occuring while loading are not missed. If
+        loading fails, paths are resolved through views.
+        '''
+        self.changes_seq = 'now'
+        try:
+            self.changes_seq = self.db.info()['update_seq']
+            docs = [row.value for row in dbutils.get_folders(self.db)]
+            docs.extend([row.value for row in dbutils.get_files(self.db)])
+            self.path_index.load(docs)
+            logger.info('- Path index loaded (%s entries)' % len(docs))
+        except Exception as e:
+            logger.exception(e)
+            logger.error('- Path index not loaded, views will be used')
+
+    def _change_tree(self, change, *paths):
+        """
+        Apply given tree change to given paths. Errors are returned as error
+        numbers.
+        """
+        try:
+            change(*[_normalize_path(path) for path in paths])
+            return 0
+        except OSError as e:
+            return -e.errno
+        except Exception as e:
+            logger.exception(e)
+            return -errno.EIO
+
+    def _prefetch_next_file(self, path):
+        '''
+        Start downloading the file that follows given one in its folder.
+        Called when a handle reads a file sequentially up to its end, as
+        copies and media players do before opening the next file.
+        '''
+        if not self.path_index.loaded:
+            return
+
+        try:
+            folder_path = path.rsplit('/', 1)[0]
+            paths = sorted([pathindex.get_full_path(doc)
+                            for doc in self.path_index.list(folder_path)
+                            if not pathindex.is_folder(doc)])
+            index = bisect.bisect_right(paths, path)
+            if index < len(paths):
+                logger.info('prefetch %s' % paths[index])
+                self.binary_cache.start_download(paths[index])
+        except Exception as e:
+            logger.exception(e)
+
     def _replicate_from_local(self, ids):
         '''
         Replicate file modifications to remote Cozy.
@@ -605,20 +609,6 @@ class CouchFSDocument(fuse.Fuse):
             doc_ids=ids
         )
 
-    def _update_parent_folder(self, parent_folder):
-        """
-        Update parent folder
-            parent_folder {string}: parent folder path
-
-        When a file or a folder is renamed/created/removed, last modification
-        date of parent folder should be updated
-
-        """
-        folder = dbutils.get_folder(self.db, parent_folder)
-        if folder is not None:
-            folder['lastModification'] = get_current_date()
-            self.db.save(folder)
-
 
 def _normalize_path(path):
     '''
@@ -634,17 +624,6 @@ def _normalize_path(path):
         return '/' + path
 
 
-def _path_split(path):
-    '''
-    Split folder path and file name.
-    '''
-    _normalize_path(path)
-    (folder_path, name) = os.path.split(path)
-    if folder_path[-1:] == '/':
-        folder_path = folder_path[:-(len(name) + 1)]
-    return (folder_path, name)
-
-
 def unmount(path):
     '''
     Unmount folder given Fuse folder.
@@ -664,7 +643,13 @@ def mount(name, path):
     Mount given folder corresponding to given device.
     '''
     logger.info('Attempt to mount %s' % path)
+    dbutils.migrate_database_views(name)
     fs = CouchFSDocument(name, path, 'http://localhost:5984/%s' % name)
-    fs.multithreaded = 0
+    if local_config.get_option(name, 'multithreaded', True):
+        fs.multithreaded = 1
+    else:
+        fs.multithreaded = 0
     logger.info('CouchDB Fuse configured for %s' % path)
+    # FUSE forks to go to background, queued logs would be lost.
+    local_config.HDLR.flush()
     fs.main()
@@ -1,8 +1,10 @@
 import json
 import string
+import datetime
 import random
 import requests
 import logging
+import threading
 
 import local_config
 
@@ -10,17 +12,144 @@ import local_config
 from couchdb import Server, http
 from couchdb.http import PreconditionFailed, ResourceConflict
 
+# Maximum number of documents saved by a single _bulk_docs request.
+BULK_BATCH_SIZE = 500
+
+# Number of times documents in conflict are read and saved again.
+CONFLICT_RETRIES = 3
+
+# URL of the local CouchDB.
+COUCHDB_URL = 'http://localhost:5984/'
+
+# Number of keep-alive connections kept by each client per host.
+POOL_SIZE = 10
+
+# Time (s) to wait for a server to answer an HTTP request.
+HTTP_TIMEOUT = 60
+
+# Time (s) to wait for the local CouchDB to answer. One shot replications
+# answer once they are done, so it's much longer.
+COUCHDB_TIMEOUT = 3600
+
+# Delays (s) before retrying a CouchDB request failing with a network error.
+COUCHDB_RETRY_DELAYS = [0, 0.5, 2]
+
+# Number of retries of idempotent HTTP requests failing to connect.
+HTTP_RETRIES = 3
+
 logger = logging.getLogger(__name__)
 local_config.configure_logger(logger)
 
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class Client:
+    '''
+    Connections of a device: a CouchDB server handle and an HTTP session,
+    both keeping a pool of keep-alive connections, with the device database
+    credentials, timeouts and a retry policy. Database handles are kept too,
+    so they are not checked again on each use.
+    '''
+
+    def __init__(self, name=None):
+        '''
+        Set up connections of device of given name. Without name, requests
+        are sent without credentials (admin party).
+        '''
+        self.name = name
+        session = http.Session(timeout=COUCHDB_TIMEOUT,
+                               retry_delays=COUCHDB_RETRY_DELAYS)
+        self.server = Server(COUCHDB_URL, session=session)
+        if name is not None:
+            self.server.resource.credentials = \
+                local_config.get_db_credentials(name)
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE,
+            max_retries=requests.packages.urllib3.util.Retry(
+                total=HTTP_RETRIES, read=False, backoff_factor=0.5))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._dbs = {}
+        self._lock = threading.Lock()
+
+    def get_db(self, database):
+        '''
+        Return handle of given database, it is checked only the first time.
+        '''
+        with self._lock:
+            db = self._dbs.get(database)
+        if db is None:
+            db = self.server[database]
+            with self._lock:
+                self._dbs[database] = db
+        return db
+
+    def forget_db(self, database):
+        '''
+        Drop handle of given database, after it was deleted for instance.
+        '''
+        with self._lock:
+            self._dbs.pop(database, None)
+
+    def request(self, method, url, **kwargs):
+        '''
+        Send an HTTP request through the session, with the default timeout
+        if none is given.
+        '''
+        kwargs.setdefault('timeout', HTTP_TIMEOUT)
+        return self.session.request(method, url, **kwargs)
+
+    def close(self):
+        '''
+        Close pooled HTTP connections. CouchDB connections are closed when
+        the server handle is collected.
+        '''
+        self.session.close()
+
+
+def get_client(name=None):
+    '''
+    Return the client of device of given name, created on first call. The
+    client without name sends requests without credentials.
+    '''
+    with _clients_lock:
+        client = _clients.get(name)
+        if client is None:
+            client = Client(name)
+            _clients[name] = client
+        return client
+
+
+def remove_client(name):
+    '''
+    Close and forget the client of device of given name, so it is created
+    again with up to date credentials.
+    '''
+    with _clients_lock:
+        client = _clients.pop(name, None)
+    if client is not None:
+        client.close()
+
+
+def get_current_date():
+    """
+    Get current date : Return current date with format 'Y-m-d T H:M:S'
+        Exemple : 2014-05-07T09:17:48
+    """
+    return datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+
 
 def create_db(database):
-    server = Server('http://localhost:5984/')
+    client = get_client()
     try:
-        db = server.create(database)
+        db = client.server.create(database)
         logger.info('[DB] Database %s created' % database)
     except PreconditionFailed:
-        db = server[database]
+        db = client.get_db(database)
         logger.info('[DB] Database %s already exists.' % database)
 
     return db
@@ -31,11 +160,10 @@ def get_db(database, credentials=True):
     Get or create given database from/in CouchDB.
     '''
     try:
-        server = Server('http://localhost:5984/')
         if credentials:
-            server.resource.credentials = \
-                local_config.get_db_credentials(database)
-        return server[database]
+            return get_client(database).get_db(database)
+        else:
+            return get_client().get_db(database)
     except Exception:
         logging.exception('[DB] Cannot connect to the database')
 
@@ -47,10 +175,8 @@ def get_db_and_server(database):
     Get or create given database from/in CouchDB.
     '''
     try:
-        server = Server('http://localhost:5984/')
-        server.resource.credentials = local_config.get_db_credentials(database)
-        db = server[database]
-        return (db, server)
+        client = get_client(database)
+        return (client.get_db(database), client.server)
     except Exception:
         logging.exception('[DB] Cannot connect to the database %s' % database)
         return (None, None)
@@ -72,9 +198,10 @@ def remove_db(database):
     '''
     Destroy given database.
     '''
-    server = Server('http://localhost:5984/')
+    get_client().forget_db(database)
+    remove_client(database)
     try:
-        server.delete(database)
+        get_client().server.delete(database)
     except http.ResourceNotFound:
         logger.info('[DB] Local database %s already removed' % database)
     logger.info('[DB] Local database %s removed' % database)
@@ -120,6 +247,78 @@ def get_file(db, path):
     return file_doc
 
 
+def get_entry(db, path):
+    '''
+    Return folder or file document located at given path with a single
+    view query.
+    '''
+    if len(path) > 0 and path[0] != '/':
+        path = '/' + path
+    try:
+        doc = list(db.view("entry/byFullPath", key=path))[0].value
+    except IndexError:
+        doc = None
+    return doc
+
+
+def get_subtree(db, path):
+    '''
+    Return folder and file documents located under given folder path, with
+    a single range query on full paths.
+    '''
+    if isinstance(path, str):
+        path = path.decode('utf-8')
+    return [row.value for row in db.view("entry/byFullPath",
+                                         startkey=path + u'/',
+                                         endkey=path + u'/\ufff0')]
+
+
+def bulk_update(db, docs, change=None, batch_size=None):
+    '''
+    Save given documents with _bulk_docs requests of at most *batch_size*
+    documents. When given, *change* is applied to each document before it
+    is saved. Documents in conflict are read again, changed and saved again
+    up to CONFLICT_RETRIES times. Return saved documents and IDs of
+    documents that could not be saved.
+    '''
+    if batch_size is None:
+        batch_size = BULK_BATCH_SIZE
+    if change is not None:
+        for doc in docs:
+            change(doc)
+
+    saved = []
+    failed = []
+    for attempt in range(CONFLICT_RETRIES + 1):
+        conflicts = []
+        for start in range(0, len(docs), batch_size):
+            batch = docs[start:start + batch_size]
+            for (doc, (success, doc_id, result)) in \
+                    zip(batch, db.update(batch)):
+                if success:
+                    saved.append(doc)
+                elif isinstance(result, ResourceConflict) \
+                        and change is not None:
+                    conflicts.append(doc_id)
+                else:
+                    logger.error('[DB] Cannot save %s: %s' % (doc_id, result))
+                    failed.append(doc_id)
+
+        if len(conflicts) == 0:
+            break
+        elif attempt == CONFLICT_RETRIES:
+            logger.error('[DB] Conflicts not solved for %s' % conflicts)
+            failed.extend(conflicts)
+            break
+
+        # Apply change again to latest revisions.
+        rows = db.view('_all_docs', keys=conflicts, include_docs=True)
+        docs = [row.doc for row in rows if row.doc is not None]
+        for doc in docs:
+            change(doc)
+    return (saved, failed)
+
+
 def get_random_key():
     '''
     Generate a random key of 20 chars. The first character is not a number
@@ -143,10 +342,11 @@ def create_db_user(database, login, password, protocol="http"):
         "roles": [],
         "password": password
     }
-    requests.post('%s://localhost:5984/_users' % (protocol),
-                  data=json.dumps(data),
-                  headers=headers,
-                  verify=False)
+    client = get_client()
+    client.request('POST', '%s://localhost:5984/_users' % (protocol),
+                   data=json.dumps(data),
+                   headers=headers,
+                   verify=False)
 
     headers = {'content-type': 'application/json'}
     data = {
@@ -159,10 +359,11 @@ def create_db_user(database, login, password, protocol="http"):
             "roles": []
         },
     }
-    requests.put('%s://localhost:5984/%s/_security' % (protocol, database),
-                 data=json.dumps(data),
-                 headers=headers,
-                 verify=False)
+    client.request('PUT',
+                   '%s://localhost:5984/%s/_security' % (protocol, database),
+                   data=json.dumps(data),
+                   headers=headers,
+                   verify=False)
     logger.info('[DB] Db user created')
 
 
@@ -170,12 +371,13 @@ def remove_db_user(database):
     '''
     Delete user created for this database.
     '''
-    response = requests.get(
-        'http://localhost:5984/_users/org.couchdb.user:%s' % database)
+    client = get_client()
+    response = client.request(
+        'GET', 'http://localhost:5984/_users/org.couchdb.user:%s' % database)
     rev = response.json().get("_rev", "")
 
-    response = requests.delete(
-        'http://localhost:5984/_users/org.couchdb.user:%s?rev=%s' %
+    response = client.request(
+        'DELETE', 'http://localhost:5984/_users/org.couchdb.user:%s?rev=%s' %
         (database, rev)
     )
     logger.info('[DB] Db user %s deleted' % database)
@@ -217,6 +419,25 @@ def init_database_view(docType, db):
     }
 
 
+def init_entry_view(db):
+    '''
+    Add view indexing folders and files together by full path, so a path
+    can be resolved without knowing its type.
+    '''
+    db["_design/entry"] = {
+        "views": {
+            "byFullPath": {
+                "map": """function (doc) {
+                  if (doc.docType === \"Folder\" ||
+                      doc.docType === \"File\") {
+                      emit(doc.path + '/' + doc.name, doc);
+                    }
+                  }"""
+            }
+        }
+    }
+
+
 def init_database_views(database):
     '''
     Initialize database:
@@ -237,6 +458,12 @@ def init_database_views(database):
     except ResourceConflict:
         logger.warn('[DB] File design document already exists')
 
+    try:
+        init_entry_view(db)
+        logger.info('[DB] Entry design document created')
+    except ResourceConflict:
+        logger.warn('[DB] Entry design document already exists')
+
     try:
         db["_design/device"] = {
             "views": {
@@ -277,6 +504,23 @@ def init_database_views(database):
         logger.warn('[DB] Binary design document already exists')
 
 
+def migrate_database_views(database):
+    '''
+    Add views introduced by newer versions to an existing device database.
+    '''
+    db = get_db(database)
+    if db is None:
+        logger.error('[DB] Views of %s cannot be migrated' % database)
+        return
+
+    if "_design/entry" not in db:
+        try:
+            init_entry_view(db)
+            logger.info('[DB] Entry design document added to %s' % database)
+        except ResourceConflict:
+            pass
+
+
 def init_device(database, url, path, device_pwd, device_id):
     '''
     Create device objects wiht filter to apply to synchronize them.
@@ -332,34 +576,46 @@ def init_device(database, url, path, device_pwd, device_id):
     return False
 
 
-def get_disk_space(database, url, device, device_password):
-    # Recover disk space
-    db = get_db(database)
+DEFAULT_DISK_SPACE = {
+    "freeDiskSpace": 1,
+    "usedDiskSpace": 0,
+    "totalDiskSpace": 1
+}
+
+
+def fetch_disk_space(url, device, device_password, timeout=10):
+    '''
+    Request disk space to the remote Cozy.
+    '''
     url = url.split('/')
-    try:
-        remote = "https://%s:%s@%s" % (device, device_password, url[2])
-        response = requests.get('%s/disk-space'%remote)
-        disk_space = json.loads(response.content)
-        # Store disk space
-        res = db.view('device/all')
-        for device in res:
-            device = device.value
-            device['diskSpace'] = disk_space['diskSpace']
+    remote = "https://%s:%s@%s" % (device, device_password, url[2])
+    response = get_client().request('GET', '%s/disk-space' % remote,
+                                    timeout=timeout)
+    return json.loads(response.content)['diskSpace']
+
+
+def get_stored_disk_space(db):
+    '''
+    Return disk space stored in the device document, arbitrary information
+    if there is none.
+    '''
+    for device in db.view('device/all'):
+        device = device.value
+        if 'diskSpace' in device:
+            return device['diskSpace']
+    return DEFAULT_DISK_SPACE
+
+
+def store_disk_space(db, disk_space):
+    '''
+    Save disk space in the device document. Nothing is written when the
+    stored value is the same. Return True if the document was saved.
+    '''
+    for device in db.view('device/all'):
+        device = device.value
+        if device.get('diskSpace') != disk_space:
+            device['diskSpace'] = disk_space
             db.save(device)
-            # Return disk space
-            return disk_space['diskSpace']
-    except:
-        # Recover information in database
-        res = db.view('device/all')
-        for device in res:
-            device = device.value
-            if 'diskSpace' in device:
-                return device['diskSpace']
-            else:
-                # Return arbitrary information
-                disk_space = {
-                    "freeDiskSpace": 1,
-                    "usedDiskSpace": 0,
-                    "totalDiskSpace": 1
-                }
-                return disk_space
+            return True
+        return False
+    return False
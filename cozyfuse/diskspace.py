@@ -0,0 +1,68 @@
+import logging
+import threading
+
+import dbutils
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+# Default time (s) between two disk space requests to the remote Cozy.
+REFRESH_INTERVAL = 300
+
+
+class DiskSpaceMonitor(threading.Thread):
+    '''
+    Background thread that refreshes disk space of the remote Cozy at a
+    regular interval. The last known value is available in memory, so
+    statfs doesn't wait for the remote Cozy. It starts with the value stored
+    in the device document and keeps it while the Cozy is unreachable.
+    '''
+
+    def __init__(self, db, url, device, device_password,
+                 interval=REFRESH_INTERVAL):
+        '''
+        Register remote Cozy information and load stored disk space.
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.db = db
+        self.url = url
+        self.device = device
+        self.device_password = device_password
+        self.interval = interval
+        self.disk_space = dbutils.get_stored_disk_space(db)
+        self._stopped = threading.Event()
+
+    def stop(self):
+        '''
+        Ask the thread to stop.
+        '''
+        self._stopped.set()
+
+    def run(self):
+        '''
+        Refresh disk space until the monitor is stopped.
+        '''
+        while not self._stopped.is_set():
+            self.refresh()
+            self._stopped.wait(self.interval)
+
+    def refresh(self):
+        '''
+        Request disk space to the remote Cozy. The device document is saved
+        only when the value changed.
+        '''
+        try:
+            disk_space = dbutils.fetch_disk_space(
+                self.url, self.device, self.device_password)
+        except Exception:
+            logger.warn('[Disk space] Cozy unreachable, last value is kept')
+            return
+
+        if disk_space != self.disk_space:
+            self.disk_space = disk_space
+            try:
+                dbutils.store_disk_space(self.db, disk_space)
+            except Exception:
+                logger.exception('[Disk space] Cannot store disk space')
@@ -0,0 +1,137 @@
+import os
+import time
+import logging
+import requests
+import threading
+import exceptions
+
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+# Size (bytes) of the buffers response bodies are read into.
+BUFFER_SIZE = 1024 * 1024
+
+# Number of keep-alive connections kept to the local CouchDB.
+POOL_SIZE = 10
+
+# Time (s) to wait for the local CouchDB to send data.
+TIMEOUT = 60
+
+# When downloaded data are synced to disk: never (the system decides),
+# once at the end of each download, or after each buffer.
+FSYNC_NEVER = 'never'
+FSYNC_END = 'end'
+FSYNC_ALWAYS = 'always'
+FSYNC_POLICIES = [FSYNC_NEVER, FSYNC_END, FSYNC_ALWAYS]
+
+
+class DownloadEngine:
+    '''
+    Fetch binaries from the local CouchDB through a pooled keep-alive
+    session. Response bodies are read into large reusable buffers, so
+    downloading costs one loop iteration and one write per buffer. Bytes
+    and time spent downloading are counted to give the throughput.
+    '''
+
+    def __init__(self, buffer_size=BUFFER_SIZE, fsync=FSYNC_NEVER,
+                 pool_size=POOL_SIZE, timeout=TIMEOUT):
+        '''
+        Create the session and register the buffer size and the fsync
+        policy.
+        '''
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy: %s' % fsync)
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.downloads = 0
+        self.errors = 0
+        self.bytes = 0
+        self.time = 0.0
+        self._buffers = []
+        self._lock = threading.Lock()
+
+    def fetch(self, url, fd, on_data=None):
+        '''
+        Write binary located at given URL to given file object. Once data
+        are written and flushed, *on_data* is called with their size. Return
+        the number of bytes written.
+        '''
+        buf = self._get_buffer()
+        view = memoryview(buf)
+        start = time.time()
+        written = 0
+        error = True
+        try:
+            req = self.session.get(url, stream=True, timeout=self.timeout)
+            try:
+                if req.status_code != 200:
+                    raise exceptions.IOError(
+                        "File not stored in the local CouchDB database %s"
+                        % url)
+
+                req.raw.decode_content = True
+                while True:
+                    size = req.raw.readinto(buf)
+                    if size == 0:
+                        break
+                    fd.write(view[:size])
+                    fd.flush()
+                    if self.fsync == FSYNC_ALWAYS:
+                        os.fsync(fd.fileno())
+                    written += size
+                    if on_data is not None:
+                        on_data(size)
+                if self.fsync == FSYNC_END:
+                    os.fsync(fd.fileno())
+                error = False
+            finally:
+                req.close()
+        finally:
+            self._release_buffer(buf)
+            with self._lock:
+                self.downloads += 1
+                if error:
+                    self.errors += 1
+                self.bytes += written
+                self.time += time.time() - start
+        return written
+
+    def stats(self):
+        '''
+        Return downloads, errors, bytes downloaded and throughput (MB/s).
+        '''
+        with self._lock:
+            throughput = 0.0
+            if self.time > 0:
+                throughput = self.bytes / self.time / (1024 * 1024)
+            return {
+                'downloads': self.downloads,
+                'errors': self.errors,
+                'bytes': self.bytes,
+                'throughput': throughput,
+            }
+
+    def _get_buffer(self):
+        '''
+        Return a free buffer, a new one if they are all used.
+        '''
+        with self._lock:
+            if len(self._buffers) > 0:
+                return self._buffers.pop()
+        return bytearray(self.buffer_size)
+
+    def _release_buffer(self, buf):
+        '''
+        Give back a buffer to reuse it for next downloads.
+        '''
+        with self._lock:
+            self._buffers.append(buf)
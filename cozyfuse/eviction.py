@@ -0,0 +1,149 @@
+import os
+import threading
+import collections
+
+
+class CacheAccounting:
+    '''
+    In-memory accounting of the binaries stored in the cache: their size,
+    the ID of their file document and the order of their last access. It
+    tells which binaries to evict, least recently used first, to stay within
+    the cache quota. When no quota is set, nothing is evicted.
+    '''
+
+    def __init__(self, max_size=None, max_files=None):
+        '''
+        Register quota: maximum size (bytes) and number of cached binaries.
+        '''
+        self.max_size = max_size
+        self.max_files = max_files
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, binary_id, size, file_id):
+        '''
+        Count given binary as cached and used right now.
+        '''
+        with self._lock:
+            self._remove(binary_id)
+            self._entries[binary_id] = (size, file_id)
+            self.size += size
+
+    def touch(self, binary_id):
+        '''
+        Mark given binary as used right now.
+        '''
+        with self._lock:
+            entry = self._entries.pop(binary_id, None)
+            if entry is not None:
+                self._entries[binary_id] = entry
+
+    def remove(self, binary_id):
+        '''
+        Stop counting given binary.
+        '''
+        with self._lock:
+            self._remove(binary_id)
+
+    def get_victims(self, pinned=()):
+        '''
+        Return (binary ID, file ID) of binaries to evict to get within the
+        quota, least recently used first. Pinned binaries and the last used
+        one are kept.
+        '''
+        victims = []
+        with self._lock:
+            size = self.size
+            count = len(self._entries)
+            if not self._exceeded(size, count):
+                return victims
+            candidates = list(self._entries.items())[:-1]
+            for (binary_id, (entry_size, file_id)) in candidates:
+                if not self._exceeded(size, count):
+                    break
+                if binary_id not in pinned:
+                    victims.append((binary_id, file_id))
+                    size -= entry_size
+                    count -= 1
+        return victims
+
+    def _exceeded(self, size, count):
+        '''
+        Return True if given size or number of binaries exceed the quota.
+        '''
+        return (self.max_size is not None and size > self.max_size) or \
+               (self.max_files is not None and count > self.max_files)
+
+    def _remove(self, binary_id):
+        '''
+        Stop counting given binary, lock must be held.
+        '''
+        entry = self._entries.pop(binary_id, None)
+        if entry is not None:
+            self.size -= entry[0]
+
+
+class Pins:
+    '''
+    IDs of binaries that must stay in the cache. They are stored in a file,
+    one per line, so pins set from the command line are seen by the mount.
+    '''
+
+    def __init__(self, filename):
+        '''
+        Register the file storing pins.
+        '''
+        self.filename = filename
+        self._pins = set()
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        '''
+        Return pinned binary IDs. The file is read again only when it
+        changed.
+        '''
+        with self._lock:
+            try:
+                mtime = os.path.getmtime(self.filename)
+            except OSError:
+                return set()
+            if mtime != self._mtime:
+                with open(self.filename) as fd:
+                    self._pins = set(line.strip() for line in fd
+                                     if line.strip() != '')
+                self._mtime = mtime
+            return self._pins
+
+    def add(self, binary_id):
+        '''
+        Pin given binary.
+        '''
+        pins = set(self.get())
+        if binary_id not in pins:
+            pins.add(binary_id)
+            self._write(pins)
+
+    def remove(self, binary_id):
+        '''
+        Unpin given binary.
+        '''
+        pins = set(self.get())
+        if binary_id in pins:
+            pins.discard(binary_id)
+            self._write(pins)
+
+    def _write(self, pins):
+        '''
+        Write pins to a temporary file then rename it, so readers never see
+        a partial file.
+        '''
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as fd:
+            for binary_id in sorted(pins):
+                fd.write('%s\n' % binary_id)
+        os.rename(temp_filename, self.filename)
@@ -0,0 +1,195 @@
+import os
+import mmap
+import threading
+
+import readahead
+
+# Reads starting further than this from the downloaded data are served with
+# a range request instead of waiting for the download.
+STREAM_WINDOW = 1024 * 1024
+
+
+class FileHandle:
+    '''
+    File opened through the mount. The cached binary is opened at the first
+    read and stays open until the handle is released, so reads don't reopen
+    the cache file each time. In mmap mode, the cached binary is mapped in
+    memory and reads are served by slicing the mapping.
+
+    When the file is not cached yet, its download runs in background and
+    reads are served as soon as the requested bytes are written. In block
+    mode, only the blocks read are fetched and cached instead.
+
+    Sequential reads are detected: range requests fetch data ahead of them
+    and, when the end of the file is near, *on_sequential_end* is called
+    with the file path so the next file can be prefetched.
+    '''
+
+    def __init__(self, path, binary_cache, use_mmap=False,
+                 on_sequential_end=None):
+        '''
+        Register the path of the opened file and the binary cache to read it
+        from.
+        '''
+        self.path = path
+        self.binary_cache = binary_cache
+        self.use_mmap = use_mmap
+        self.on_sequential_end = on_sequential_end
+        self.read_ahead = readahead.ReadAhead()
+        self._file = None
+        self._map = None
+        self._size = None
+        self._download = None
+        self._blocks = None
+        self._ahead = None
+        self._end_notified = False
+        self._lock = threading.Lock()
+
+    def read(self, size, offset):
+        '''
+        Return *size* bytes of the file starting at *offset*. File is
+        downloaded to the cache first if needed.
+        '''
+        with self._lock:
+            self.read_ahead.update(offset, size)
+            if self._file is None and self._blocks is None:
+                self._open()
+
+            if self._blocks is not None:
+                buf = self.binary_cache.read_blocks(
+                    self.path, self._blocks, size, offset)
+                if buf is not None:
+                    self._notify_sequential_end(offset + size)
+                    return buf
+                # Ranges can't be read, the file is downloaded entirely.
+                self._blocks = None
+                self._open_download()
+
+            if self._download is not None:
+                buf = self._read_downloading(size, offset)
+                if buf is not None:
+                    return buf
+
+            self._notify_sequential_end(offset + size)
+            if offset >= self._size:
+                return ''
+            if offset + size > self._size:
+                size = self._size - offset
+
+            if self._map is not None:
+                return self._map[offset:offset + size]
+            else:
+                self._file.seek(offset)
+                return self._file.read(size)
+
+    def release(self):
+        '''
+        Close the cached binary.
+        '''
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._download = None
+            self._blocks = None
+            self._ahead = None
+
+    def _open(self):
+        '''
+        Open cached binary. If it's not cached yet, read it block by block in
+        block mode, or start its download.
+        '''
+        cached = self.binary_cache.is_cached(self.path)
+        if not cached:
+            self._blocks = self.binary_cache.get_blocks(self.path)
+            if self._blocks is not None:
+                self._size = self._blocks.size
+                return
+        self._open_download(cached)
+
+    def _open_download(self, cached=False):
+        '''
+        Open cached binary, starting its download if it's not cached yet.
+        '''
+        if not cached:
+            self._download = self.binary_cache.start_download(self.path)
+
+        if self._download is not None:
+            self._file = self._download.open()
+        else:
+            self._file = self.binary_cache.get(self.path)
+            self._map_file()
+
+    def _map_file(self):
+        '''
+        Read size of the complete cached binary and map it in mmap mode.
+        '''
+        self._size = os.fstat(self._file.fileno()).st_size
+
+        # Empty files can't be mapped.
+        if self.use_mmap and self._size > 0:
+            self._map = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _read_downloading(self, size, offset):
+        '''
+        Read data of a file being downloaded. Reads far from the downloaded
+        data are requested to the database directly. Return None once the
+        download is finished, the cached file is then read normally.
+        '''
+        download = self._download
+        window = max(STREAM_WINDOW, self.read_ahead.window)
+        if not download.done and offset > download.written + window:
+            buf = self._read_range(size, offset)
+            if buf is not None:
+                return buf
+
+        download.wait_for(offset + size)
+        if download.done:
+            # Cache file may have been written by another process, it's
+            # opened again rather than read from the partial file.
+            self._download = None
+            self._file.close()
+            self._file = self.binary_cache.get(self.path)
+            self._map_file()
+            return None
+
+        self._file.seek(offset)
+        return self._file.read(size)
+
+    def _read_range(self, size, offset):
+        '''
+        Read data with a range request. For sequential reads, the request
+        covers the read-ahead window and the extra data is kept for the next
+        reads.
+        '''
+        if self._ahead is not None:
+            (ahead_offset, ahead_buf) = self._ahead
+            start = offset - ahead_offset
+            if start >= 0 and start + size <= len(ahead_buf):
+                return ahead_buf[start:start + size]
+
+        length = size
+        if self.read_ahead.sequential:
+            length = max(size, self.read_ahead.window)
+
+        buf = self.binary_cache.read_range(self.path, offset, length)
+        if buf is None:
+            return None
+        self._ahead = (offset, buf)
+        return buf[:size]
+
+    def _notify_sequential_end(self, end):
+        '''
+        Call on_sequential_end once, when a sequential reader gets within the
+        read-ahead window of the end of the file.
+        '''
+        if self.on_sequential_end is not None \
+           and not self._end_notified \
+           and self.read_ahead.sequential \
+           and end + self.read_ahead.window >= self._size:
+            self._end_notified = True
+            self.on_sequential_end(self.path)
@@ -0,0 +1,176 @@
+import json
+import time
+import sqlite3
+import threading
+
+import pathindex
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    file_id TEXT NOT NULL,
+    binary_id TEXT,
+    binary_rev TEXT,
+    size INTEGER,
+    cached INTEGER NOT NULL DEFAULT 0,
+    last_access REAL,
+    digest TEXT,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_file_id ON files (file_id);
+CREATE INDEX IF NOT EXISTS files_binary_id ON files (binary_id);
+'''
+
+
+class FileIndex:
+    '''
+    Index of the file documents of a device stored in a SQLite database of
+    the device folder. It maps file paths to their document, binary and
+    cache state, so the binary cache finds them without a view query. The
+    mount, the command line and the binary replication share it and keep it
+    up to date with the changes they see.
+    '''
+
+    def __init__(self, filename):
+        '''
+        Open (and create if needed) the index stored in given file. The
+        index is a cache of the database: a crash may lose the last updates
+        but not corrupt it.
+        '''
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            filename, check_same_thread=False, timeout=30)
+        self._connection.row_factory = sqlite3.Row
+        with self._lock:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.executescript(SCHEMA)
+
+    def close(self):
+        '''
+        Close the index database.
+        '''
+        with self._lock:
+            self._connection.close()
+
+    def get(self, path):
+        '''
+        Return the file document located at given path, None if it's not
+        indexed.
+        '''
+        row = self._get_row('SELECT doc FROM files WHERE path = ?',
+                            (path.decode('utf-8'),))
+        if row is None:
+            return None
+        return json.loads(row['doc'])
+
+    def get_path(self, binary_id):
+        '''
+        Return path of a file of given binary, None if it's not indexed.
+        '''
+        row = self._get_row('SELECT path FROM files WHERE binary_id = ?',
+                            (binary_id,))
+        if row is None:
+            return None
+        return row['path'].encode('utf-8')
+
+    def get_state(self, binary_id):
+        '''
+        Return cache state of given binary as a dict with cached, size,
+        last_access and digest keys, None if it's not indexed.
+        '''
+        row = self._get_row(
+            'SELECT cached, size, last_access, digest FROM files '
+            'WHERE binary_id = ?', (binary_id,))
+        if row is None:
+            return None
+        return dict(zip(row.keys(), row))
+
+    def update(self, doc):
+        '''
+        Index given file document. A previous path of the same document is
+        dropped. The cache state of its binary is kept, and its digest too
+        unless the binary revision changed.
+        '''
+        with self._lock:
+            with self._connection:
+                self._update(doc)
+
+    def remove(self, file_id):
+        '''
+        Drop file of given document ID from the index.
+        '''
+        self._execute('DELETE FROM files WHERE file_id = ?', (file_id,))
+
+    def on_change(self, line):
+        '''
+        Apply a line of the changes feed to the index.
+        '''
+        doc = line.get('doc')
+        if line.get('deleted', False):
+            self.remove(line['id'])
+        elif doc is not None and doc.get('docType') == 'File':
+            self.update(doc)
+
+    def set_cached(self, binary_id, cached):
+        '''
+        Record if given binary is cached on this device.
+        '''
+        self._execute('UPDATE files SET cached = ?, last_access = ? '
+                      'WHERE binary_id = ?',
+                      (int(cached), time.time(), binary_id))
+
+    def touch(self, binary_id):
+        '''
+        Record that given binary is read now.
+        '''
+        self._execute('UPDATE files SET last_access = ? WHERE binary_id = ?',
+                      (time.time(), binary_id))
+
+    def set_digest(self, binary_id, digest):
+        '''
+        Record attachment digest of given binary.
+        '''
+        self._execute('UPDATE files SET digest = ? WHERE binary_id = ?',
+                      (digest, binary_id))
+
+    def _update(self, doc):
+        '''
+        Index given file document, the lock and a transaction must be held.
+        '''
+        binary = doc.get('binary', {}).get('file', {})
+        row = self._connection.execute(
+            'SELECT binary_id, binary_rev, cached, last_access, digest '
+            'FROM files WHERE file_id = ?', (doc['_id'],)).fetchone()
+        state = (0, None, None)
+        if row is not None and row['binary_id'] == binary.get('id'):
+            digest = None
+            if row['binary_rev'] == binary.get('rev'):
+                digest = row['digest']
+            state = (row['cached'], row['last_access'], digest)
+
+        self._connection.execute('DELETE FROM files WHERE file_id = ?',
+                                 (doc['_id'],))
+        self._connection.execute(
+            'INSERT OR REPLACE INTO files (path, file_id, binary_id, '
+            'binary_rev, size, cached, last_access, digest, doc) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (pathindex.get_full_path(doc).decode('utf-8'), doc['_id'],
+             binary.get('id'), binary.get('rev'), doc.get('size')) + state +
+            (json.dumps(doc),))
+
+    def _get_row(self, query, params):
+        '''
+        Return first row returned by given query.
+        '''
+        with self._lock:
+            return self._connection.execute(query, params).fetchone()
+
+    def _execute(self, query, params):
+        '''
+        Run given query in its own transaction.
+        '''
+        with self._lock:
+            with self._connection:
+                self._connection.execute(query, params)
@@ -0,0 +1,260 @@
+import os
+import json
+import time
+import base64
+import hashlib
+import logging
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+# Default rate (bytes/s) at which cached binaries are read to be verified.
+RATE = 2 * 1024 * 1024
+
+# Default number of binaries verified in parallel.
+WORKERS = 2
+
+# Time (s) between the end of a verification pass and the next one.
+PASS_INTERVAL = 24 * 3600
+
+# Size (bytes) of the chunks binaries are hashed by.
+CHUNK_SIZE = 256 * 1024
+
+# Number of verified binaries between two saves of the progress.
+SAVE_INTERVAL = 20
+
+
+class Throttle:
+    '''
+    Limit the rate at which bytes are read by several threads.
+    '''
+
+    def __init__(self, rate):
+        '''
+        Register the rate (bytes/s) not to exceed.
+        '''
+        self.rate = rate
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self, size):
+        '''
+        Reserve the reading of *size* bytes. Return the time (s) to wait
+        before reading them.
+        '''
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + size / float(self.rate)
+        return start - now
+
+
+class IntegrityVerifier(threading.Thread):
+    '''
+    Background thread that checks cached binaries against the digest of
+    the attachment they were downloaded from, so truncated downloads and
+    bit rot are not served. Binaries are hashed by a pool of threads at a
+    throttled rate, to leave the disk to the mount. Corrupt binaries are
+    removed and downloaded again.
+
+    A pass verifies all cached binaries, then the verifier sleeps until the
+    next one. Binaries verified during the current pass are saved in a
+    state file, so a pass interrupted by an unmount resumes where it
+    stopped. A binary changed since it was verified is verified again.
+    '''
+
+    def __init__(self, binary_cache, filename, rate=RATE, workers=WORKERS,
+                 interval=PASS_INTERVAL):
+        '''
+        Register the binary cache to verify and the file where progress is
+        saved.
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.binary_cache = binary_cache
+        self.filename = filename
+        self.workers = workers
+        self.interval = interval
+        self.throttle = Throttle(rate)
+        self.state = self._load_state()
+        self.verified = 0
+        self.corrupt = 0
+        self.skipped = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def stop(self):
+        '''
+        Ask the thread to stop. Progress of the current pass is saved.
+        '''
+        self._stopped.set()
+
+    def run(self):
+        '''
+        Run verification passes until the verifier is stopped.
+        '''
+        while not self._stopped.is_set():
+            if self._stopped.wait(self._get_delay()):
+                break
+            try:
+                self.verify_all()
+            except Exception:
+                logger.exception('[Integrity] Verification pass failed')
+                self._stopped.wait(self.interval)
+
+    def verify_all(self):
+        '''
+        Verify cached binaries not verified yet during the current pass. The
+        pass is over when they are all done.
+        '''
+        pending = [binary_id
+                   for binary_id in self.binary_cache.get_cached_binaries()
+                   if not self._is_verified(binary_id)]
+        logger.info('[Integrity] %d binaries to verify' % len(pending))
+
+        pool = ThreadPool(self.workers)
+        try:
+            done = 0
+            for (binary_id, result, stat) in \
+                    pool.imap_unordered(self._verify, pending):
+                if result is not None:
+                    self.state['verified'][binary_id] = \
+                        [stat.st_size, stat.st_mtime]
+                done += 1
+                if done % SAVE_INTERVAL == 0:
+                    self._save_state()
+        finally:
+            pool.close()
+            pool.join()
+
+        if not self._stopped.is_set():
+            self.state['last_pass'] = time.time()
+            self.state['verified'] = {}
+            logger.info('[Integrity] Verification pass done')
+        self._save_state()
+
+    def verify(self, binary_id):
+        '''
+        Hash cached binary and compare it with its attachment digest. Return
+        True if it matches, False if it is corrupt (it's then downloaded
+        again) and None if it can't be verified.
+        '''
+        return self._verify(binary_id)[1]
+
+    def stats(self):
+        '''
+        Return numbers of binaries verified, found corrupt and skipped, and
+        bytes read.
+        '''
+        with self._lock:
+            return {
+                'verified': self.verified,
+                'corrupt': self.corrupt,
+                'skipped': self.skipped,
+                'bytes': self.bytes,
+            }
+
+    def _verify(self, binary_id):
+        '''
+        Verify given binary. Return its ID, the result of the verification
+        and the stat of the verified file.
+        '''
+        filename = os.path.join(self.binary_cache.cache_path, binary_id,
+                                'file')
+        digest = None
+        try:
+            digest = self.binary_cache.get_digest(binary_id)
+            stat = os.stat(filename)
+            md5 = self._hash(filename)
+        except Exception:
+            logger.exception('[Integrity] Cannot verify %s' % binary_id)
+            md5 = None
+        if digest is None or not digest.startswith('md5-') or md5 is None:
+            with self._lock:
+                self.skipped += 1
+            return (binary_id, None, None)
+
+        if base64.b64encode(md5.digest()) == digest[len('md5-'):]:
+            with self._lock:
+                self.verified += 1
+            return (binary_id, True, stat)
+
+        logger.error('[Integrity] %s does not match digest %s, downloading '
+                     'it again' % (binary_id, digest))
+        with self._lock:
+            self.corrupt += 1
+        self.binary_cache.repair(binary_id, stat)
+        return (binary_id, False, stat)
+
+    def _hash(self, filename):
+        '''
+        Return MD5 hash of given file, read at the throttled rate. Return
+        None if the verifier is stopped meanwhile.
+        '''
+        md5 = hashlib.md5()
+        with open(filename, 'rb') as fd:
+            while True:
+                data = fd.read(CHUNK_SIZE)
+                if len(data) == 0:
+                    return md5
+                md5.update(data)
+                with self._lock:
+                    self.bytes += len(data)
+                if self._stopped.wait(self.throttle.reserve(len(data))):
+                    return None
+
+    def _is_verified(self, binary_id):
+        '''
+        Return True if given binary was verified during the current pass and
+        didn't change since.
+        '''
+        entry = self.state['verified'].get(binary_id)
+        if entry is None:
+            return False
+        try:
+            stat = os.stat(os.path.join(self.binary_cache.cache_path,
+                                        binary_id, 'file'))
+        except OSError:
+            return False
+        return entry == [stat.st_size, stat.st_mtime]
+
+    def _get_delay(self):
+        '''
+        Return time (s) to wait before the next pass. A pass in progress is
+        resumed at once.
+        '''
+        last_pass = self.state.get('last_pass')
+        if last_pass is None or len(self.state['verified']) > 0:
+            return 0
+        return max(0, last_pass + self.interval - time.time())
+
+    def _load_state(self):
+        '''
+        Return progress saved in the state file, an empty one if it can't be
+        read.
+        '''
+        try:
+            with open(self.filename) as fd:
+                state = json.load(fd)
+            state.setdefault('verified', {})
+            return state
+        except (IOError, ValueError):
+            return {'last_pass': None, 'verified': {}}
+
+    def _save_state(self):
+        '''
+        Write progress to a temporary file then rename it, so a crash never
+        leaves a partial state file.
+        '''
+        try:
+            with open(self.filename + '.tmp', 'w') as fd:
+                json.dump(self.state, fd)
+            os.rename(self.filename + '.tmp', self.filename)
+        except (IOError, OSError):
+            logger.exception('[Integrity] Cannot save progress')
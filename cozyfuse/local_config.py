@@ -3,6 +3,9 @@ import shutil
 import daemon
 import lockfile
 import logging
+import logging.handlers
+
+import logs
 
 from yaml import load, dump
 from yaml import Loader
@@ -15,7 +18,15 @@ if not os.path.isdir(CONFIG_FOLDER):
 
 CONFIG_PATH = os.path.join(CONFIG_FOLDER, 'config.yaml')
 
-HDLR = logging.FileHandler(os.path.join(CONFIG_FOLDER, 'cozyfuse.log'))
+# Log file is rotated when it reaches this size (bytes).
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+
+# Log file is written by a background thread.
+HDLR = logs.QueueHandler(logging.handlers.RotatingFileHandler(
+    os.path.join(CONFIG_FOLDER, 'cozyfuse.log'),
+    maxBytes=LOG_MAX_BYTES,
+    backupCount=LOG_BACKUP_COUNT))
 HDLR.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
 
 logger = logging.getLogger(__name__)
@@ -187,6 +198,18 @@ def get_db_credentials(name):
     return (db_login, db_password)
 
 
+def get_option(name, option, default=None):
+    '''
+    Return value of an optional parameter of device *name*, *default* if it
+    is not set in the config file.
+    '''
+    config = get_full_config()
+    if name not in config:
+        raise NoConfigFound('[Config] No device is registered for %s' % name)
+    else:
+        return config[name].get(option, default)
+
+
 def get_full_config():
     '''
     Get config (~/.cozyfuse/config.yaml) file as a dict.
@@ -0,0 +1,36 @@
+import threading
+import contextlib
+
+
+class KeyLocks:
+    '''
+    Set of locks identified by a key (a path or a binary ID). A lock only
+    exists while a thread holds it or waits for it.
+    '''
+
+    def __init__(self):
+        '''
+        Initialize the dict storing, for each key, its lock and the number
+        of threads using it.
+        '''
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        '''
+        Context manager holding the lock of given key.
+        '''
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+
+        entry[0].acquire()
+        try:
+            yield
+        finally:
+            entry[0].release()
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
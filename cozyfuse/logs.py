@@ -0,0 +1,184 @@
+import os
+import Queue
+import atexit
+import logging
+import threading
+
+# Maximum number of records waiting to be written. Records are dropped when
+# the queue is full rather than slowing down the caller.
+QUEUE_SIZE = 10000
+
+
+class QueueHandler(logging.Handler):
+    '''
+    Handler that puts records in a queue. A background thread writes them
+    with the target handler, so callers don't wait for file I/O.
+    '''
+
+    def __init__(self, target, queue_size=QUEUE_SIZE):
+        '''
+        Register the handler that will write records. The writing thread is
+        started at the first record.
+        '''
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue_size = queue_size
+        self.dropped = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._thread_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def setFormatter(self, fmt):
+        '''
+        Formatting is done by the target handler, in the writing thread.
+        '''
+        self.target.setFormatter(fmt)
+
+    def emit(self, record):
+        '''
+        Prepare record so it can be formatted later, then queue it.
+        '''
+        try:
+            self._ensure_thread()
+            self._prepare(record)
+            self._queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        '''
+        Write queued records and stop the writing thread.
+        '''
+        with self._thread_lock:
+            if self._thread is not None and self._thread.is_alive() \
+               and self._pid == os.getpid():
+                try:
+                    self._queue.put(None, timeout=5)
+                    self._thread.join(5)
+                except Queue.Full:
+                    pass
+            self._thread = None
+            self._pid = None
+        self.target.close()
+        logging.Handler.close(self)
+
+    def flush(self, timeout=5):
+        '''
+        Wait until records queued so far are written. Used before the
+        process forks: the parent process exits without running exit
+        handlers, so its queue would be lost.
+        '''
+        if self._thread is None or self._pid != os.getpid():
+            return
+        written = threading.Event()
+        try:
+            self._queue.put(written, timeout=timeout)
+        except Queue.Full:
+            return
+        written.wait(timeout)
+        self.target.flush()
+
+    def _prepare(self, record):
+        '''
+        Merge message arguments and format exception now: they may change
+        or be released before the record is written.
+        '''
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+
+    def _ensure_thread(self):
+        '''
+        Start the writing thread if it's not running in this process. When
+        the process forked (FUSE does it to go to background), threads of
+        the parent are lost, so a new queue and thread are created.
+        '''
+        if self._pid == os.getpid():
+            return
+
+        with self._thread_lock:
+            if self._pid != os.getpid():
+                # The parent's writing thread may have held the target lock
+                # when the process forked: it would never be released.
+                self.target.createLock()
+                self._queue = Queue.Queue(self.queue_size)
+                self._thread = threading.Thread(target=self._write,
+                                                args=(self._queue,))
+                self._thread.daemon = True
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _write(self, queue):
+        '''
+        Write queued records until None is received.
+        '''
+        while True:
+            record = queue.get()
+            if record is None:
+                break
+            if not isinstance(record, logging.LogRecord):
+                # Event queued by flush.
+                record.set()
+                continue
+            try:
+                self.target.handle(record)
+            except Exception:
+                self.target.handleError(record)
+
+
+def get_level(level):
+    '''
+    Return the number of given level, given as a name or a number.
+    '''
+    if isinstance(level, int):
+        return level
+    number = logging.getLevelName(str(level).upper())
+    if not isinstance(number, int):
+        raise ValueError('Unknown log level: %s' % level)
+    return number
+
+
+class OperationLogger:
+    '''
+    Log calls to file system operations. Each operation has its own level,
+    and calls to hot operations can be sampled: only one call out of *rate*
+    is logged.
+    '''
+
+    def __init__(self, logger, levels=None, sampling=None):
+        '''
+        Register levels (name or number) and sampling rates by operation.
+        Operations without level are logged at INFO level. Raise ValueError
+        for an unknown level name.
+        '''
+        self.logger = logger
+        self.levels = {}
+        for (operation, level) in (levels or {}).items():
+            self.levels[operation] = get_level(level)
+        self.sampling = sampling or {}
+        self._counts = {}
+
+    def log(self, operation, path):
+        '''
+        Log a call to given operation on given path.
+        '''
+        level = self.levels.get(operation, logging.INFO)
+        if not self.logger.isEnabledFor(level):
+            return
+
+        rate = self.sampling.get(operation, 1)
+        if rate > 1:
+            # Not locked: a lost increment only shifts sampling a bit.
+            count = self._counts.get(operation, 0) + 1
+            self._counts[operation] = count
+            if count % rate != 1:
+                return
+
+        self.logger.log(level, '%s %s', operation, path)
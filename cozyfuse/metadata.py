@@ -0,0 +1,164 @@
+import datetime
+
+import cache
+import dbutils
+import pathindex
+
+# Time attributes are cached when the path index is not loaded.
+ATTR_VALIDITY_PERIOD = datetime.timedelta(seconds=10)
+
+# Document describing the root of the mount.
+ROOT_DOC = {'docType': 'Folder'}
+
+
+class Metadata:
+    '''
+    Folder and file metadata of a mounted device. Documents are read from the
+    path index when it's loaded, from views otherwise. Attributes built from
+    them, folder listings and missing paths are cached, and the changes feed
+    evicts what it modifies.
+
+    Changes are counted by a generation number: an operation that read
+    documents before a change must not cache what it read, else the eviction
+    done by the change would be undone.
+    '''
+
+    def __init__(self, db, path_index, get_stat, on_evict=None):
+        '''
+        Register the database, the path index and the function building
+        attributes from a document. *on_evict* is called with each path
+        evicted by a change.
+        '''
+        self.db = db
+        self.path_index = path_index
+        self.get_stat = get_stat
+        self.on_evict = on_evict
+        self.generation = 0
+
+        # With the path index, the changes listener knows every path touched
+        # by a change, so cached data are kept until they are evicted.
+        # Without it, deleted documents can't be matched to their paths, so
+        # cached data expire.
+        if path_index.loaded:
+            validity_period = None
+        else:
+            validity_period = ATTR_VALIDITY_PERIOD
+        self.attr_cache = cache.Cache(validity_period)
+        self.readdir_file_cache = cache.Cache(validity_period)
+        self.readdir_folder_cache = cache.Cache(validity_period)
+        # Missing paths are not bounded by the tree size, they still expire.
+        self.missing_cache = cache.Cache(ATTR_VALIDITY_PERIOD)
+
+    def get_attr(self, path):
+        '''
+        Return attributes of given path, None if nothing is located there.
+        '''
+        # Path is known as missing, no need to look for it.
+        if self.missing_cache.get(path) is not None:
+            return None
+
+        st = self.attr_cache.get(path)
+        if st is None:
+            generation = self.generation
+            if path == '':
+                doc = ROOT_DOC
+            else:
+                doc = self.get_entry(path)
+
+            if doc is None:
+                if generation == self.generation:
+                    self.missing_cache.add(path, True)
+                return None
+
+            st = self.get_stat(doc)
+            if generation == self.generation:
+                self.attr_cache.add(path, st)
+        return st
+
+    def list(self, path):
+        '''
+        Return documents of the folder located at given path. Documents are
+        already there, so their attributes are cached to avoid a query for
+        each getattr that follows a listing.
+        '''
+        generation = self.generation
+
+        # Index is up to date, no need to query the database.
+        if self.path_index.loaded:
+            docs = self.path_index.list(path)
+
+        else:
+            res = self.readdir_file_cache.get(path)
+            if res is None:
+                res = self.db.view('file/byFolder', key=path)
+                if generation == self.generation:
+                    self.readdir_file_cache.add(path, res)
+            docs = [row.value for row in res]
+
+            res = self.readdir_folder_cache.get(path)
+            if res is None:
+                res = self.db.view('folder/byFolder', key=path)
+                if generation == self.generation:
+                    self.readdir_folder_cache.add(path, res)
+            docs.extend([row.value for row in res])
+
+        for doc in docs:
+            if generation != self.generation:
+                break
+            self.attr_cache.add(
+                pathindex.get_full_path(doc), self.get_stat(doc))
+        return docs
+
+    def get_entry(self, path):
+        '''
+        Return folder or file document located at given path.
+        '''
+        if self.path_index.loaded:
+            return self.path_index.get(path)
+        else:
+            return dbutils.get_entry(self.db, path)
+
+    def get_file(self, path):
+        '''
+        Return file document located at given path.
+        '''
+        doc = self.get_entry(path)
+        if doc is not None and not pathindex.is_folder(doc):
+            return doc
+        else:
+            return None
+
+    def on_change(self, line):
+        '''
+        Update path index with given change, then evict cached data of the
+        previous and new paths of the changed document.
+        '''
+        if self.path_index.loaded:
+            (old_path, new_path) = self.path_index.apply_change(line)
+        else:
+            doc = line.get('doc')
+            old_path = None
+            new_path = None
+            if not line.get('deleted', False) and doc is not None \
+               and doc.get('docType') in pathindex.DOC_TYPES:
+                new_path = pathindex.get_full_path(doc)
+
+        # Operations that read the index before this change must not cache
+        # what they read.
+        self.generation += 1
+
+        for path in set([old_path, new_path]):
+            if path is not None:
+                self.evict(path)
+
+    def evict(self, path):
+        '''
+        Remove cached data of given path and listings of its parent folder.
+        '''
+        folder_path = path.rsplit('/', 1)[0]
+        self.attr_cache.remove(path)
+        self.missing_cache.remove(path)
+        self.readdir_file_cache.remove(folder_path)
+        self.readdir_folder_cache.remove(folder_path)
+        if self.on_evict is not None:
+            self.on_evict(path)
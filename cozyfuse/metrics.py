@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import types
+import logging
+import threading
+
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+# Upper bounds (ms) of latency histogram buckets. Last bucket has no bound.
+LATENCY_BUCKETS = [0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000]
+
+# Time (s) between two writes of the metrics file.
+WRITE_INTERVAL = 10
+
+
+class OperationStats:
+    '''
+    Call count, error count and latency histogram of an operation.
+    '''
+
+    def __init__(self):
+        '''
+        Initialize counters, one per histogram bucket.
+        '''
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, duration, error):
+        '''
+        Count a call that lasted *duration* ms.
+        '''
+        self.calls += 1
+        if error:
+            self.errors += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+
+        index = 0
+        while index < len(LATENCY_BUCKETS) and \
+                duration > LATENCY_BUCKETS[index]:
+            index += 1
+        self.buckets[index] += 1
+
+    def to_dict(self):
+        '''
+        Return counters as a dict that can be serialized in JSON.
+        '''
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'total_time': self.total_time,
+            'max_time': self.max_time,
+            'buckets': self.buckets,
+        }
+
+
+class Metrics:
+    '''
+    Metrics of a mount: statistics of each file system operation and
+    counters of registered caches. Caches are objects with a stats method
+    returning a dict of counters.
+    '''
+
+    def __init__(self):
+        '''
+        Initialize operation statistics and cache registry.
+        '''
+        self.operations = {}
+        self.caches = {}
+        self._lock = threading.Lock()
+
+    def record(self, operation, duration, error=False):
+        '''
+        Count a call to given operation that lasted *duration* ms.
+        '''
+        with self._lock:
+            stats = self.operations.get(operation)
+            if stats is None:
+                stats = self.operations[operation] = OperationStats()
+            stats.record(duration, error)
+
+    def register_cache(self, name, cache):
+        '''
+        Include counters of given cache in the metrics.
+        '''
+        self.caches[name] = cache
+
+    def instrument(self, operation, function):
+        '''
+        Return *function* wrapped to record its calls under *operation*. A
+        call fails when it raises an exception or returns an error number
+        (negative integer). Generators are consumed, so the whole listing is
+        measured.
+        '''
+        def instrumented(*args, **kwargs):
+            start = time.time()
+            error = True
+            try:
+                result = function(*args, **kwargs)
+                if isinstance(result, types.GeneratorType):
+                    result = list(result)
+                error = isinstance(result, int) and result < 0
+                return result
+            finally:
+                self.record(operation, (time.time() - start) * 1000, error)
+        return instrumented
+
+    def snapshot(self):
+        '''
+        Return all metrics as a dict that can be serialized in JSON.
+        '''
+        with self._lock:
+            operations = dict([(name, stats.to_dict())
+                               for (name, stats) in self.operations.items()])
+        caches = dict([(name, cache.stats())
+                       for (name, cache) in self.caches.items()])
+        return {
+            'time': time.time(),
+            'latency_buckets': LATENCY_BUCKETS,
+            'operations': operations,
+            'caches': caches,
+        }
+
+
+class MetricsWriter(threading.Thread):
+    '''
+    Background thread writing metrics to a file at a regular interval, so
+    they can be read while the file system is mounted.
+    '''
+
+    def __init__(self, metrics, filename, interval=WRITE_INTERVAL):
+        '''
+        Register metrics to write and the file to write them to.
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.metrics = metrics
+        self.filename = filename
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def stop(self):
+        '''
+        Ask the thread to stop. Metrics are written a last time.
+        '''
+        self._stopped.set()
+        self.write()
+
+    def run(self):
+        '''
+        Write metrics until the writer is stopped.
+        '''
+        while not self._stopped.is_set():
+            self.write()
+            self._stopped.wait(self.interval)
+
+    def write(self):
+        '''
+        Write metrics to a temporary file then rename it, so readers never
+        see a partial file.
+        '''
+        try:
+            temp_filename = self.filename + '.tmp'
+            with open(temp_filename, 'w') as fd:
+                json.dump(self.metrics.snapshot(), fd)
+            os.rename(temp_filename, self.filename)
+        except Exception:
+            logger.exception('[Metrics] Cannot write %s' % self.filename)
+
+
+def read(filename):
+    '''
+    Return metrics stored in given file.
+    '''
+    with open(filename) as fd:
+        return json.load(fd)
+
+
+def format_metrics(snapshot):
+    '''
+    Return metrics as human readable lines.
+    '''
+    lines = ['%-10s %8s %7s %10s %10s' % (
+        'operation', 'calls', 'errors', 'avg (ms)', 'max (ms)')]
+    for (name, stats) in sorted(snapshot['operations'].items()):
+        average = stats['total_time'] / max(stats['calls'], 1)
+        lines.append('%-10s %8d %7d %10.2f %10.2f' % (
+            name, stats['calls'], stats['errors'], average,
+            stats['max_time']))
+
+    lines.append('')
+    for (name, stats) in sorted(snapshot['caches'].items()):
+        counters = ', '.join(['%s: %s' % item
+                              for item in sorted(stats.items())])
+        lines.append('%s cache: %s' % (name, counters))
+    return lines
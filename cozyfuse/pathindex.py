@@ -0,0 +1,132 @@
+import threading
+
+DOC_TYPES = ['Folder', 'File']
+
+
+class PathIndex:
+    '''
+    In-memory tree of the folders and files of a device. It is loaded once
+    from the database then kept up to date with the changes feed, so path
+    lookups don't require any view query.
+    '''
+
+    def __init__(self):
+        '''
+        Initialize the index dicts: one for the documents indexed by full
+        path, one for the child names of each folder and one to find back
+        the path of a document from its ID.
+        '''
+        self.loaded = False
+        self._entries = {}
+        self._children = {}
+        self._paths = {}
+        self._lock = threading.RLock()
+
+    def load(self, docs):
+        '''
+        Fill the index with given folder and file documents. Previous content
+        is dropped.
+        '''
+        with self._lock:
+            self._entries = {}
+            self._children = {}
+            self._paths = {}
+            for doc in docs:
+                self._add(doc)
+            self.loaded = True
+
+    def get(self, path):
+        '''
+        Return the folder or file document located at given path, None if
+        there is no such document.
+        '''
+        with self._lock:
+            return self._entries.get(path)
+
+    def list(self, path):
+        '''
+        Return the documents stored in the folder located at given path.
+        '''
+        with self._lock:
+            paths = set(self._children.get(path, {}).values())
+            return [self._entries[child] for child in paths
+                    if child in self._entries]
+
+    def get_path(self, doc_id):
+        '''
+        Return the path currently indexed for given document ID.
+        '''
+        with self._lock:
+            return self._paths.get(doc_id)
+
+    def apply_change(self, change):
+        '''
+        Update the index with a line of the changes feed (retrieved with
+        include_docs option). The previous and the new paths of the changed
+        document are returned (None when not indexed).
+        '''
+        doc = change.get('doc')
+        with self._lock:
+            old_path = self._remove(change['id'])
+            new_path = None
+            if not change.get('deleted', False) and doc is not None:
+                new_path = self._add(doc)
+        return (old_path, new_path)
+
+    def _add(self, doc):
+        '''
+        Index given document if it's a folder or a file. Return its full path.
+        '''
+        if doc.get('docType') not in DOC_TYPES:
+            return None
+
+        self._remove(doc['_id'])
+        folder_path = _encode(doc['path'])
+        path = get_full_path(doc)
+
+        self._entries[path] = doc
+        self._paths[doc['_id']] = path
+        self._children.setdefault(folder_path, {})[doc['_id']] = path
+        return path
+
+    def _remove(self, doc_id):
+        '''
+        Remove document matching given ID from the index. Return the path
+        it was indexed for.
+        '''
+        path = self._paths.pop(doc_id, None)
+        if path is not None:
+            folder_path = path.rsplit('/', 1)[0]
+            self._children.get(folder_path, {}).pop(doc_id, None)
+
+            # Another document may have been indexed for the same path.
+            doc = self._entries.get(path)
+            if doc is not None and doc['_id'] == doc_id:
+                del self._entries[path]
+        return path
+
+
+def get_full_path(doc):
+    '''
+    Return full path of a folder or file document, encoded the same way FUSE
+    gives paths.
+    '''
+    return _encode(doc['path']) + '/' + _encode(doc['name'])
+
+
+def is_folder(doc):
+    '''
+    Return True if given document describes a folder.
+    '''
+    return doc.get('docType') == 'Folder'
+
+
+def _encode(value):
+    '''
+    Paths given by FUSE are UTF-8 encoded strings while documents contain
+    unicode strings.
+    '''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    else:
+        return value
@@ -0,0 +1,168 @@
+import Queue
+import fnmatch
+import logging
+import threading
+
+import dbutils
+import pathindex
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+# Conditions a cache policy rule can set.
+CONDITIONS = ['path', 'max_size', 'mime']
+
+# Time (s) to wait for new documents before saving storage marks.
+IDLE_DELAY = 5
+
+
+class CachePolicy:
+    '''
+    Rules telling which files must be cached on the device, declared in the
+    cache_policies option of the device, for instance:
+
+        cache_policies:
+          - {path: /Documents}
+          - {max_size: 5}
+          - {mime: image/*}
+          - {path: /Videos, cache: false}
+
+    A rule matches files satisfying all its conditions: being in given
+    folder, weighing at most given megabytes, having a mime type matching
+    given pattern. A file is cached when it matches a rule and no rule with
+    cache set to false.
+    '''
+
+    def __init__(self, rules):
+        '''
+        Register given rules. Invalid ones are ignored.
+        '''
+        self.rules = []
+        for rule in rules or []:
+            if not isinstance(rule, dict) or \
+                    not any(condition in rule for condition in CONDITIONS) \
+                    or any(key not in CONDITIONS + ['cache'] for key in rule):
+                logger.error('[Policy] Invalid cache policy ignored: %s'
+                             % rule)
+                continue
+            rule = dict(rule)
+            if 'path' in rule:
+                rule['path'] = '/' + rule['path'].strip('/')
+            self.rules.append(rule)
+
+    def should_cache(self, doc):
+        '''
+        Return True if file of given document must be cached, False if it
+        must not, None if no rule matches it.
+        '''
+        result = None
+        for rule in self.rules:
+            if self._matches(rule, doc):
+                if not rule.get('cache', True):
+                    return False
+                result = True
+        return result
+
+    def _matches(self, rule, doc):
+        '''
+        Return True if file of given document satisfies all conditions of
+        given rule.
+        '''
+        if 'path' in rule:
+            path = pathindex.get_full_path(doc)
+            if rule['path'] != '/' and path != rule['path'] and \
+                    not path.startswith(rule['path'] + '/'):
+                return False
+        if 'max_size' in rule:
+            size = doc.get('size')
+            if size is None or size > rule['max_size'] * 1024 * 1024:
+                return False
+        if 'mime' in rule:
+            if not fnmatch.fnmatch(doc.get('mime') or '', rule['mime']):
+                return False
+        return True
+
+
+class PolicyWorker(threading.Thread):
+    '''
+    Background thread applying cache policies to file documents: files
+    that must be cached are downloaded to the binary cache and pinned, files
+    that must not are unpinned and removed from it. Documents are queued as
+    they arrive, so the working set is cached before it's read.
+    '''
+
+    def __init__(self, policy, binary_cache):
+        '''
+        Register the policy and the binary cache to fill.
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.policy = policy
+        self.binary_cache = binary_cache
+        self.queue = Queue.Queue()
+        self.cached = 0
+        self.removed = 0
+        self._stopped = threading.Event()
+
+    def add(self, doc):
+        '''
+        Queue given document, it's ignored if it's not a file one.
+        '''
+        if doc.get('docType') == 'File' and 'binary' in doc:
+            self.queue.put(doc)
+
+    def add_all(self, db):
+        '''
+        Queue all file documents of given database, to apply policies to
+        files replicated before.
+        '''
+        for row in dbutils.get_files(db):
+            self.add(row.value)
+
+    def stop(self):
+        '''
+        Ask the thread to stop after the current document.
+        '''
+        self._stopped.set()
+
+    def run(self):
+        '''
+        Apply policies to queued documents until the worker is stopped.
+        Storage marks are saved each time the queue is empty.
+        '''
+        while not self._stopped.is_set():
+            try:
+                doc = self.queue.get(timeout=IDLE_DELAY)
+            except Queue.Empty:
+                self.binary_cache.flush()
+                continue
+            self.apply(doc)
+        self.binary_cache.flush()
+
+    def apply(self, doc):
+        '''
+        Cache or remove file of given document, according to the policy.
+        '''
+        decision = self.policy.should_cache(doc)
+        if decision is None:
+            return
+        path = pathindex.get_full_path(doc)
+        try:
+            self.binary_cache.file_index.update(doc)
+            self.binary_cache.evict_metadata(path)
+            if decision:
+                self.binary_cache.pin(path)
+                if not self.binary_cache.is_cached(path):
+                    self.binary_cache.add(path)
+                    self.cached += 1
+                    logger.info('[Policy] %s cached' % path)
+            else:
+                self.binary_cache.unpin(path)
+                if self.binary_cache.is_cached(path):
+                    self.binary_cache.remove(path)
+                    self.removed += 1
+                    logger.info('[Policy] %s removed from cache' % path)
+        except Exception:
+            logger.exception('[Policy] Cannot apply cache policy to %s'
+                             % path)
@@ -0,0 +1,49 @@
+import time
+
+MIN_WINDOW = 128 * 1024
+MAX_WINDOW = 16 * 1024 * 1024
+# The window holds what is read during this time (s) at observed speed.
+WINDOW_DURATION = 2
+
+
+class ReadAhead:
+    '''
+    Access pattern of a file handle. Reads that follow each other are
+    considered sequential, the amount of data to fetch ahead of them (the
+    window) follows the speed at which they are consumed. A random read
+    shrinks the window.
+    '''
+
+    def __init__(self):
+        '''
+        Initialize pattern: no read occured yet.
+        '''
+        self.window = MIN_WINDOW
+        self.sequential = False
+        self._next_offset = None
+        self._streak_start = None
+        self._streak_size = 0
+
+    def update(self, offset, size):
+        '''
+        Register a read of *size* bytes at *offset* and update the window.
+        '''
+        now = time.time()
+
+        if offset == self._next_offset:
+            self.sequential = True
+            self._streak_size += size
+            elapsed = now - self._streak_start
+            if elapsed > 0:
+                window = int(self._streak_size / elapsed * WINDOW_DURATION)
+            else:
+                window = self.window * 2
+            self.window = max(MIN_WINDOW, min(window, MAX_WINDOW))
+
+        else:
+            self.sequential = False
+            self.window = max(MIN_WINDOW, self.window / 2)
+            self._streak_start = now
+            self._streak_size = size
+
+        self._next_offset = offset + size
@@ -1,6 +1,6 @@
 import logging
-import requests
 
+import dbutils
 import local_config
 
 logger = logging.getLogger(__name__)
@@ -26,8 +26,8 @@ def register_device(name, url, path, password):
     configuration file.
     '''
     data = {'login': name, 'folder': path}
-    response = requests.post(
-        '%s/device/' % url,
+    response = dbutils.get_client().request(
+        'POST', '%s/device/' % url,
         data=data,
         auth=('owner', password),
         verify=False
@@ -63,8 +63,9 @@ def remove_device(url, device_id, password):
     '''
     Remove device from its Cozy.
     '''
-    response = requests.delete('%s/device/%s/' % (url, device_id),
-                               auth=('owner', password), verify=False)
+    response = dbutils.get_client().request(
+        'DELETE', '%s/device/%s/' % (url, device_id),
+        auth=('owner', password), verify=False)
 
     logger.info('[Remote config] Device deletion succeeded for %s.' % url)
     return response
@@ -1,12 +1,15 @@
+import os
 import json
-import requests
 import logging
 import time
 
 import dbutils
+import fileindex
+import binarycache
+import policies
 import local_config
 
-from couchdb import Server, http
+from couchdb import http
 
 logger = logging.getLogger(__name__)
 local_config.configure_logger(logger)
@@ -43,7 +46,7 @@ def replicate(database, url, device, device_password, device_id,
     local = 'http://%s:%s@localhost:5984/%s' % \
             (db_login, db_password, database)
     remote = "https://%s:%s@%s/cozy" % (device, device_password, url[2])
-    server = Server('http://localhost:5984/')
+    server = dbutils.get_client().server
 
     if to_local:
         target = local
@@ -85,7 +88,7 @@ def get_progression():
     Recover progression of metadata replication
     '''
     url = 'http://localhost:5984/_active_tasks'
-    response = requests.get(url)
+    response = dbutils.get_client().request('GET', url)
     replications = json.loads(response.content)
     prog = 0
     for rep in replications:
@@ -122,6 +125,12 @@ class BinaryReplication():
             local_config.get_db_credentials(db_name)
         (self.db, self.server) = dbutils.get_db_and_server(db_name)
         self.db_name = db_name
+        device_path = os.path.join(local_config.CONFIG_FOLDER, db_name)
+        if not os.path.isdir(device_path):
+            os.makedirs(device_path)
+        self.file_index = fileindex.FileIndex(
+            os.path.join(device_path, 'files.sqlite'))
+        self.policy_worker = self._get_policy_worker(device_path)
         self.replicate_file_changes()
 
     def replicate_file_changes(self):
@@ -147,12 +156,14 @@ class BinaryReplication():
                                       include_docs=True)
 
             binary_ids = []
+            docs = []
 
             # Iterate over changes
             for line in changes['results']:
 
                 # Save last sequence number
                 new_seq = line['seq']
+                self.file_index.on_change(line)
 
                 # Find related binary and add its ID to the list
                 # of files to replicate.
@@ -171,6 +182,8 @@ class BinaryReplication():
                     logger.info("Updating file %s..." % doc['name'])
                 if 'binary' in doc:
                     binary_ids.append(doc['binary']['file']['id'])
+                    if not self._is_deleted(line):
+                        docs.append(doc)
 
             # Replicate related binaries
             if len(binary_ids) > 0:
@@ -185,6 +198,11 @@ class BinaryReplication():
                         % line['id']
                     )
 
+            # Apply cache policies once binaries are local
+            if self.policy_worker is not None:
+                for doc in docs:
+                    self.policy_worker.add(doc)
+
             # Save last sequence number along with the device
             if new_seq != device['seq']:
                 device = dbutils.get_device(self.db_name)
@@ -194,6 +212,31 @@ class BinaryReplication():
             # Wait until further potential changes
             time.sleep(10)
 
+    def _get_policy_worker(self, device_path):
+        '''
+        Start the worker applying cache policies of the device to its files,
+        already replicated ones first. Return None if the device has no
+        policy.
+        '''
+        policy = policies.CachePolicy(
+            local_config.get_option(self.db_name, 'cache_policies', []))
+        if len(policy.rules) == 0:
+            return None
+
+        (device_url, device_mount_path) = local_config.get_config(self.db_name)
+        binary_cache = binarycache.BinaryCache(
+            self.db_name, device_path,
+            'http://%s:%s@localhost:5984/%s' % (
+                self.username, self.password, self.db_name),
+            device_mount_path,
+            dedup=local_config.get_option(self.db_name, 'cache_dedup', False))
+        worker = policies.PolicyWorker(policy, binary_cache)
+        worker.add_all(self.db)
+        worker.start()
+        logger.info('[Policy] %d cache policies applied'
+                    % len(policy.rules))
+        return worker
+
     def _is_new(self, line):
         '''
         Document is considered as new if its revision starts by "1-"
@@ -0,0 +1,118 @@
+import copy
+import logging
+import threading
+
+import dbutils
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+# Time (s) between two flushes of queued storage marks.
+FLUSH_INTERVAL = 5
+
+
+class StorageQueue:
+    '''
+    Changes of the storage field of file documents, which lists the devices
+    storing the file binary, waiting to be saved. They are saved with
+    _bulk_docs requests applied to the latest revisions, so caching many
+    files doesn't cost one request and conflict risk per file. Only the last
+    change queued for a file is saved.
+    '''
+
+    def __init__(self, db, device_name, batch_size=None):
+        '''
+        Register the database and the name of the device to add to or remove
+        from storage fields. Queued changes are flushed once *batch_size* of
+        them are waiting.
+        '''
+        if batch_size is None:
+            batch_size = dbutils.BULK_BATCH_SIZE
+        self.db = db
+        self.device_name = device_name
+        self.batch_size = batch_size
+        self.pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def mark(self, file_id, stored, size=None):
+        '''
+        Queue marking of given file as stored or not on the device. When
+        given, *size* is saved as the file size too.
+        '''
+        with self._lock:
+            self.pending[file_id] = (stored, size)
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        '''
+        Save queued changes. Documents already in the expected state are not
+        saved again.
+        '''
+        with self._flush_lock:
+            with self._lock:
+                (pending, self.pending) = (self.pending, {})
+            if len(pending) == 0:
+                return
+
+            def change(doc):
+                (stored, size) = pending[doc['_id']]
+                storage = doc.get('storage', [])
+                if stored and self.device_name not in storage:
+                    doc['storage'] = storage + [self.device_name]
+                elif not stored and self.device_name in storage:
+                    storage.remove(self.device_name)
+                if size is not None:
+                    doc['size'] = size
+
+            try:
+                rows = self.db.view('_all_docs', keys=list(pending),
+                                    include_docs=True)
+                docs = []
+                for row in rows:
+                    if row.doc is None:
+                        continue
+                    doc = copy.deepcopy(row.doc)
+                    change(doc)
+                    if doc != row.doc:
+                        docs.append(row.doc)
+                (saved, failed) = dbutils.bulk_update(self.db, docs, change)
+            except Exception:
+                logger.exception('[Storage] Cannot save %d storage marks'
+                                 % len(pending))
+                return
+            logger.info('[Storage] %d files marked, %d failed'
+                        % (len(saved), len(failed)))
+
+
+class StorageFlusher(threading.Thread):
+    '''
+    Background thread flushing a storage queue at a regular interval.
+    '''
+
+    def __init__(self, queue, interval=FLUSH_INTERVAL):
+        '''
+        Register the queue to flush.
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def stop(self):
+        '''
+        Ask the thread to stop. The queue is flushed a last time.
+        '''
+        self._stopped.set()
+        self.queue.flush()
+
+    def run(self):
+        '''
+        Flush the queue until the thread is stopped.
+        '''
+        while not self._stopped.wait(self.interval):
+            self.queue.flush()
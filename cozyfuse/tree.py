@@ -0,0 +1,247 @@
+import errno
+import logging
+import mimetypes
+
+import dbutils
+import local_config
+import pathindex
+
+from couchdb.http import ResourceConflict, ResourceNotFound
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+
+class Tree:
+    '''
+    Create, move and delete folder and file documents of a mounted device.
+    Changes are applied to the metadata right away, so following operations
+    see them before the changes feed brings them back.
+
+    Errors are raised as OSError with the error number to return to FUSE.
+    '''
+
+    def __init__(self, db, metadata, binary_cache):
+        '''
+        Register the database, the metadata of the mount and the binary
+        cache holding file contents.
+        '''
+        self.db = db
+        self.metadata = metadata
+        self.binary_cache = binary_cache
+
+    def create_folder(self, path):
+        '''
+        Create folder document at given path.
+        '''
+        (folder_path, name) = split_path(path)
+        self._check_creatable(path, folder_path)
+
+        now = dbutils.get_current_date()
+        doc = {
+            'name': name,
+            'path': folder_path.decode('utf-8'),
+            'docType': 'Folder',
+            'creationDate': now,
+            'lastModification': now,
+        }
+        self.db.save(doc)
+        self.apply(doc)
+        self.touch_folders([folder_path])
+        return doc
+
+    def create_file(self, path):
+        '''
+        Create an empty file at given path: a binary document with an empty
+        attachment and the file document linked to it.
+        '''
+        (folder_path, name) = split_path(path)
+        self._check_creatable(path, folder_path)
+
+        binary = {'docType': 'Binary'}
+        self.db.save(binary)
+        self.db.put_attachment(binary, '', filename='file')
+
+        now = dbutils.get_current_date()
+        (mime_type, encoding) = mimetypes.guess_type(path)
+        doc = {
+            'name': name,
+            'path': folder_path.decode('utf-8'),
+            'binary': {
+                'file': {
+                    'id': binary['_id'],
+                    'rev': binary['_rev'],
+                }
+            },
+            'docType': 'File',
+            'mime': mime_type,
+            'size': 0,
+            'creationDate': now,
+            'lastModification': now,
+        }
+        self.db.save(doc)
+        self.apply(doc)
+        self.touch_folders([folder_path])
+        return doc
+
+    def remove_file(self, path):
+        '''
+        Delete file document located at given path, its binary and its
+        cached content.
+        '''
+        doc = self.metadata.get_file(path)
+        if doc is None:
+            raise OSError(errno.ENOENT, 'No file at %s' % path)
+
+        binary_id = doc['binary']['file']['id']
+        self.binary_cache.discard(path)
+        try:
+            self.db.delete(self.db[binary_id])
+        except ResourceNotFound:
+            pass
+        self._delete(doc)
+        self.apply(doc, deleted=True)
+        self.touch_folders([split_path(path)[0]])
+
+    def remove_folder(self, path):
+        '''
+        Delete the empty folder located at given path.
+        '''
+        doc = self.metadata.get_entry(path)
+        if doc is None:
+            raise OSError(errno.ENOENT, 'No folder at %s' % path)
+        elif not pathindex.is_folder(doc):
+            raise OSError(errno.ENOTDIR, '%s is not a folder' % path)
+        elif len(self.metadata.list(path)) > 0:
+            raise OSError(errno.ENOTEMPTY, '%s is not empty' % path)
+
+        self._delete(doc)
+        self.apply(doc, deleted=True)
+        self.touch_folders([split_path(path)[0]])
+
+    def rename(self, path_from, path_to):
+        '''
+        Move folder or file located at *path_from* to *path_to*. A file or
+        an empty folder at *path_to* is replaced. Documents of a folder
+        subtree are read with a single query and saved with bulk requests.
+        '''
+        doc = self.metadata.get_entry(path_from)
+        if doc is None:
+            raise OSError(errno.ENOENT, 'Nothing at %s' % path_from)
+        elif path_from == path_to:
+            return
+
+        (folder_from, name_from) = split_path(path_from)
+        (folder_to, name_to) = split_path(path_to)
+        if pathindex.is_folder(doc) and path_to.startswith(path_from + '/'):
+            raise OSError(errno.EINVAL,
+                          'Cannot move %s in itself' % path_from)
+        if folder_to != '':
+            folder = self.metadata.get_entry(folder_to)
+            if folder is None:
+                raise OSError(errno.ENOENT, 'No folder at %s' % folder_to)
+            elif not pathindex.is_folder(folder):
+                raise OSError(errno.ENOTDIR,
+                              '%s is not a folder' % folder_to)
+        self._remove_target(doc, path_to)
+
+        docs = [dict(doc)]
+        if pathindex.is_folder(doc):
+            docs.extend(dbutils.get_subtree(self.db, path_from))
+        old_paths = dict([(entry['_id'], pathindex.get_full_path(entry))
+                          for entry in docs])
+
+        old_prefix = path_from.decode('utf-8')
+        new_prefix = path_to.decode('utf-8')
+        now = dbutils.get_current_date()
+
+        def move(entry):
+            if entry['_id'] == doc['_id']:
+                entry['path'] = folder_to.decode('utf-8')
+                entry['name'] = name_to
+                entry['lastModification'] = now
+            elif entry['path'] == old_prefix or \
+                    entry['path'].startswith(old_prefix + u'/'):
+                entry['path'] = new_prefix + entry['path'][len(old_prefix):]
+
+        (saved, failed) = dbutils.bulk_update(self.db, docs, move)
+        for entry in saved:
+            self.apply(entry, old_path=old_paths.get(entry['_id']))
+        self.touch_folders([folder_from, folder_to])
+
+        if len(failed) > 0:
+            raise OSError(errno.EIO, '%d documents not moved' % len(failed))
+
+    def apply(self, doc, deleted=False, old_path=None):
+        '''
+        Apply a document saved by this mount to the metadata, as the changes
+        feed will do later.
+        '''
+        if old_path is None:
+            old_path = pathindex.get_full_path(doc)
+        line = {'id': doc['_id'], 'doc': doc, 'deleted': deleted}
+        self.metadata.on_change(line)
+        # Without the path index, previous paths are not known by on_change.
+        self.metadata.evict(old_path)
+
+    def touch_folders(self, paths):
+        '''
+        Set last modification date of folders located at given paths, with a
+        single bulk request.
+        '''
+        docs = []
+        for path in set(paths):
+            doc = self.metadata.get_entry(path) if path != '' else None
+            if doc is not None:
+                docs.append(dict(doc))
+
+        now = dbutils.get_current_date()
+        (saved, failed) = dbutils.bulk_update(
+            self.db, docs, lambda doc: doc.update(lastModification=now))
+        for doc in saved:
+            self.apply(doc)
+
+    def _check_creatable(self, path, folder_path):
+        '''
+        Raise an error if something is located at given path or if its
+        parent folder doesn't exist.
+        '''
+        if self.metadata.get_entry(path) is not None:
+            raise OSError(errno.EEXIST, '%s already exists' % path)
+        if folder_path != '' and self.metadata.get_entry(folder_path) is None:
+            raise OSError(errno.ENOENT, 'No folder at %s' % folder_path)
+
+    def _remove_target(self, doc, path):
+        '''
+        Remove what is located at *path* to move given document there.
+        '''
+        target = self.metadata.get_entry(path)
+        if target is None:
+            return
+        elif pathindex.is_folder(doc) and not pathindex.is_folder(target):
+            raise OSError(errno.ENOTDIR, '%s is not a folder' % path)
+        elif not pathindex.is_folder(doc) and pathindex.is_folder(target):
+            raise OSError(errno.EISDIR, '%s is a folder' % path)
+        elif pathindex.is_folder(target):
+            self.remove_folder(path)
+        else:
+            self.remove_file(path)
+
+    def _delete(self, doc):
+        '''
+        Delete given document. When the document changed since it was read,
+        its latest revision is deleted.
+        '''
+        try:
+            self.db.delete(doc)
+        except ResourceConflict:
+            self.db.delete(self.db[doc['_id']])
+
+
+def split_path(path):
+    '''
+    Split a normalized path in its folder path and its name. The name is
+    returned as unicode, like in documents.
+    '''
+    (folder_path, name) = path.rsplit('/', 1)
+    return (folder_path, name.decode('utf-8'))
@@ -0,0 +1,224 @@
+import os
+import shutil
+import logging
+import tempfile
+import threading
+import mimetypes
+
+import dbutils
+import locks
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+
+class Staging:
+    '''
+    Local copies of files opened for writing. Writes go to a staging file in
+    the device folder, holes left by writes beyond the end stay sparse. The
+    staging file is uploaded as the file binary when the file is flushed or
+    released, so memory use doesn't depend on the file size.
+
+    Handles opened on the same path share the same staging file. When the
+    last one is released, the staging file becomes the cached binary.
+    '''
+
+    def __init__(self, db, binary_cache, folder, on_saved=None):
+        '''
+        Register the database, the binary cache and the staging folder.
+        *on_saved* is called with each file document saved after an upload.
+        Staging files left by a previous run are removed: without their
+        handle, nothing tells which file they belong to.
+        '''
+        self.db = db
+        self.binary_cache = binary_cache
+        self.folder = folder
+        self.on_saved = on_saved
+        self.handles = {}
+        self.locks = locks.KeyLocks()
+
+        if os.path.isdir(folder):
+            for filename in os.listdir(folder):
+                logger.warn('[Staging] Removing stale file %s' % filename)
+                os.remove(os.path.join(folder, filename))
+        else:
+            os.makedirs(folder)
+
+    def open(self, path, truncate=False):
+        '''
+        Return a handle to write file located at given path. Its current
+        content is copied to the staging file unless *truncate* is True.
+        '''
+        with self.locks.lock(path):
+            handle = self.handles.get(path)
+            if handle is None:
+                handle = WriteHandle(self, path)
+                try:
+                    handle.prepare(truncate)
+                except Exception:
+                    handle.close()
+                    raise
+                self.handles[path] = handle
+            elif truncate:
+                handle.truncate(0)
+            handle.users += 1
+            return handle
+
+    def truncate(self, path, size):
+        '''
+        Change size of file located at given path.
+        '''
+        handle = self.open(path)
+        try:
+            handle.truncate(size)
+        finally:
+            handle.release()
+
+    def release(self, handle):
+        '''
+        Upload content of given handle if it changed. When it was the last
+        user of the staging file, the staging file is moved to the cache.
+        '''
+        with self.locks.lock(handle.path):
+            handle.users -= 1
+            try:
+                handle.flush()
+            finally:
+                if handle.users == 0:
+                    self.handles.pop(handle.path, None)
+                    handle.close()
+
+    def upload(self, path, filename):
+        '''
+        Stream given staging file to the binary of file located at given
+        path, then update size, date and binary revision of the file.
+        '''
+        (file_doc, binary_id, cache_filename) = \
+            self.binary_cache.get_file_metadata(path)
+
+        binary = self.db[binary_id]
+        (mime_type, encoding) = mimetypes.guess_type(path)
+        with open(filename, 'rb') as content:
+            self.db.put_attachment(binary, content, filename='file',
+                                   content_type=mime_type)
+
+        # Previous content must not be read from the cache any more.
+        self.binary_cache.discard(path)
+
+        file_doc = self.db[file_doc['_id']]
+        file_doc['size'] = os.path.getsize(filename)
+        file_doc['lastModification'] = dbutils.get_current_date()
+        file_doc['binary']['file']['rev'] = binary['_rev']
+        # Staging file is moved to the cache when the file is released.
+        storage = file_doc.setdefault('storage', [])
+        if self.binary_cache.name not in storage:
+            storage.append(self.binary_cache.name)
+        self.db.save(file_doc)
+        logger.info('[Staging] %s uploaded' % path)
+
+        if self.on_saved is not None:
+            self.on_saved(file_doc)
+
+
+class WriteHandle:
+    '''
+    File opened for writing through the mount. Reads and writes are served
+    by the staging file.
+    '''
+
+    def __init__(self, staging, path):
+        '''
+        Register the staging area and the path of the opened file.
+        '''
+        self.staging = staging
+        self.path = path
+        self.users = 0
+        self.dirty = False
+        self.uploaded = False
+        self.filename = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def prepare(self, truncate):
+        '''
+        Create the staging file, filled with the current content of the file
+        unless it is truncated.
+        '''
+        (fd, self.filename) = tempfile.mkstemp(dir=self.staging.folder)
+        self._file = os.fdopen(fd, 'r+b')
+        if truncate:
+            self.dirty = True
+        else:
+            binary_cache = self.staging.binary_cache
+            binary_cache.add(self.path)
+            with binary_cache.get(self.path) as cached_file:
+                shutil.copyfileobj(cached_file, self._file)
+
+    def get_size(self):
+        '''
+        Return current size of the staging file, None once it's closed.
+        '''
+        with self._lock:
+            if self._file is None:
+                return None
+            self._file.flush()
+            return os.fstat(self._file.fileno()).st_size
+
+    def read(self, size, offset):
+        '''
+        Return *size* bytes of the staging file starting at *offset*.
+        '''
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(size)
+
+    def write(self, buf, offset):
+        '''
+        Write *buf* in the staging file at *offset*.
+        '''
+        with self._lock:
+            self._file.seek(offset)
+            self._file.write(buf)
+            self.dirty = True
+            return len(buf)
+
+    def truncate(self, size):
+        '''
+        Change size of the staging file.
+        '''
+        with self._lock:
+            self._file.truncate(size)
+            self.dirty = True
+
+    def flush(self):
+        '''
+        Upload the staging file if it changed since the last upload.
+        '''
+        with self._lock:
+            if self.dirty:
+                self._file.flush()
+                self.staging.upload(self.path, self.filename)
+                self.dirty = False
+                self.uploaded = True
+
+    def release(self):
+        '''
+        Release the handle: content is uploaded if needed.
+        '''
+        self.staging.release(self)
+
+    def close(self):
+        '''
+        Close the staging file. Once uploaded, it is moved to the cache so
+        the new content is not downloaded again.
+        '''
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.close()
+            self._file = None
+            if self.uploaded and not self.dirty:
+                self.staging.binary_cache.store(self.path, self.filename)
+            else:
+                os.remove(self.filename)
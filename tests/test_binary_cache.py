@@ -1,6 +1,10 @@
 import pytest
 import sys
 import os
+import httpretty
+import base64
+import hashlib
+import fcntl
 
 from uuid import uuid4
 
@@ -8,6 +12,7 @@ sys.path.append('..')
 
 import cozyfuse.local_config as local_config
 import cozyfuse.binarycache as binarycache
+import cozyfuse.pathindex as pathindex
 
 local_config.CONFIG_FOLDER = \
     os.path.join(os.path.expanduser('~'), '.cozyfuse-test')
@@ -101,3 +106,323 @@ def test_mark_file_as_stored():
     assert file_doc['storage'] == ['cozy-fuse-test']
     binary_cache.mark_file_as_not_stored(file_doc)
     assert file_doc['storage'] == []
+
+def test_download(tmpdir):
+    httpretty.enable()
+    url = 'http://localhost:5984/cozy-fuse-test/binary/file'
+    httpretty.register_uri(httpretty.GET, url, body='binary content')
+    filename = str(tmpdir.join('file'))
+    finished = []
+
+    download = binarycache.Download(url, filename, finished.append)
+    assert os.path.exists(download.part_filename)
+    assert download.part_filename.endswith('.part')
+    download.start()
+    download.wait()
+    assert finished == [download]
+    assert download.written == len('binary content')
+    assert open(filename).read() == 'binary content'
+    assert not os.path.exists(download.part_filename)
+    httpretty.disable()
+    httpretty.reset()
+
+def test_download_error(tmpdir):
+    httpretty.enable()
+    url = 'http://localhost:5984/cozy-fuse-test/binary/file'
+    httpretty.register_uri(httpretty.GET, url, status=404)
+    filename = str(tmpdir.join('file'))
+
+    download = binarycache.Download(url, filename)
+    download.start()
+    pytest.raises(IOError, download.wait)
+    assert not os.path.exists(filename)
+    assert not os.path.exists(download.part_filename)
+    httpretty.disable()
+    httpretty.reset()
+
+def test_download_by_other_process(tmpdir):
+    url = 'http://localhost:5984/cozy-fuse-test/binary/file'
+    filename = str(tmpdir.join('file'))
+    download = binarycache.Download(url, filename)
+
+    # Another process holds the lock while it downloads the binary.
+    lock_file = open(binarycache.get_lock_filename(filename), 'w')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    download.start()
+    download.join(0.1)
+    assert not download.done
+    with open(filename, 'w') as fd:
+        fd.write('binary content')
+    lock_file.close()
+
+    download.wait()
+    assert download.open().read() == 'binary content'
+    assert tmpdir.listdir(lambda path: path.ext == '.part') == []
+
+def test_remove_partial_files(tmpdir):
+    cache_path = tmpdir.mkdir('cache')
+    cache_path.mkdir('binary-1').join('file.a1b2.part').write('')
+    cache_path.mkdir('binary-2').join('file.c3d4.part').write('')
+    lock_file = open(str(cache_path.join('binary-2', 'file.lock')), 'w')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+    binarycache.BinaryCache(TESTDB, str(tmpdir), COUCH_URL, MOUNT_FOLDER)
+    assert not cache_path.join('binary-1', 'file.a1b2.part').exists()
+    assert cache_path.join('binary-2', 'file.c3d4.part').exists()
+    lock_file.close()
+
+def test_is_cached_size(tmpdir):
+    index = pathindex.PathIndex()
+    index.load([{
+        '_id': FILE_ID, 'docType': 'File', 'path': '', 'name': 'test.txt',
+        'size': 14, 'binary': {'file': {'id': BINARY_ID}},
+    }])
+    binary_cache = binarycache.BinaryCache(
+        TESTDB, str(tmpdir), COUCH_URL, MOUNT_FOLDER, index)
+    cache_file = tmpdir.join('cache').mkdir(BINARY_ID).join('file')
+    cache_file.write('binary content')
+    assert binary_cache.is_cached('/test.txt')
+
+    cache_file.write('binary')
+    assert not binary_cache.is_cached('/test.txt')
+    assert not cache_file.exists()
+
+def test_read_range_unsupported(tmpdir):
+    index = pathindex.PathIndex()
+    index.load([{
+        '_id': FILE_ID, 'docType': 'File', 'path': '', 'name': 'test.txt',
+        'binary': {'file': {'id': BINARY_ID}},
+    }])
+    binary_cache = binarycache.BinaryCache(
+        TESTDB, str(tmpdir), 'http://localhost:5984/cozy-fuse-test',
+        MOUNT_FOLDER, index)
+    requests = []
+
+    def answer(request, uri, headers):
+        requests.append(request.headers['Range'])
+        return (200, headers, 'binary content')
+
+    httpretty.enable()
+    url = 'http://localhost:5984/cozy-fuse-test/%s/file' % BINARY_ID
+    httpretty.register_uri(httpretty.GET, url, body=answer)
+    assert binary_cache.read_range('/test.txt', 2, 4) is None
+    assert binary_cache.read_range('/test.txt', 6, 4) is None
+    assert requests == ['bytes=2-5']
+    httpretty.disable()
+    httpretty.reset()
+
+class FakeDB:
+    def __init__(self, docs):
+        self.docs = dict([(doc['_id'], doc) for doc in docs])
+        self.saved = []
+
+    def __getitem__(self, doc_id):
+        return dict(self.docs[doc_id])
+
+    def save(self, doc):
+        self.saved.append(doc)
+
+    def update(self, docs):
+        self.saved.extend(docs)
+        return [(True, doc['_id'], '2-rev') for doc in docs]
+
+    def view(self, name, keys=None, include_docs=False):
+        return [Row(None, self.docs.get(key)) for key in keys]
+
+class Row:
+    def __init__(self, value, doc=None):
+        self.value = value
+        self.doc = doc
+
+def use_db(binary_cache, db):
+    binary_cache.db = db
+    binary_cache.storage.db = db
+    return db
+
+def test_evict(tmpdir):
+    docs = [{
+        '_id': 'file-%d' % number, 'docType': 'File', 'path': '',
+        'name': '%d.txt' % number, 'storage': [TESTDB],
+        'binary': {'file': {'id': 'binary-%d' % number}},
+    } for number in range(3)]
+    index = pathindex.PathIndex()
+    index.load(docs)
+    binary_cache = binarycache.BinaryCache(
+        TESTDB, str(tmpdir), COUCH_URL, MOUNT_FOLDER, index, max_files=2)
+    use_db(binary_cache, FakeDB(docs))
+    binary_cache.pins.add('binary-0')
+
+    for number in range(3):
+        filename = str(tmpdir.join('staged'))
+        with open(filename, 'w') as fd:
+            fd.write('content')
+        binary_cache.store('/%d.txt' % number, filename)
+        binary_cache.get('/%d.txt' % number).close()
+
+    assert binary_cache.is_cached('/0.txt')
+    assert not binary_cache.is_cached('/1.txt')
+    assert binary_cache.is_cached('/2.txt')
+    binary_cache.flush()
+    assert [doc['_id'] for doc in binary_cache.db.saved] == ['file-1']
+    assert binary_cache.db.saved[0]['storage'] == []
+    assert binary_cache.stats()['evictions'] == 1
+
+    # Accounting is read again from the cache folder.
+    binary_cache = binarycache.BinaryCache(
+        TESTDB, str(tmpdir), COUCH_URL, MOUNT_FOLDER, index, max_files=2)
+    assert len(binary_cache.accounting) == 2
+    assert binary_cache.accounting.size == 2 * len('content')
+
+def test_dedup(tmpdir):
+    digest = 'md5-' + base64.b64encode(hashlib.md5('binary content').digest())
+    docs = [{
+        '_id': 'file-%s' % name, 'docType': 'File', 'path': '',
+        'name': '%s.txt' % name,
+        'binary': {'file': {'id': 'binary-%s' % name}},
+    } for name in ['a', 'b']]
+    binaries = [{
+        '_id': 'binary-%s' % name, 'docType': 'Binary',
+        '_attachments': {'file': {'digest': digest}},
+    } for name in ['a', 'b']]
+    index = pathindex.PathIndex()
+    index.load(docs)
+    binary_cache = binarycache.BinaryCache(
+        TESTDB, str(tmpdir), 'http://localhost:5984/cozy-fuse-test',
+        MOUNT_FOLDER, index, dedup=True)
+    use_db(binary_cache, FakeDB(docs + binaries))
+    requests = []
+
+    def answer(request, uri, headers):
+        requests.append(uri)
+        return (200, headers, 'binary content')
+
+    httpretty.enable()
+    for name in ['a', 'b']:
+        url = 'http://localhost:5984/cozy-fuse-test/binary-%s/file' % name
+        httpretty.register_uri(httpretty.GET, url, body=answer)
+    binary_cache.add('/a.txt')
+    binary_cache.add('/b.txt')
+    httpretty.disable()
+    httpretty.reset()
+
+    assert len(requests) == 1
+    assert binary_cache.stats()['dedup_hits'] == 1
+    filename_a = binary_cache.get_file_metadata('/a.txt')[2]
+    filename_b = binary_cache.get_file_metadata('/b.txt')[2]
+    assert os.stat(filename_a).st_ino == os.stat(filename_b).st_ino
+    assert binary_cache.get('/b.txt').read() == 'binary content'
+    binary_cache.flush()
+    assert sorted([doc['_id'] for doc in binary_cache.db.saved]) == \
+        ['file-a', 'file-b']
+    assert [doc['storage'] for doc in binary_cache.db.saved] == \
+        [[TESTDB], [TESTDB]]
+
+    blob_filename = binary_cache._get_blob_filename(digest)
+    binary_cache.remove('/a.txt')
+    assert os.path.exists(blob_filename)
+    binary_cache.remove('/b.txt')
+    assert not os.path.exists(blob_filename)
+
+def test_read_blocks(tmpdir):
+    doc = {
+        '_id': FILE_ID, 'docType': 'File', 'path': '', 'name': 'test.txt',
+        'size': 14, 'binary': {'file': {'id': BINARY_ID}},
+    }
+    index = pathindex.PathIndex()
+    index.load([doc])
+    binary_cache = binarycache.BinaryCache(
+        TESTDB, str(tmpdir), COUCH_URL, MOUNT_FOLDER, index,
+        max_size=6, block_size=4)
+    use_db(binary_cache, FakeDB([doc]))
+    content = '0123456789abcd'
+    binary_cache._read_binary_range = \
+        lambda binary_id, offset, size: content[offset:offset + size]
+
+    block_file = binary_cache.get_blocks('/test.txt')
+    assert binary_cache.read_blocks('/test.txt', block_file, 2, 1) == '12'
+    assert binary_cache.read_blocks('/test.txt', block_file, 2, 12) == 'cd'
+    assert binary_cache.accounting.size == 6
+    assert not binary_cache.is_cached('/test.txt')
+
+    # Least recently used block is evicted beyond the quota.
+    assert binary_cache.read_blocks('/test.txt', block_file, 2, 5) == '56'
+    assert binary_cache.accounting.size == 6
+    assert binary_cache.stats()['evictions'] == 1
+
+    # Blocks become the cached binary once they are all read.
+    binary_cache.accounting.max_size = None
+    assert binary_cache.read_blocks('/test.txt', block_file, 14, 0) == content
+    assert binary_cache.is_cached('/test.txt')
+    assert binary_cache.accounting.size == 14
+    assert len(binary_cache.accounting) == 1
+    binary_cache.flush()
+    assert binary_cache.db.saved[-1]['storage'] == [TESTDB]
+    assert binary_cache.db.saved[-1]['size'] == 14
+    assert binary_cache.get_blocks('/test.txt') is None
+
+class FakeViewDB(FakeDB):
+    def __init__(self, docs):
+        FakeDB.__init__(self, docs)
+        self.queries = 0
+
+    def view(self, name, key):
+        self.queries += 1
+        return [Row(doc) for doc in self.docs.values()
+                if pathindex.get_full_path(doc) == key]
+
+def test_file_index(tmpdir):
+    doc = {
+        '_id': FILE_ID, 'docType': 'File', 'path': '', 'name': 'test.txt',
+        'binary': {'file': {'id': BINARY_ID}},
+    }
+    binary_cache = binarycache.BinaryCache(
+        TESTDB, str(tmpdir), COUCH_URL, MOUNT_FOLDER)
+    use_db(binary_cache, FakeViewDB([doc]))
+    assert binary_cache.get_file_metadata('/test.txt')[1] == BINARY_ID
+    assert binary_cache.db.queries == 1
+
+    # Another process finds it in the index without any query.
+    binary_cache = binarycache.BinaryCache(
+        TESTDB, str(tmpdir), COUCH_URL, MOUNT_FOLDER)
+    use_db(binary_cache, FakeViewDB([doc]))
+    assert binary_cache.get_file_metadata('/test.txt')[1] == BINARY_ID
+    assert binary_cache.db.queries == 0
+
+    binary_cache.on_change({'id': FILE_ID, 'deleted': True})
+    assert binary_cache.file_index.get('/test.txt') is None
+
+
+def test_repair(tmpdir):
+    doc = {
+        '_id': FILE_ID, 'docType': 'File', 'path': '', 'name': 'test.txt',
+        'binary': {'file': {'id': BINARY_ID}},
+    }
+    index = pathindex.PathIndex()
+    index.load([doc])
+    binary_cache = binarycache.BinaryCache(
+        TESTDB, str(tmpdir), COUCH_URL, MOUNT_FOLDER, index)
+    use_db(binary_cache, FakeDB([doc]))
+    binary_cache.file_index.update(doc)
+
+    httpretty.enable()
+    httpretty.register_uri(
+        httpretty.GET, '%s/%s/file' % (COUCH_URL, BINARY_ID),
+        body='binary content')
+    try:
+        binary_cache.add('/test.txt')
+        filename = binary_cache.get_file_metadata('/test.txt')[2]
+        assert binary_cache.get_cached_binaries() == [BINARY_ID]
+        stat = os.stat(filename)
+        with open(filename, 'wb') as fd:
+            fd.write('binary c0ntent')
+
+        # The file changed since it was checked, it's left alone.
+        assert binary_cache.repair(BINARY_ID, stat) is None
+
+        download = binary_cache.repair(BINARY_ID, os.stat(filename))
+        download.wait()
+    finally:
+        httpretty.disable()
+        httpretty.reset()
+
+    assert binary_cache.get('/test.txt').read() == 'binary content'
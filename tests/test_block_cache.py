@@ -0,0 +1,97 @@
+import pytest
+import sys
+import os
+
+sys.path.append('..')
+
+import cozyfuse.blockcache as blockcache
+
+CONTENT = '0123456789'
+
+
+class Fetcher:
+    '''
+    Serve ranges of CONTENT, recording requested ranges.
+    '''
+
+    def __init__(self, ranged=True):
+        self.ranged = ranged
+        self.ranges = []
+
+    def __call__(self, offset, size):
+        self.ranges.append((offset, size))
+        if not self.ranged:
+            return None
+        return CONTENT[offset:offset + size]
+
+
+def test_read(tmpdir):
+    fetch = Fetcher()
+    block_file = blockcache.BlockFile(str(tmpdir), 10, fetch, 4)
+    assert block_file.count == 3
+    assert os.path.getsize(block_file.filename) == 10
+
+    assert block_file.read(2, 5) == ('56', [(1, 4)])
+    assert fetch.ranges == [(4, 4)]
+    assert block_file.read(10, 0) == (CONTENT, [(0, 4), (2, 2)])
+    assert fetch.ranges == [(4, 4), (0, 4), (8, 2)]
+    assert block_file.is_complete()
+    assert block_file.read(4, 10) == ('', [])
+
+
+def test_read_runs(tmpdir):
+    fetch = Fetcher()
+    block_file = blockcache.BlockFile(str(tmpdir), 10, fetch, 2)
+    block_file.read(1, 4)
+    block_file.read(10, 0)
+    assert fetch.ranges == [(4, 2), (0, 4), (6, 4)]
+
+
+def test_read_unranged(tmpdir):
+    block_file = blockcache.BlockFile(str(tmpdir), 10, Fetcher(False), 4)
+    assert block_file.read(2, 5) == (None, [])
+    assert blockcache.get_blocks(blockcache.read_bitmap(str(tmpdir))) == []
+
+
+def test_bitmap_persisted(tmpdir):
+    block_file = blockcache.BlockFile(str(tmpdir), 10, Fetcher(), 4)
+    block_file.read(2, 5)
+
+    fetch = Fetcher()
+    block_file = blockcache.BlockFile(str(tmpdir), 10, fetch, 4)
+    assert block_file.read(2, 5) == ('56', [])
+    assert fetch.ranges == []
+
+    # Another size means another content, blocks are dropped.
+    block_file = blockcache.BlockFile(str(tmpdir), 8, fetch, 4)
+    assert blockcache.get_blocks(block_file.bitmap) == []
+
+
+def test_evict_block(tmpdir):
+    fetch = Fetcher()
+    block_file = blockcache.BlockFile(str(tmpdir), 10, fetch, 4)
+    block_file.read(10, 0)
+    block_file.evict_block(1)
+    assert not block_file.is_complete()
+    assert blockcache.get_blocks(blockcache.read_bitmap(str(tmpdir))) == [0, 2]
+    assert block_file.read(2, 5) == ('56', [(1, 4)])
+
+
+def test_promote(tmpdir):
+    block_file = blockcache.BlockFile(str(tmpdir), 10, Fetcher(), 4)
+    block_file.read(10, 0)
+    filename = str(tmpdir.join('file'))
+    block_file.promote(filename)
+    assert open(filename).read() == CONTENT
+    assert blockcache.read_bitmap(str(tmpdir)) is None
+    assert block_file.read(2, 5) == ('56', [])
+
+
+def test_bitmap():
+    bitmap = bytearray(2)
+    blockcache.set_block(bitmap, 0, True)
+    blockcache.set_block(bitmap, 9, True)
+    assert blockcache.get_blocks(bitmap) == [0, 9]
+    blockcache.set_block(bitmap, 0, False)
+    assert not blockcache.has_block(bitmap, 0)
+    assert blockcache.get_blocks(bitmap) == [9]
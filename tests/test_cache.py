@@ -28,3 +28,10 @@ def test_invalidity():
     assert local_cache.get('test') == 42
     time.sleep(1)
     assert local_cache.get('test') is None
+
+def test_no_validity_period():
+    local_cache = cache.Cache(None)
+    local_cache.add('test', 42)
+    assert local_cache.get('test') == 42
+    local_cache.remove('test')
+    assert local_cache.get('test') is None
@@ -2,6 +2,7 @@ import pytest
 import sys
 import os
 import requests
+import httpretty
 
 sys.path.append('..')
 
@@ -126,3 +127,103 @@ def test_remove_db_user():
 
 def test_clear_config():
     local_config.clear()
+
+
+class Row:
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeDB(dict):
+    '''
+    Database storing design documents, answering entry view with given
+    documents.
+    '''
+
+    def __init__(self, docs=[]):
+        dict.__init__(self)
+        self.docs = docs
+        self.keys_queried = []
+
+    def view(self, name, key):
+        self.keys_queried.append(key)
+        return [Row(doc) for doc in self.docs
+                if doc['path'] + '/' + doc['name'] == key]
+
+
+def test_get_entry():
+    folder = {'docType': 'Folder', 'path': '', 'name': 'photos'}
+    db = FakeDB([folder])
+    assert dbutils.get_entry(db, 'photos') == folder
+    assert dbutils.get_entry(db, '/videos') is None
+    assert db.keys_queried == ['/photos', '/videos']
+
+
+def test_init_entry_view():
+    db = FakeDB()
+    dbutils.init_entry_view(db)
+    assert 'byFullPath' in db['_design/entry']['views']
+
+
+def test_migrate_database_views(monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(dbutils, 'get_db', lambda database: db)
+    dbutils.migrate_database_views(TESTDB)
+    assert '_design/entry' in db
+
+    db['_design/entry'] = 'existing'
+    dbutils.migrate_database_views(TESTDB)
+    assert db['_design/entry'] == 'existing'
+
+
+def test_migrate_database_views_unreachable(monkeypatch):
+    monkeypatch.setattr(dbutils, 'get_db', lambda database: None)
+    dbutils.migrate_database_views(TESTDB)
+
+
+def test_get_client(monkeypatch):
+    monkeypatch.setattr(local_config, 'get_db_credentials',
+                        lambda name: ('login', 'password'))
+    client = dbutils.get_client('device')
+    assert dbutils.get_client('device') is client
+    assert dbutils.get_client() is not client
+    assert client.server.resource.credentials == ('login', 'password')
+    assert dbutils.get_client().server.resource.credentials is None
+
+    dbutils.remove_client('device')
+    assert dbutils.get_client('device') is not client
+    dbutils.remove_client('device')
+
+
+def test_client_get_db():
+    checks = []
+
+    def head(request, uri, headers):
+        checks.append(uri)
+        return (200, headers, '')
+
+    httpretty.enable()
+    httpretty.register_uri(httpretty.HEAD, 'http://localhost:5984/devicedb',
+                           body=head)
+    try:
+        client = dbutils.Client()
+        db = client.get_db('devicedb')
+        assert client.get_db('devicedb') is db
+        assert len(checks) == 1
+
+        client.forget_db('devicedb')
+        client.get_db('devicedb')
+        assert len(checks) == 2
+    finally:
+        httpretty.disable()
+        httpretty.reset()
+
+
+def test_client_request(monkeypatch):
+    client = dbutils.Client()
+    calls = []
+    monkeypatch.setattr(client.session, 'request',
+                        lambda method, url, **kwargs: calls.append(kwargs))
+    client.request('GET', 'http://localhost:5984/_active_tasks')
+    client.request('GET', 'http://localhost:5984/_active_tasks', timeout=2)
+    assert calls == [{'timeout': dbutils.HTTP_TIMEOUT}, {'timeout': 2}]
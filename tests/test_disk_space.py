@@ -0,0 +1,89 @@
+import pytest
+import sys
+import os
+import httpretty
+
+sys.path.append('..')
+
+import cozyfuse.local_config as local_config
+local_config.CONFIG_FOLDER = \
+    os.path.join(os.path.expanduser('~'), '.cozyfuse-test')
+
+local_config.CONFIG_PATH = \
+    os.path.join(local_config.CONFIG_FOLDER, 'config.yaml')
+
+import cozyfuse.dbutils as dbutils
+import cozyfuse.diskspace as diskspace
+
+URL = 'https://localhost:2223'
+DISK_SPACE = {
+    'freeDiskSpace': 10,
+    'usedDiskSpace': 5,
+    'totalDiskSpace': 15,
+}
+
+
+class Row:
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeDB:
+    '''
+    Database containing a single device document.
+    '''
+
+    def __init__(self, device):
+        self.device = device
+        self.saved = 0
+
+    def view(self, name):
+        return [Row(self.device)]
+
+    def save(self, doc):
+        self.saved += 1
+
+
+def test_stored_disk_space():
+    db = FakeDB({'docType': 'Device'})
+    assert dbutils.get_stored_disk_space(db) == dbutils.DEFAULT_DISK_SPACE
+    db.device['diskSpace'] = DISK_SPACE
+    assert dbutils.get_stored_disk_space(db) == DISK_SPACE
+
+
+def test_store_disk_space():
+    db = FakeDB({'docType': 'Device'})
+    assert dbutils.store_disk_space(db, DISK_SPACE)
+    assert db.saved == 1
+    assert not dbutils.store_disk_space(db, dict(DISK_SPACE))
+    assert db.saved == 1
+
+
+def test_refresh():
+    httpretty.enable()
+    httpretty.register_uri(httpretty.GET, URL + '/disk-space',
+                           body='{"diskSpace": {"freeDiskSpace": 10, '
+                                '"usedDiskSpace": 5, "totalDiskSpace": 15}}')
+    db = FakeDB({'docType': 'Device'})
+    monitor = diskspace.DiskSpaceMonitor(db, URL, 'device', 'password')
+    assert monitor.disk_space == dbutils.DEFAULT_DISK_SPACE
+
+    monitor.refresh()
+    assert monitor.disk_space == DISK_SPACE
+    assert db.saved == 1
+    monitor.refresh()
+    assert db.saved == 1
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_refresh_offline():
+    httpretty.enable()
+    httpretty.register_uri(httpretty.GET, URL + '/disk-space', status=502)
+    db = FakeDB({'docType': 'Device', 'diskSpace': DISK_SPACE})
+    monitor = diskspace.DiskSpaceMonitor(db, URL, 'device', 'password')
+    monitor.refresh()
+    assert monitor.disk_space == DISK_SPACE
+    assert db.saved == 0
+    httpretty.disable()
+    httpretty.reset()
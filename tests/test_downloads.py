@@ -0,0 +1,58 @@
+import pytest
+import sys
+import httpretty
+
+sys.path.append('..')
+
+import cozyfuse.downloads as downloads
+
+URL = 'http://localhost:5984/cozy-fuse-test/binary/file'
+
+
+@pytest.fixture
+def server(request):
+    httpretty.enable()
+
+    def fin():
+        httpretty.disable()
+        httpretty.reset()
+    request.addfinalizer(fin)
+
+
+def test_fetch(server, tmpdir):
+    content = 'binary content' * 100
+    httpretty.register_uri(httpretty.GET, URL, body=content)
+    engine = downloads.DownloadEngine(buffer_size=512)
+    sizes = []
+
+    with open(str(tmpdir.join('file')), 'wb') as fd:
+        assert engine.fetch(URL, fd, sizes.append) == len(content)
+    assert tmpdir.join('file').read() == content
+    assert sum(sizes) == len(content)
+    assert max(sizes) <= 512
+
+    stats = engine.stats()
+    assert stats['downloads'] == 1
+    assert stats['errors'] == 0
+    assert stats['bytes'] == len(content)
+
+
+def test_fetch_error(server, tmpdir):
+    httpretty.register_uri(httpretty.GET, URL, status=404)
+    engine = downloads.DownloadEngine()
+    with open(str(tmpdir.join('file')), 'wb') as fd:
+        pytest.raises(IOError, engine.fetch, URL, fd)
+    assert engine.stats()['errors'] == 1
+
+
+def test_buffers_reused(server, tmpdir):
+    httpretty.register_uri(httpretty.GET, URL, body='binary content')
+    engine = downloads.DownloadEngine(fsync=downloads.FSYNC_ALWAYS)
+    for i in range(3):
+        with open(str(tmpdir.join('file')), 'wb') as fd:
+            engine.fetch(URL, fd)
+    assert len(engine._buffers) == 1
+
+
+def test_fsync_policy():
+    pytest.raises(ValueError, downloads.DownloadEngine, fsync='sometimes')
@@ -0,0 +1,84 @@
+import pytest
+import sys
+import os
+
+sys.path.append('..')
+
+import cozyfuse.eviction as eviction
+
+
+def test_no_quota():
+    accounting = eviction.CacheAccounting()
+    accounting.add('binary-1', 100, 'file-1')
+    accounting.add('binary-2', 100, 'file-2')
+    assert accounting.size == 200
+    assert len(accounting) == 2
+    assert accounting.get_victims() == []
+
+
+def test_victims_by_size():
+    accounting = eviction.CacheAccounting(max_size=250)
+    accounting.add('binary-1', 100, 'file-1')
+    accounting.add('binary-2', 100, 'file-2')
+    accounting.add('binary-3', 100, 'file-3')
+    assert accounting.get_victims() == [('binary-1', 'file-1')]
+
+    accounting.touch('binary-1')
+    assert accounting.get_victims() == [('binary-2', 'file-2')]
+
+
+def test_victims_by_count():
+    accounting = eviction.CacheAccounting(max_files=1)
+    accounting.add('binary-1', 100, 'file-1')
+    accounting.add('binary-2', 100, 'file-2')
+    accounting.add('binary-3', 100, 'file-3')
+    assert accounting.get_victims() == [
+        ('binary-1', 'file-1'), ('binary-2', 'file-2')]
+
+    accounting.remove('binary-1')
+    assert accounting.size == 200
+    assert accounting.get_victims() == [('binary-2', 'file-2')]
+
+
+def test_victims_pinned():
+    accounting = eviction.CacheAccounting(max_files=1)
+    accounting.add('binary-1', 100, 'file-1')
+    accounting.add('binary-2', 100, 'file-2')
+    accounting.add('binary-3', 100, 'file-3')
+    assert accounting.get_victims(set(['binary-1'])) == [
+        ('binary-2', 'file-2')]
+
+
+def test_last_used_kept():
+    accounting = eviction.CacheAccounting(max_size=50)
+    accounting.add('binary-1', 100, 'file-1')
+    accounting.add('binary-2', 100, 'file-2')
+    assert accounting.get_victims() == [('binary-1', 'file-1')]
+
+
+def test_add_again():
+    accounting = eviction.CacheAccounting()
+    accounting.add('binary-1', 100, 'file-1')
+    accounting.add('binary-1', 50, 'file-1')
+    assert accounting.size == 50
+    assert len(accounting) == 1
+
+
+def test_pins(tmpdir):
+    filename = str(tmpdir.join('pinned'))
+    pins = eviction.Pins(filename)
+    assert pins.get() == set()
+
+    pins.add('binary-1')
+    pins.add('binary-2')
+    assert eviction.Pins(filename).get() == set(['binary-1', 'binary-2'])
+
+    pins.remove('binary-1')
+    assert eviction.Pins(filename).get() == set(['binary-2'])
+    assert not os.path.exists(filename + '.tmp')
+
+    # Unchanged pins are not written again.
+    inode = os.stat(filename).st_ino
+    pins.add('binary-2')
+    pins.remove('binary-1')
+    assert os.stat(filename).st_ino == inode
@@ -0,0 +1,206 @@
+import pytest
+import sys
+
+sys.path.append('..')
+
+import cozyfuse.filehandle as filehandle
+import cozyfuse.readahead as readahead
+
+
+class FakeBinaryCache:
+    '''
+    Binary cache serving a local file, counting how many times the file is
+    opened.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.added = False
+        self.opened = 0
+
+    def is_cached(self, path):
+        return self.added
+
+    def start_download(self, path):
+        self.added = True
+        return None
+
+    def get_blocks(self, path):
+        return None
+
+    def get(self, path):
+        self.opened += 1
+        return open(self.filename, 'rb')
+
+
+@pytest.fixture
+def binary_cache(tmpdir):
+    filename = tmpdir.join('file')
+    filename.write('0123456789')
+    return FakeBinaryCache(str(filename))
+
+
+def test_read(binary_cache):
+    fh = filehandle.FileHandle('/test.txt', binary_cache)
+    assert fh.read(4, 0) == '0123'
+    assert fh.read(4, 4) == '4567'
+    assert fh.read(4, 8) == '89'
+    assert fh.read(4, 10) == ''
+    assert binary_cache.added
+    assert binary_cache.opened == 1
+
+
+def test_release(binary_cache):
+    fh = filehandle.FileHandle('/test.txt', binary_cache)
+    assert fh.read(2, 0) == '01'
+    fh.release()
+    assert fh.read(2, 2) == '23'
+    assert binary_cache.opened == 2
+    fh.release()
+
+
+def test_read_mmap(binary_cache):
+    fh = filehandle.FileHandle('/test.txt', binary_cache, use_mmap=True)
+    assert fh.read(4, 0) == '0123'
+    assert fh.read(4, 8) == '89'
+    assert fh.read(4, 10) == ''
+    fh.release()
+
+
+def test_read_mmap_empty_file(binary_cache, tmpdir):
+    filename = tmpdir.join('empty')
+    filename.write('')
+    binary_cache.filename = str(filename)
+    fh = filehandle.FileHandle('/empty.txt', binary_cache, use_mmap=True)
+    assert fh.read(4, 0) == ''
+    fh.release()
+
+
+class FakeDownload:
+    '''
+    Download whose progress is set by the test.
+    '''
+
+    def __init__(self, filename, written):
+        self.filename = filename
+        self.written = written
+        self.done = False
+
+    def open(self):
+        return open(self.filename, 'rb')
+
+    def wait_for(self, end):
+        if end > self.written:
+            self.written = end
+            self.done = True
+
+
+class FakeDownloadingCache(FakeBinaryCache):
+    '''
+    Binary cache where the file is being downloaded.
+    '''
+
+    def __init__(self, filename, written):
+        FakeBinaryCache.__init__(self, filename)
+        self.download = FakeDownload(filename, written)
+        self.ranges = []
+
+    def start_download(self, path):
+        return self.download
+
+    def read_range(self, path, offset, size):
+        self.ranges.append((offset, size))
+        return 'r' * size
+
+
+def test_read_downloading(binary_cache):
+    cache = FakeDownloadingCache(binary_cache.filename, 4)
+    fh = filehandle.FileHandle('/test.txt', cache)
+    assert fh.read(2, 0) == '01'
+    assert not cache.download.done
+    assert fh.read(4, 4) == '4567'
+    assert cache.download.done
+    assert fh.read(4, 8) == '89'
+    assert cache.ranges == []
+    fh.release()
+
+
+def test_read_downloading_far_offset(binary_cache):
+    cache = FakeDownloadingCache(binary_cache.filename, 0)
+    fh = filehandle.FileHandle('/test.txt', cache)
+    offset = filehandle.STREAM_WINDOW + 1
+    assert fh.read(4, offset) == 'rrrr'
+    assert cache.ranges == [(offset, 4)]
+    fh.release()
+
+
+def test_read_downloading_read_ahead(binary_cache, monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(readahead.time, 'time', lambda: now[0])
+    cache = FakeDownloadingCache(binary_cache.filename, 0)
+    fh = filehandle.FileHandle('/test.txt', cache)
+    offset = filehandle.STREAM_WINDOW + 1
+    fh.read(4, offset)
+    now[0] += 1
+    fh.read(4, offset + 4)
+    assert cache.ranges[-1] == (offset + 4, readahead.MIN_WINDOW)
+    assert fh.read(4, offset + 8) == 'rrrr'
+    assert len(cache.ranges) == 2
+
+
+def test_sequential_end(binary_cache):
+    ends = []
+    fh = filehandle.FileHandle('/test.txt', binary_cache,
+                               on_sequential_end=ends.append)
+    fh.read(2, 5)
+    assert ends == []
+    fh.read(2, 7)
+    fh.read(2, 9)
+    assert ends == ['/test.txt']
+    fh.release()
+
+
+def test_read_downloading_mmap(binary_cache):
+    cache = FakeDownloadingCache(binary_cache.filename, 4)
+    fh = filehandle.FileHandle('/test.txt', cache, use_mmap=True)
+    assert fh.read(2, 0) == '01'
+    assert fh._map is None
+    assert fh.read(4, 4) == '4567'
+    assert fh._map is not None
+    assert fh.read(4, 8) == '89'
+    fh.release()
+
+
+class FakeBlocks:
+    size = 10
+
+
+class FakeBlockCache(FakeBinaryCache):
+    '''
+    Binary cache in block mode, ranges can be read until *ranged* is unset.
+    '''
+
+    def __init__(self, filename):
+        FakeBinaryCache.__init__(self, filename)
+        self.ranged = True
+
+    def get_blocks(self, path):
+        return FakeBlocks()
+
+    def read_blocks(self, path, blocks, size, offset):
+        if self.ranged:
+            return 'b' * size
+        return None
+
+
+def test_read_blocks(binary_cache):
+    cache = FakeBlockCache(binary_cache.filename)
+    fh = filehandle.FileHandle('/test.txt', cache)
+    assert fh.read(4, 2) == 'bbbb'
+    assert cache.opened == 0
+
+    # Falls back to the download when ranges can't be read.
+    cache.ranged = False
+    assert fh.read(4, 2) == '2345'
+    assert cache.opened == 1
+    fh.release()
@@ -0,0 +1,78 @@
+import pytest
+import sys
+
+sys.path.append('..')
+
+import cozyfuse.fileindex as fileindex
+
+
+FILE = {
+    '_id': 'file-id',
+    'docType': 'File',
+    'path': u'/photos',
+    'name': u'\xe9t\xe9.jpg',
+    'size': 12,
+    'binary': {'file': {'id': 'binary-id', 'rev': '1-a'}},
+}
+PATH = '/photos/\xc3\xa9t\xc3\xa9.jpg'
+
+
+@pytest.fixture
+def index(tmpdir):
+    return fileindex.FileIndex(str(tmpdir.join('files.sqlite')))
+
+
+def test_get(index):
+    assert index.get(PATH) is None
+    index.update(FILE)
+    assert index.get(PATH) == FILE
+    assert index.get_state('binary-id') == {
+        'cached': 0, 'size': 12, 'last_access': None, 'digest': None}
+
+
+def test_persisted(tmpdir, index):
+    index.update(FILE)
+    index.close()
+    index = fileindex.FileIndex(str(tmpdir.join('files.sqlite')))
+    assert index.get(PATH) == FILE
+
+
+def test_rename(index):
+    index.update(FILE)
+    index.set_cached('binary-id', True)
+    index.set_digest('binary-id', 'md5-abc')
+    index.update(dict(FILE, path=u'/archives'))
+    assert index.get(PATH) is None
+    assert index.get('/archives/\xc3\xa9t\xc3\xa9.jpg')['path'] == \
+        u'/archives'
+    state = index.get_state('binary-id')
+    assert state['cached'] == 1
+    assert state['digest'] == 'md5-abc'
+
+
+def test_new_binary_revision(index):
+    index.update(FILE)
+    index.set_cached('binary-id', True)
+    index.set_digest('binary-id', 'md5-abc')
+    index.update(dict(FILE, binary={
+        'file': {'id': 'binary-id', 'rev': '2-b'}}))
+    state = index.get_state('binary-id')
+    assert state['cached'] == 1
+    assert state['digest'] is None
+
+
+def test_on_change(index):
+    index.on_change({'id': 'file-id', 'doc': FILE})
+    index.on_change({'id': 'folder-id', 'doc': {
+        '_id': 'folder-id', 'docType': 'Folder', 'path': '', 'name': 'a'}})
+    assert index.get(PATH) == FILE
+    assert index.get('/a') is None
+    index.on_change({'id': 'file-id', 'deleted': True,
+                     'doc': {'_id': 'file-id', '_deleted': True}})
+    assert index.get(PATH) is None
+
+
+def test_touch(index):
+    index.update(FILE)
+    index.touch('binary-id')
+    assert index.get_state('binary-id')['last_access'] is not None
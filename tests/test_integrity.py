@@ -0,0 +1,111 @@
+import sys
+import os
+import json
+import base64
+import hashlib
+
+sys.path.append('..')
+
+import cozyfuse.integrity as integrity
+
+
+class FakeBinaryCache:
+    '''
+    Binary cache storing given contents, with the digest of the expected
+    contents, and recording repaired binaries.
+    '''
+
+    def __init__(self, folder, contents, expected):
+        self.cache_path = folder
+        self.digests = {}
+        self.repaired = []
+        for (binary_id, content) in contents.items():
+            os.mkdir(os.path.join(folder, binary_id))
+            with open(os.path.join(folder, binary_id, 'file'), 'wb') as fd:
+                fd.write(content)
+            self.digests[binary_id] = 'md5-' + base64.b64encode(
+                hashlib.md5(expected.get(binary_id, content)).digest())
+
+    def get_cached_binaries(self):
+        return sorted(self.digests)
+
+    def get_digest(self, binary_id):
+        return self.digests[binary_id]
+
+    def repair(self, binary_id, stat=None):
+        self.repaired.append(binary_id)
+
+
+def test_throttle():
+    throttle = integrity.Throttle(100)
+    assert throttle.reserve(50) == 0
+    assert 0.4 < throttle.reserve(50) <= 0.5
+    assert 0.9 < throttle.reserve(50) <= 1
+
+
+def test_verify(tmpdir):
+    binary_cache = FakeBinaryCache(
+        str(tmpdir.mkdir('cache')),
+        {'good': 'content', 'bad': 'truncat'},
+        {'bad': 'truncated'})
+    binary_cache.digests['unknown'] = None
+    verifier = integrity.IntegrityVerifier(
+        binary_cache, str(tmpdir.join('integrity.json')), rate=1024 * 1024)
+    assert verifier.verify('good') is True
+    assert verifier.verify('bad') is False
+    assert verifier.verify('unknown') is None
+    assert binary_cache.repaired == ['bad']
+    assert verifier.stats() == {
+        'verified': 1, 'corrupt': 1, 'skipped': 1, 'bytes': 14}
+
+
+def test_verify_all(tmpdir):
+    state_filename = str(tmpdir.join('integrity.json'))
+    binary_cache = FakeBinaryCache(
+        str(tmpdir.mkdir('cache')),
+        dict(('binary-%d' % index, 'content %d' % index)
+             for index in range(5)),
+        {'binary-3': 'other content'})
+    verifier = integrity.IntegrityVerifier(
+        binary_cache, state_filename, rate=1024 * 1024)
+    verifier.verify_all()
+    assert verifier.stats()['verified'] == 4
+    assert binary_cache.repaired == ['binary-3']
+    with open(state_filename) as fd:
+        state = json.load(fd)
+    assert state['verified'] == {}
+    assert state['last_pass'] is not None
+    assert verifier._get_delay() > 0
+
+
+def test_resume(tmpdir):
+    state_filename = str(tmpdir.join('integrity.json'))
+    binary_cache = FakeBinaryCache(
+        str(tmpdir.mkdir('cache')),
+        dict(('binary-%d' % index, 'content %d' % index)
+             for index in range(3)),
+        {})
+    stat = os.stat(os.path.join(binary_cache.cache_path, 'binary-0', 'file'))
+    with open(state_filename, 'w') as fd:
+        json.dump({'last_pass': None,
+                   'verified': {'binary-0': [stat.st_size, stat.st_mtime]}},
+                  fd)
+
+    verifier = integrity.IntegrityVerifier(
+        binary_cache, state_filename, rate=1024 * 1024)
+    assert verifier._get_delay() == 0
+    verifier.verify_all()
+    assert verifier.stats()['verified'] == 2
+
+
+def test_stop(tmpdir):
+    binary_cache = FakeBinaryCache(
+        str(tmpdir.mkdir('cache')), {'binary': 'content'}, {})
+    verifier = integrity.IntegrityVerifier(
+        binary_cache, str(tmpdir.join('integrity.json')), rate=1)
+    verifier.throttle.reserve(1000)
+    verifier.start()
+    verifier.stop()
+    verifier.join(5)
+    assert not verifier.is_alive()
+    assert verifier.stats()['verified'] == 0
@@ -62,6 +62,16 @@ def test_set_get_device_config(config_file):
     assert res == local_config.get_device_config('test-device')
 
 
+def test_get_option(config_file):
+    assert local_config.get_option('test-device', 'url') == \
+        'https://localhost:2223'
+    assert local_config.get_option('test-device', 'multithreaded') is None
+    assert local_config.get_option('test-device', 'multithreaded', True)
+    pytest.raises(local_config.NoConfigFound,
+                  local_config.get_option,
+                  'test-no-device', 'url')
+
+
 def test_no_config(config_file):
     pytest.raises(local_config.NoConfigFound,
                   local_config.get_config,
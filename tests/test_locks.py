@@ -0,0 +1,39 @@
+import pytest
+import sys
+import time
+import threading
+
+sys.path.append('..')
+
+import cozyfuse.locks as locks
+
+
+def test_lock():
+    key_locks = locks.KeyLocks()
+    with key_locks.lock('/test'):
+        assert '/test' in key_locks._locks
+        with key_locks.lock('/other'):
+            pass
+    assert key_locks._locks == {}
+
+
+def test_lock_exclusion():
+    key_locks = locks.KeyLocks()
+    events = []
+
+    def worker(name):
+        with key_locks.lock('/test'):
+            events.append('start %s' % name)
+            time.sleep(0.05)
+            events.append('end %s' % name)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(events) == 6
+    for i in range(0, 6, 2):
+        assert events[i].split()[1] == events[i + 1].split()[1]
+    assert key_locks._locks == {}
@@ -0,0 +1,96 @@
+import pytest
+import sys
+import logging
+
+sys.path.append('..')
+
+import cozyfuse.logs as logs
+
+
+class ListHandler(logging.Handler):
+    '''
+    Handler storing formatted records.
+    '''
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+
+def get_logger(name, handler):
+    logger = logging.getLogger(name)
+    logger.handlers = [handler]
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    return logger
+
+
+def test_queue_handler():
+    target = ListHandler()
+    handler = logs.QueueHandler(target)
+    handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+    logger = get_logger('test-queue-handler', handler)
+
+    logger.info('read %s', '/test.txt')
+    try:
+        raise ValueError('wrong value')
+    except ValueError:
+        logger.exception('failure')
+    handler.close()
+
+    assert target.messages[0] == 'INFO read /test.txt'
+    assert target.messages[1].startswith('ERROR failure\n')
+    assert 'ValueError: wrong value' in target.messages[1]
+
+
+def test_queue_handler_full():
+    target = ListHandler()
+    handler = logs.QueueHandler(target, queue_size=1)
+    handler._ensure_thread()
+    handler._queue.put(None)
+    handler._thread.join()
+    logger = get_logger('test-queue-handler-full', handler)
+
+    logger.info('first')
+    logger.info('second')
+    assert handler.dropped == 1
+
+
+def test_operation_logger_levels():
+    target = ListHandler()
+    logger = get_logger('test-operation-levels', target)
+    op_logger = logs.OperationLogger(logger, {'read': 'debug',
+                                              'open': logging.WARNING})
+    op_logger.log('read', '/test.txt')
+    op_logger.log('open', '/test.txt')
+    op_logger.log('getattr', '/test.txt')
+    assert target.messages == ['open /test.txt', 'getattr /test.txt']
+
+
+def test_operation_logger_sampling():
+    target = ListHandler()
+    logger = get_logger('test-operation-sampling', target)
+    op_logger = logs.OperationLogger(logger, sampling={'getattr': 10})
+    for i in range(25):
+        op_logger.log('getattr', '/%s' % i)
+    assert target.messages == ['getattr /0', 'getattr /10', 'getattr /20']
+
+
+def test_operation_logger_unknown_level():
+    logger = get_logger('test-operation-unknown', ListHandler())
+    with pytest.raises(ValueError):
+        logs.OperationLogger(logger, {'read': 'verbose'})
+
+
+def test_queue_handler_flush():
+    target = ListHandler()
+    handler = logs.QueueHandler(target)
+    logger = get_logger('test-queue-handler-flush', handler)
+    for i in range(100):
+        logger.info('line %s', i)
+    handler.flush()
+    assert len(target.messages) == 100
+    handler.close()
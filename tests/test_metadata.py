@@ -0,0 +1,177 @@
+import pytest
+import sys
+
+sys.path.append('..')
+
+import cozyfuse.metadata as metadata
+import cozyfuse.pathindex as pathindex
+
+
+FOLDER = {
+    '_id': 'folder-id',
+    'docType': 'Folder',
+    'path': '',
+    'name': 'photos',
+}
+
+FILE = {
+    '_id': 'file-id',
+    'docType': 'File',
+    'path': '/photos',
+    'name': 'beach.jpg',
+}
+
+
+def get_stat(doc):
+    return doc.get('name', '')
+
+
+def get_metadata():
+    index = pathindex.PathIndex()
+    index.load([FOLDER, FILE])
+    evicted = []
+    return (metadata.Metadata(None, index, get_stat, evicted.append),
+            evicted)
+
+
+def test_get_attr():
+    (meta, evicted) = get_metadata()
+    assert meta.get_attr('') == ''
+    assert meta.get_attr('/photos/beach.jpg') == 'beach.jpg'
+    assert meta.attr_cache.get('/photos/beach.jpg') == 'beach.jpg'
+
+
+def test_list():
+    (meta, evicted) = get_metadata()
+    assert meta.list('/photos') == [FILE]
+    assert meta.attr_cache.get('/photos/beach.jpg') == 'beach.jpg'
+
+
+def test_on_change_rename():
+    (meta, evicted) = get_metadata()
+    meta.get_attr('/photos/beach.jpg')
+    meta.get_attr('/sea.jpg')
+    meta.readdir_file_cache.add('/photos', ['listing'])
+    meta.readdir_file_cache.add('', ['listing'])
+
+    renamed = dict(FILE, path='', name='sea.jpg')
+    meta.on_change({'id': 'file-id', 'doc': renamed})
+
+    assert meta.generation == 1
+    assert sorted(evicted) == ['/photos/beach.jpg', '/sea.jpg']
+    assert meta.attr_cache.get('/photos/beach.jpg') is None
+    assert meta.missing_cache.get('/sea.jpg') is None
+    assert meta.readdir_file_cache.get('/photos') is None
+    assert meta.readdir_file_cache.get('') is None
+    assert meta.get_attr('/sea.jpg') == 'sea.jpg'
+    assert meta.get_attr('/photos/beach.jpg') is None
+
+
+def test_on_change_delete():
+    (meta, evicted) = get_metadata()
+    meta.get_attr('/photos/beach.jpg')
+    meta.on_change({'id': 'file-id', 'deleted': True})
+    assert evicted == ['/photos/beach.jpg']
+    assert meta.get_attr('/photos/beach.jpg') is None
+    assert meta.list('/photos') == []
+
+
+def test_on_change_during_read():
+    (meta, evicted) = get_metadata()
+    created = dict(FILE, _id='new-id', name='new.jpg')
+    get_entry = meta.get_entry
+
+    def get_entry_during_change(path):
+        # A change arrives while the document is read.
+        doc = get_entry(path)
+        meta.on_change({'id': 'new-id', 'doc': created})
+        return doc
+
+    meta.get_entry = get_entry_during_change
+    assert meta.get_attr('/photos/new.jpg') is None
+    assert meta.missing_cache.get('/photos/new.jpg') is None
+    meta.get_entry = get_entry
+    assert meta.get_attr('/photos/new.jpg') == 'new.jpg'
+
+
+def test_list_during_change():
+    (meta, evicted) = get_metadata()
+    list_docs = meta.path_index.list
+
+    def list_during_change(path):
+        docs = list_docs(path)
+        meta.on_change({'id': 'file-id', 'deleted': True})
+        return docs
+
+    meta.path_index.list = list_during_change
+    assert meta.list('/photos') == [FILE]
+    assert meta.attr_cache.get('/photos/beach.jpg') is None
+
+
+class Row:
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeDB:
+    '''
+    Database answering entry and listing views, counting queries.
+    '''
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.queries = 0
+
+    def view(self, name, key):
+        self.queries += 1
+        if name == 'entry/byFullPath':
+            return [Row(doc) for doc in self.docs
+                    if pathindex.get_full_path(doc) == key]
+        doc_type = name.split('/')[0].capitalize()
+        return [Row(doc) for doc in self.docs
+                if doc['docType'] == doc_type and doc['path'] == key]
+
+
+def test_missing_path():
+    (meta, evicted) = get_metadata()
+    assert meta.get_attr('/photos/new.jpg') is None
+    assert meta.missing_cache.get('/photos/new.jpg')
+
+    # Second lookup doesn't read the index.
+    meta.get_entry = None
+    assert meta.get_attr('/photos/new.jpg') is None
+    del meta.get_entry
+
+    created = dict(FILE, _id='new-id', name='new.jpg')
+    meta.on_change({'id': 'new-id', 'doc': created})
+    assert meta.missing_cache.get('/photos/new.jpg') is None
+    assert meta.get_attr('/photos/new.jpg') == 'new.jpg'
+
+
+def test_missing_path_without_index():
+    db = FakeDB([FOLDER])
+    meta = metadata.Metadata(db, pathindex.PathIndex(), get_stat)
+    assert meta.get_attr('/photos/beach.jpg') is None
+    assert meta.get_attr('/photos/beach.jpg') is None
+    assert db.queries == 1
+
+    db.docs.append(FILE)
+    meta.on_change({'id': 'file-id', 'doc': FILE})
+    assert meta.get_attr('/photos/beach.jpg') == 'beach.jpg'
+    assert db.queries == 2
+
+
+def test_list_without_index():
+    db = FakeDB([FOLDER, FILE])
+    meta = metadata.Metadata(db, pathindex.PathIndex(), get_stat)
+    assert meta.list('/photos') == [FILE]
+    assert meta.list('/photos') == [FILE]
+    assert db.queries == 2
+    assert meta.get_attr('/photos/beach.jpg') == 'beach.jpg'
+    assert db.queries == 2
+
+    renamed = dict(FILE, name='sea.jpg')
+    db.docs[1] = renamed
+    meta.on_change({'id': 'file-id', 'doc': renamed})
+    assert meta.list('/photos') == [renamed]
+    assert db.queries == 4
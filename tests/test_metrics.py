@@ -0,0 +1,78 @@
+import pytest
+import sys
+import errno
+
+sys.path.append('..')
+
+import cozyfuse.cache as cache
+import cozyfuse.metrics as metrics
+
+
+def test_instrument():
+    stats = metrics.Metrics()
+
+    def getattr(path):
+        if path == '/missing':
+            return -errno.ENOENT
+        return 'stat'
+
+    def readdir(path):
+        for name in ['a', 'b']:
+            yield name
+
+    getattr = stats.instrument('getattr', getattr)
+    readdir = stats.instrument('readdir', readdir)
+    assert getattr('/file') == 'stat'
+    assert getattr('/missing') == -errno.ENOENT
+    assert readdir('/') == ['a', 'b']
+
+    operations = stats.snapshot()['operations']
+    assert operations['getattr']['calls'] == 2
+    assert operations['getattr']['errors'] == 1
+    assert operations['readdir']['calls'] == 1
+    assert sum(operations['getattr']['buckets']) == 2
+
+
+def test_instrument_exception():
+    stats = metrics.Metrics()
+
+    def read(path):
+        raise IOError()
+
+    read = stats.instrument('read', read)
+    pytest.raises(IOError, read, '/file')
+    assert stats.snapshot()['operations']['read']['errors'] == 1
+
+
+def test_histogram():
+    operation = metrics.OperationStats()
+    operation.record(0.05, False)
+    operation.record(3, False)
+    operation.record(10000, False)
+    assert operation.buckets[0] == 1
+    assert operation.buckets[3] == 1
+    assert operation.buckets[-1] == 1
+    assert operation.max_time == 10000
+
+
+def test_cache_stats():
+    stats = metrics.Metrics()
+    local_cache = cache.Cache()
+    stats.register_cache('attr', local_cache)
+    local_cache.get('/file')
+    local_cache.add('/file', 'stat')
+    local_cache.get('/file')
+    local_cache.remove('/file')
+    assert stats.snapshot()['caches']['attr'] == {
+        'size': 0, 'hits': 1, 'misses': 1, 'evictions': 1}
+
+
+def test_writer(tmpdir):
+    stats = metrics.Metrics()
+    stats.record('read', 2)
+    filename = str(tmpdir.join('metrics.json'))
+    metrics.MetricsWriter(stats, filename).write()
+    snapshot = metrics.read(filename)
+    assert snapshot['operations']['read']['calls'] == 1
+    lines = metrics.format_metrics(snapshot)
+    assert lines[1].split()[:3] == ['read', '1', '0']
@@ -0,0 +1,86 @@
+import pytest
+import sys
+
+sys.path.append('..')
+
+import cozyfuse.pathindex as pathindex
+
+
+FOLDER = {
+    '_id': 'folder-id',
+    'docType': 'Folder',
+    'path': '',
+    'name': 'photos',
+}
+
+FILE = {
+    '_id': 'file-id',
+    'docType': 'File',
+    'path': '/photos',
+    'name': u'\xe9t\xe9.jpg',
+}
+
+
+def get_index():
+    index = pathindex.PathIndex()
+    index.load([FOLDER, FILE])
+    return index
+
+
+def test_load():
+    index = pathindex.PathIndex()
+    assert not index.loaded
+    index.load([FOLDER, FILE, {'_id': 'device', 'docType': 'Device'}])
+    assert index.loaded
+    assert index.get('/photos') == FOLDER
+    assert index.get('/photos/\xc3\xa9t\xc3\xa9.jpg') == FILE
+    assert index.get('/device') is None
+
+
+def test_list():
+    index = get_index()
+    assert index.list('') == [FOLDER]
+    assert index.list('/photos') == [FILE]
+    assert index.list('/nothing') == []
+
+
+def test_is_folder():
+    assert pathindex.is_folder(FOLDER)
+    assert not pathindex.is_folder(FILE)
+
+
+def test_apply_change_creation():
+    index = get_index()
+    doc = {
+        '_id': 'new-id',
+        'docType': 'File',
+        'path': '',
+        'name': 'new.txt',
+    }
+    res = index.apply_change({'id': 'new-id', 'doc': doc})
+    assert res == (None, '/new.txt')
+    assert index.get('/new.txt') == doc
+    assert doc in index.list('')
+
+
+def test_apply_change_rename():
+    index = get_index()
+    doc = dict(FILE, name='renamed.jpg')
+    res = index.apply_change({'id': 'file-id', 'doc': doc})
+    assert res == ('/photos/\xc3\xa9t\xc3\xa9.jpg', '/photos/renamed.jpg')
+    assert index.get('/photos/\xc3\xa9t\xc3\xa9.jpg') is None
+    assert index.list('/photos') == [doc]
+    assert index.get_path('file-id') == '/photos/renamed.jpg'
+
+
+def test_apply_change_deletion():
+    index = get_index()
+    change = {
+        'id': 'file-id',
+        'deleted': True,
+        'doc': {'_id': 'file-id', '_deleted': True},
+    }
+    res = index.apply_change(change)
+    assert res == ('/photos/\xc3\xa9t\xc3\xa9.jpg', None)
+    assert index.list('/photos') == []
+    assert index.get_path('file-id') is None
@@ -0,0 +1,116 @@
+import sys
+import time
+
+sys.path.append('..')
+
+import cozyfuse.policies as policies
+
+
+def get_doc(path, name, size=None, mime=None):
+    return {'_id': name, 'docType': 'File', 'path': path, 'name': name,
+            'size': size, 'mime': mime, 'binary': {'file': {'id': name}}}
+
+
+class FakeFileIndex:
+    def update(self, doc):
+        pass
+
+
+class FakeBinaryCache:
+    '''
+    Binary cache recording pins, downloads and removals.
+    '''
+
+    def __init__(self, cached=()):
+        self.file_index = FakeFileIndex()
+        self.cached = set(cached)
+        self.pinned = set()
+        self.added = []
+        self.removed = []
+
+    def evict_metadata(self, path):
+        pass
+
+    def pin(self, path):
+        self.pinned.add(path)
+
+    def unpin(self, path):
+        self.pinned.discard(path)
+
+    def is_cached(self, path):
+        return path in self.cached
+
+    def add(self, path):
+        self.added.append(path)
+        self.cached.add(path)
+
+    def remove(self, path):
+        self.removed.append(path)
+        self.cached.discard(path)
+
+    def flush(self):
+        pass
+
+
+def test_invalid_rules():
+    policy = policies.CachePolicy([
+        {'path': 'Documents/'}, {'cache': False}, {'folder': '/Videos'},
+        'image/*'])
+    assert policy.rules == [{'path': '/Documents'}]
+    assert policies.CachePolicy(None).rules == []
+
+
+def test_should_cache():
+    policy = policies.CachePolicy([
+        {'path': '/Documents'},
+        {'max_size': 1},
+        {'mime': 'image/*'},
+        {'path': '/Videos', 'cache': False},
+        {'path': '/Documents/tmp', 'mime': 'text/*', 'cache': False},
+    ])
+    assert policy.should_cache(get_doc('/Documents', 'cv.pdf', 10 ** 8))
+    assert policy.should_cache(get_doc('', 'notes.txt', 100))
+    assert policy.should_cache(
+        get_doc('/Photos', 'cat.jpg', 10 ** 8, 'image/jpeg'))
+    assert policy.should_cache(
+        get_doc('/Documents/tmp', 'a.pdf', 10 ** 8, 'application/pdf'))
+    assert policy.should_cache(get_doc('/Videos', 'a.mp4', 100)) is False
+    assert policy.should_cache(
+        get_doc('/Documents/tmp', 'a.txt', 10 ** 8, 'text/plain')) is False
+    assert policy.should_cache(get_doc('/Documentsx', 'a', 10 ** 8)) is None
+    assert policy.should_cache(get_doc('/Music', 'a.mp3')) is None
+
+
+def test_apply():
+    policy = policies.CachePolicy([
+        {'path': '/Documents'}, {'path': '/Videos', 'cache': False}])
+    binary_cache = FakeBinaryCache(['/Videos/a.mp4', '/Documents/b.pdf'])
+    binary_cache.pinned.add('/Videos/a.mp4')
+    worker = policies.PolicyWorker(policy, binary_cache)
+    for doc in [get_doc('/Documents', 'a.pdf'),
+                get_doc('/Documents', 'b.pdf'),
+                get_doc('/Videos', 'a.mp4'),
+                get_doc('/Music', 'a.mp3')]:
+        worker.apply(doc)
+
+    assert binary_cache.added == ['/Documents/a.pdf']
+    assert binary_cache.removed == ['/Videos/a.mp4']
+    assert binary_cache.pinned == set(['/Documents/a.pdf', '/Documents/b.pdf'])
+    assert (worker.cached, worker.removed) == (1, 1)
+
+
+def test_worker(monkeypatch):
+    monkeypatch.setattr(policies, 'IDLE_DELAY', 0.1)
+    policy = policies.CachePolicy([{'path': '/Documents'}])
+    binary_cache = FakeBinaryCache()
+    worker = policies.PolicyWorker(policy, binary_cache)
+    worker.add(get_doc('/Documents', 'a.pdf'))
+    worker.add({'_id': 'folder', 'docType': 'Folder', 'path': '',
+                'name': 'Documents'})
+    worker.start()
+    while not worker.queue.empty():
+        time.sleep(0.01)
+    worker.stop()
+    worker.join(10)
+    assert not worker.is_alive()
+    assert binary_cache.added == ['/Documents/a.pdf']
@@ -0,0 +1,42 @@
+import pytest
+import sys
+
+sys.path.append('..')
+
+import cozyfuse.readahead as readahead
+
+
+def test_sequential():
+    read_ahead = readahead.ReadAhead()
+    read_ahead.update(0, 4096)
+    assert not read_ahead.sequential
+    read_ahead.update(4096, 4096)
+    assert read_ahead.sequential
+    read_ahead.update(8192, 4096)
+    assert read_ahead.sequential
+    assert read_ahead.window >= readahead.MIN_WINDOW
+    assert read_ahead.window <= readahead.MAX_WINDOW
+
+
+def test_random():
+    read_ahead = readahead.ReadAhead()
+    read_ahead.window = readahead.MAX_WINDOW
+    read_ahead.update(0, 4096)
+    read_ahead.update(4096, 4096)
+    read_ahead.update(1000000, 4096)
+    assert not read_ahead.sequential
+    assert read_ahead.window < readahead.MAX_WINDOW
+
+
+def test_window_follows_speed(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(readahead.time, 'time', lambda: now[0])
+    read_ahead = readahead.ReadAhead()
+    size = 1024 * 1024
+    read_ahead.update(0, size)
+    for i in range(1, 5):
+        now[0] += 1
+        read_ahead.update(i * size, size)
+    # 5 MB read in 4 s.
+    assert read_ahead.window == \
+        int(5 * size / 4.0 * readahead.WINDOW_DURATION)
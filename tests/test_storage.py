@@ -0,0 +1,115 @@
+import pytest
+import sys
+import copy
+
+sys.path.append('..')
+
+import cozyfuse.storage as storage
+
+from couchdb.http import ResourceConflict
+
+
+class Row:
+    def __init__(self, doc):
+        self.doc = doc
+
+
+class FakeDB:
+    '''
+    Database answering _all_docs and _bulk_docs requests, counting them.
+    Documents listed in *conflicts* are in conflict once.
+    '''
+
+    def __init__(self, docs, conflicts=()):
+        self.docs = dict([(doc['_id'], doc) for doc in docs])
+        self.conflicts = set(conflicts)
+        self.updates = []
+
+    def view(self, name, keys, include_docs):
+        return [Row(copy.deepcopy(self.docs.get(key))) for key in keys]
+
+    def update(self, docs):
+        self.updates.append([doc['_id'] for doc in docs])
+        results = []
+        for doc in docs:
+            if doc['_id'] in self.conflicts:
+                self.conflicts.remove(doc['_id'])
+                results.append((False, doc['_id'], ResourceConflict()))
+            else:
+                self.docs[doc['_id']] = doc
+                results.append((True, doc['_id'], '2-rev'))
+        return results
+
+
+def get_docs():
+    return [
+        {'_id': 'file-1', 'docType': 'File'},
+        {'_id': 'file-2', 'docType': 'File', 'storage': ['laptop']},
+        {'_id': 'file-3', 'docType': 'File', 'storage': ['phone']},
+    ]
+
+
+def test_flush():
+    db = FakeDB(get_docs())
+    queue = storage.StorageQueue(db, 'laptop')
+    queue.mark('file-1', True, 12)
+    queue.mark('file-2', False)
+    queue.mark('file-3', True)
+    assert db.updates == []
+
+    queue.flush()
+    assert len(db.updates) == 1
+    assert sorted(db.updates[0]) == ['file-1', 'file-2', 'file-3']
+    assert db.docs['file-1']['storage'] == ['laptop']
+    assert db.docs['file-1']['size'] == 12
+    assert db.docs['file-2']['storage'] == []
+    assert db.docs['file-3']['storage'] == ['phone', 'laptop']
+    assert queue.pending == {}
+
+
+def test_flush_unchanged():
+    db = FakeDB(get_docs())
+    queue = storage.StorageQueue(db, 'laptop')
+    queue.mark('file-2', True)
+    queue.mark('file-3', False)
+    queue.mark('unknown', True)
+    queue.flush()
+    assert db.updates == []
+
+
+def test_last_mark():
+    db = FakeDB(get_docs())
+    queue = storage.StorageQueue(db, 'laptop')
+    queue.mark('file-1', True)
+    queue.mark('file-1', False)
+    queue.flush()
+    assert db.updates == []
+
+
+def test_batch_size():
+    db = FakeDB(get_docs())
+    queue = storage.StorageQueue(db, 'laptop', batch_size=2)
+    queue.mark('file-1', True)
+    assert db.updates == []
+    queue.mark('file-3', True)
+    assert len(db.updates) == 1
+
+
+def test_conflict():
+    db = FakeDB(get_docs(), conflicts=['file-1'])
+    queue = storage.StorageQueue(db, 'laptop')
+    queue.mark('file-1', True)
+    queue.flush()
+    assert db.updates == [['file-1'], ['file-1']]
+    assert db.docs['file-1']['storage'] == ['laptop']
+
+
+def test_flusher_stop():
+    db = FakeDB(get_docs())
+    queue = storage.StorageQueue(db, 'laptop')
+    flusher = storage.StorageFlusher(queue, 60)
+    flusher.start()
+    queue.mark('file-1', True)
+    flusher.stop()
+    flusher.join(1)
+    assert db.docs['file-1']['storage'] == ['laptop']
@@ -0,0 +1,201 @@
+import pytest
+import sys
+import errno
+import uuid
+
+sys.path.append('..')
+
+import cozyfuse.metadata as metadata
+import cozyfuse.pathindex as pathindex
+import cozyfuse.tree as tree
+
+from couchdb.http import ResourceConflict
+
+
+class Row:
+    def __init__(self, value, doc_id=None):
+        self.value = value
+        self.doc = value
+        self.id = doc_id
+
+
+class FakeDB:
+    '''
+    Database storing documents in a dict, checking revisions.
+    '''
+
+    def __init__(self):
+        self.docs = {}
+        self.attachments = {}
+        self.bulk_sizes = []
+
+    def save(self, doc):
+        doc.setdefault('_id', uuid.uuid4().hex)
+        stored = self.docs.get(doc['_id'])
+        if stored is not None and stored['_rev'] != doc.get('_rev'):
+            raise ResourceConflict()
+        revision = int(doc.get('_rev', '0').split('-')[0]) + 1
+        doc['_rev'] = '%d-rev' % revision
+        self.docs[doc['_id']] = dict(doc)
+
+    def put_attachment(self, doc, content, filename):
+        self.attachments[doc['_id']] = content
+        self.save(doc)
+
+    def delete(self, doc):
+        if self.docs[doc['_id']]['_rev'] != doc['_rev']:
+            raise ResourceConflict()
+        del self.docs[doc['_id']]
+
+    def __getitem__(self, doc_id):
+        return dict(self.docs[doc_id])
+
+    def update(self, docs):
+        self.bulk_sizes.append(len(docs))
+        results = []
+        for doc in docs:
+            try:
+                self.save(doc)
+                results.append((True, doc['_id'], doc['_rev']))
+            except ResourceConflict as e:
+                results.append((False, doc['_id'], e))
+        return results
+
+    def view(self, name, startkey=None, endkey=None, keys=None,
+             include_docs=False):
+        if name == '_all_docs':
+            return [Row(self[doc_id], doc_id) for doc_id in keys]
+        docs = [doc for doc in self.docs.values()
+                if doc.get('docType') in ['Folder', 'File']]
+        docs.sort(key=lambda doc: doc['path'] + u'/' + doc['name'])
+        return [Row(dict(doc)) for doc in docs
+                if startkey <= doc['path'] + u'/' + doc['name'] <= endkey]
+
+
+class FakeBinaryCache:
+    def __init__(self):
+        self.discarded = []
+
+    def discard(self, path):
+        self.discarded.append(path)
+
+
+def get_tree():
+    db = FakeDB()
+    index = pathindex.PathIndex()
+    index.load([])
+    meta = metadata.Metadata(db, index, lambda doc: doc)
+    return tree.Tree(db, meta, FakeBinaryCache())
+
+
+def test_create_folder():
+    files = get_tree()
+    files.create_folder('/photos')
+    doc = files.metadata.get_entry('/photos')
+    assert doc['docType'] == 'Folder'
+    assert files.db.docs[doc['_id']]['path'] == ''
+
+    with pytest.raises(OSError) as error:
+        files.create_folder('/photos')
+    assert error.value.errno == errno.EEXIST
+
+    with pytest.raises(OSError) as error:
+        files.create_folder('/videos/2014')
+    assert error.value.errno == errno.ENOENT
+
+
+def test_create_file():
+    files = get_tree()
+    folder = files.create_folder('/photos')
+    files.create_file('/photos/\xc3\xa9t\xc3\xa9.jpg')
+    doc = files.metadata.get_file('/photos/\xc3\xa9t\xc3\xa9.jpg')
+    assert doc['name'] == u'\xe9t\xe9.jpg'
+    assert doc['mime'] == 'image/jpeg'
+    binary_id = doc['binary']['file']['id']
+    assert files.db.attachments[binary_id] == ''
+    assert files.db.docs[folder['_id']]['_rev'] == '2-rev'
+
+
+def test_remove_file():
+    files = get_tree()
+    doc = files.create_file('/test.txt')
+    files.remove_file('/test.txt')
+    assert files.db.docs == {}
+    assert files.binary_cache.discarded == ['/test.txt']
+    assert files.metadata.get_attr('/test.txt') is None
+
+    with pytest.raises(OSError) as error:
+        files.remove_file('/test.txt')
+    assert error.value.errno == errno.ENOENT
+
+
+def test_remove_folder():
+    files = get_tree()
+    files.create_folder('/photos')
+    files.create_file('/photos/test.jpg')
+
+    with pytest.raises(OSError) as error:
+        files.remove_folder('/photos')
+    assert error.value.errno == errno.ENOTEMPTY
+
+    files.remove_file('/photos/test.jpg')
+    files.remove_folder('/photos')
+    assert files.db.docs == {}
+    assert files.metadata.list('') == []
+
+
+def test_rename_file():
+    files = get_tree()
+    files.create_folder('/photos')
+    doc = files.create_file('/test.jpg')
+    files.rename('/test.jpg', '/photos/beach.jpg')
+    assert files.metadata.get_entry('/test.jpg') is None
+    assert files.metadata.get_file('/photos/beach.jpg')['_id'] == doc['_id']
+    assert files.db.docs[doc['_id']]['path'] == '/photos'
+
+    files.create_file('/other.jpg')
+    files.rename('/other.jpg', '/photos/beach.jpg')
+    assert doc['_id'] not in files.db.docs
+
+    with pytest.raises(OSError) as error:
+        files.rename('/photos/beach.jpg', '/photos')
+    assert error.value.errno == errno.EISDIR
+
+
+def test_rename_folder(monkeypatch):
+    monkeypatch.setattr(tree.dbutils, 'BULK_BATCH_SIZE', 2)
+    files = get_tree()
+    files.create_folder('/photos')
+    files.create_folder('/photos/2014')
+    files.create_file('/photos/2014/a.jpg')
+    files.create_file('/photos/2014/b.jpg')
+    files.create_file('/photos/c.jpg')
+    files.create_file('/photosphere.jpg')
+    files.db.bulk_sizes = []
+
+    files.rename('/photos', '/pictures')
+    paths = sorted([doc['path'] + '/' + doc['name']
+                    for doc in files.db.docs.values()
+                    if doc.get('docType') in ['Folder', 'File']])
+    assert paths == ['/photosphere.jpg', '/pictures', '/pictures/2014',
+                     '/pictures/2014/a.jpg', '/pictures/2014/b.jpg',
+                     '/pictures/c.jpg']
+    assert files.db.bulk_sizes == [2, 2, 1]
+    assert files.metadata.get_entry('/photos/2014') is None
+    assert files.metadata.get_file('/pictures/2014/a.jpg') is not None
+
+    with pytest.raises(OSError) as error:
+        files.rename('/pictures', '/pictures/2014/photos')
+    assert error.value.errno == errno.EINVAL
+
+
+def test_bulk_update_conflict():
+    db = FakeDB()
+    doc = {'_id': 'doc', 'count': 0}
+    db.save(doc)
+    db.save(dict(doc))
+    (saved, failed) = tree.dbutils.bulk_update(
+        db, [doc], lambda doc: doc.update(count=doc['count'] + 1))
+    assert failed == []
+    assert db.docs['doc']['count'] == 1
+    assert db.docs['doc']['_rev'] == '3-rev'
@@ -0,0 +1,133 @@
+import pytest
+import sys
+import os
+
+sys.path.append('..')
+
+import cozyfuse.writeback as writeback
+
+
+class FakeDB:
+    '''
+    Database storing one file and its binary.
+    '''
+
+    def __init__(self):
+        self.docs = {
+            'file-id': {'_id': 'file-id', '_rev': '1-rev', 'binary': {
+                'file': {'id': 'binary-id', 'rev': '1-rev'}}},
+            'binary-id': {'_id': 'binary-id', '_rev': '1-rev'},
+        }
+        self.content = '0123456789'
+        self.uploads = 0
+
+    def put_attachment(self, doc, content, filename, content_type):
+        self.content = content.read()
+        self.uploads += 1
+        doc['_rev'] = '%d-rev' % (self.uploads + 1)
+
+    def save(self, doc):
+        self.docs[doc['_id']] = doc
+
+    def __getitem__(self, doc_id):
+        return dict(self.docs[doc_id])
+
+
+class FakeBinaryCache:
+    '''
+    Binary cache storing the file content in a local file.
+    '''
+
+    def __init__(self, db, folder):
+        self.name = 'laptop'
+        self.db = db
+        self.filename = os.path.join(folder, 'cached')
+        self.stored = False
+
+    def get_file_metadata(self, path):
+        return (self.db.docs['file-id'], 'binary-id', self.filename)
+
+    def add(self, path):
+        with open(self.filename, 'wb') as fd:
+            fd.write(self.db.content)
+
+    def get(self, path):
+        return open(self.filename, 'rb')
+
+    def discard(self, path):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def store(self, path, filename):
+        os.rename(filename, self.filename)
+        self.stored = True
+
+
+@pytest.fixture
+def staging(tmpdir):
+    db = FakeDB()
+    binary_cache = FakeBinaryCache(db, str(tmpdir))
+    saved = []
+    staging = writeback.Staging(db, binary_cache,
+                                str(tmpdir.join('staging')), saved.append)
+    staging.saved = saved
+    return staging
+
+
+def test_write(staging):
+    handle = staging.open('/test.txt')
+    assert handle.read(4, 0) == '0123'
+    assert handle.write('ab', 2) == 2
+    assert handle.read(4, 0) == '01ab'
+    assert staging.open('/test.txt') is handle
+    handle.release()
+    assert staging.db.content == '01ab456789'
+
+    handle.write('cd', 10)
+    assert handle.get_size() == 12
+    handle.release()
+    assert staging.db.uploads == 2
+    assert staging.db.content == '01ab456789cd'
+    assert staging.handles == {}
+    assert staging.binary_cache.stored
+    assert os.listdir(staging.folder) == []
+
+    doc = staging.db.docs['file-id']
+    assert doc['size'] == 12
+    assert doc['binary']['file']['rev'] == '3-rev'
+    assert doc['storage'] == ['laptop']
+    assert len(staging.saved) == 2
+    assert staging.saved[-1] == doc
+
+
+def test_release_unchanged(staging):
+    handle = staging.open('/test.txt')
+    handle.read(4, 0)
+    handle.release()
+    assert staging.db.uploads == 0
+    assert not staging.binary_cache.stored
+    assert os.listdir(staging.folder) == []
+
+
+def test_truncate(staging):
+    staging.truncate('/test.txt', 4)
+    assert staging.db.content == '0123'
+    handle = staging.open('/test.txt', truncate=True)
+    handle.release()
+    assert staging.db.content == ''
+
+
+def test_sparse_write(staging):
+    handle = staging.open('/test.txt', truncate=True)
+    handle.write('end', 1024 * 1024)
+    handle.flush()
+    assert len(staging.db.content) == 1024 * 1024 + 3
+    handle.release()
+    assert staging.db.uploads == 1
+
+
+def test_stale_files(tmpdir):
+    folder = tmpdir.mkdir('staging')
+    folder.join('tmp123').write('lost')
+    writeback.Staging(None, None, str(folder))
+    assert folder.listdir() == []